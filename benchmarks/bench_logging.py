@@ -0,0 +1,79 @@
+"""Micro-benchmark of debug logging of notification payloads.
+
+Compares the per-request overhead of eagerly serializing payloads line by
+line, as done by earlier versions of the plugin, to deferred serialization
+with LazyJSON, with debug logging disabled and enabled.
+
+Run from within the repository root with
+
+    python benchmarks/bench_logging.py
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import timeit
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..'))
+
+from dtool_lookup_server_notification_plugin.log import LazyJSON  # NOQA
+
+MOCK_EVENT = os.path.join(_HERE, '..', 'tests', 'data', 'mock_event.json')
+
+logger = logging.getLogger('bench_logging')
+
+
+def eager_log_nested(log_func, dct):
+    """Logging of nested content as implemented in plugin versions <= 0.2.2."""
+    for l in json.dumps(dct, indent=2, default=str).splitlines():
+        log_func(l)
+
+
+def lazy_log_nested(log_func, dct):
+    log_func("%s", LazyJSON(dct))
+
+
+def log_request(log_nested, payload):
+    """Debug logging done for a single request by the webhook/notify route."""
+    logger.debug("Request JSON:")
+    log_nested(logger.debug, payload)
+    logger.debug("Records:")
+    log_nested(logger.debug, payload['Records'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, nargs='+', default=[1, 100, 1000],
+                        help='number of records per notification')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with open(MOCK_EVENT) as f:
+        event = json.load(f)
+
+    # format all records as usual, but discard the output
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    print('{:>8} {:>6} {:>14} {:>14} {:>8}'.format(
+        'records', 'level', 'eager [us]', 'lazy [us]', 'speedup'))
+    for num_records in args.records:
+        payload = dict(event, Records=event['Records'] * num_records)
+        number = max(1, 2000 // num_records)
+        for level in [logging.INFO, logging.DEBUG]:
+            logger.setLevel(level)
+            timings = []
+            for log_nested in [eager_log_nested, lazy_log_nested]:
+                t = min(timeit.repeat(lambda: log_request(log_nested, payload),
+                                      number=number, repeat=args.repeat))
+                timings.append(1e6 * t / number)
+            print('{:>8} {:>6} {:>14.2f} {:>14.2f} {:>8.1f}'.format(
+                num_records, logging.getLevelName(level), timings[0], timings[1],
+                timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""Throughput benchmark of the notification routes.
+
+Generates datasets with a configurable number of items on disk and replays
+synthetic notifications about their creation through the Flask test client:
+
+    single          one S3 event record per /webhook/notify request
+    multi           several records per /webhook/notify request
+    sns             single records form-encoded like NetApp StorageGRID
+    elastic-search  /elastic-search/notify/all/... requests with metadata
+
+Reports events per second, p50 and p99 latency per request of the fastest
+of several runs and the peak memory allocated within a separate run.
+Requires a MongoDB server, i.e. start one with
+
+    docker run -d -p 27017:27017 mongo
+
+and run from within the repository root with
+
+    python benchmarks/bench_notify.py
+"""
+import argparse
+import copy
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..'))
+
+import dtoolcore  # NOQA
+
+from dtoolcore.utils import sanitise_uri  # NOQA
+
+from dtool_lookup_server_notification_plugin import Config  # NOQA
+
+MOCK_EVENT = os.path.join(_HERE, '..', 'tests', 'data', 'mock_event.json')
+
+BUCKET_NAME = 'bench-bucket'
+
+SCENARIOS = ['single', 'multi', 'sns', 'elastic-search']
+
+
+def create_app(mongo_uri, mongo_db_name):
+    from dtool_lookup_server import create_app, sql_db
+    from dtool_lookup_server.utils import register_users
+
+    app = create_app({
+        "SECRET_KEY": "secret",
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
+        "MONGO_URI": "{}/{}".format(mongo_uri.rstrip('/'), mongo_db_name),
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    })
+    app.app_context().push()
+    sql_db.Model.metadata.create_all(sql_db.engine)
+    register_users([dict(username="bench", is_admin=True)])
+    return app
+
+
+def create_datasets(base_uri, num_datasets, num_items, item_size):
+    """Create frozen datasets, return their admin metadata."""
+    admin_metadata = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        item_path = os.path.join(tmp_dir, 'item')
+        with open(item_path, 'wb') as f:
+            f.write(os.urandom(item_size))
+        for i in range(num_datasets):
+            proto_dataset = dtoolcore.create_proto_dataset(
+                'bench-{}'.format(i), base_uri, readme_content='index: {}'.format(i))
+            for j in range(num_items):
+                proto_dataset.put_item(item_path, 'item-{}'.format(j))
+            proto_dataset.freeze()
+            admin_metadata.append(
+                dtoolcore.DataSet.from_uri(proto_dataset.uri)._admin_metadata)
+    return admin_metadata
+
+
+def s3_record(template, uuid, object_key):
+    record = copy.deepcopy(template)
+    record['eventName'] = 's3:ObjectCreated:Put'
+    record['s3']['bucket']['name'] = BUCKET_NAME
+    record['s3']['object']['key'] = urllib.parse.quote('{}/{}'.format(uuid, object_key))
+    return record
+
+
+def generate_requests(scenario, admin_metadata, template, records_per_request):
+    """Yield (url, keyword arguments of client.post, number of events)."""
+    event = {k: v for k, v in template.items() if k != 'Records'}
+    record = template['Records'][0]
+    if scenario == 'single':
+        for metadata in admin_metadata:
+            payload = dict(event, Records=[s3_record(record, metadata['uuid'], 'dtool')])
+            yield '/webhook/notify', dict(json=payload), 1
+    elif scenario == 'multi':
+        # finalizing and metadata objects of several datasets per request
+        records = [s3_record(record, metadata['uuid'], object_key)
+                   for metadata in admin_metadata
+                   for object_key in ['README.yml', 'dtool']]
+        for i in range(0, len(records), records_per_request):
+            payload = dict(event, Records=records[i:i+records_per_request])
+            yield '/webhook/notify', dict(json=payload), len(payload['Records'])
+    elif scenario == 'sns':
+        for metadata in admin_metadata:
+            payload = dict(event, Records=[s3_record(record, metadata['uuid'], 'dtool')])
+            form = {
+                'Action': 'Publish',
+                'Message': json.dumps(payload),
+                'TopicArn': 'urn:bench:sns:bench:bench:bench',
+                'Version': '2010-03-31',
+            }
+            yield '/webhook/notify', dict(data=form), 1
+    elif scenario == 'elastic-search':
+        for metadata in admin_metadata:
+            url = '/elastic-search/notify/all/{}_{}/dtool'.format(BUCKET_NAME, metadata['uuid'])
+            yield url, dict(json={'bucket': BUCKET_NAME, 'metadata': metadata}), 1
+    else:
+        raise ValueError("Unknown scenario '{}'.".format(scenario))
+
+
+def run(client, requests):
+    """Post all requests, return latencies per request and number of events."""
+    latencies = []
+    num_events = 0
+    for url, kwargs, n in requests:
+        start = time.perf_counter()
+        r = client.post(url, **kwargs)
+        latencies.append(time.perf_counter() - start)
+        if r.status_code not in (200, 202):
+            raise RuntimeError("{} returned status {}.".format(url, r.status_code))
+        num_events += n
+    return latencies, num_events
+
+
+def peak_memory(client, requests):
+    """Post all requests, return the peak memory allocated in bytes."""
+    # separate run, tracing allocations slows down processing considerably
+    tracemalloc.start()
+    try:
+        run(client, requests)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--items', type=int, nargs='+', default=[1, 100],
+                        help='number of items per dataset')
+    parser.add_argument('--item-size', type=int, default=1024,
+                        help='size of every item in bytes')
+    parser.add_argument('--datasets', type=int, default=50,
+                        help='number of datasets notified about per run')
+    parser.add_argument('--records', type=int, default=10,
+                        help='number of records per request of scenario multi')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per scenario, the fastest is reported')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017')
+    args = parser.parse_args()
+
+    from dtool_lookup_server import mongo
+    from dtool_lookup_server.utils import register_base_uri, update_permissions
+
+    with open(MOCK_EVENT) as f:
+        template = json.load(f)
+
+    mongo_db_name = 'bench_notify_{}'.format(os.getpid())
+    app = create_app(args.mongo_uri, mongo_db_name)
+    client = app.test_client()
+
+    print('{:>15} {:>6} {:>9} {:>10} {:>10} {:>10} {:>12}'.format(
+        'scenario', 'items', 'events', 'events/s', 'p50 [ms]', 'p99 [ms]', 'memory [kB]'))
+    try:
+        for num_items in args.items:
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                base_uri = sanitise_uri(tmp_dir)
+                register_base_uri(base_uri)
+                update_permissions({
+                    'base_uri': base_uri,
+                    'users_with_search_permissions': ['bench'],
+                    'users_with_register_permissions': ['bench'],
+                })
+                Config.BUCKET_TO_BASE_URI[BUCKET_NAME] = base_uri
+                admin_metadata = create_datasets(
+                    base_uri, args.datasets, num_items, args.item_size)
+
+                for scenario in args.scenarios:
+                    requests = list(generate_requests(
+                        scenario, admin_metadata, template, args.records))
+                    best = None
+                    for _ in range(args.repeat):
+                        latencies, num_events = run(client, requests)
+                        if best is None or sum(latencies) < sum(best):
+                            best = latencies
+                    latencies = best
+                    peak = peak_memory(client, requests)
+                    print('{:>15} {:>6} {:>9} {:>10.1f} {:>10.2f} {:>10.2f} {:>12.0f}'.format(
+                        scenario, num_items, num_events,
+                        num_events / sum(latencies),
+                        1e3 * statistics.median(latencies),
+                        1e3 * percentile(latencies, 99),
+                        peak / 1024))
+            finally:
+                shutil.rmtree(tmp_dir)
+    finally:
+        mongo.cx.drop_database(mongo_db_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Benchmark resolution of bucket names in elastic search object paths.
+
+Compares the linear scan over all configured buckets, as done by earlier
+versions of the plugin, to the longest-prefix lookup of the bucket index
+for increasing numbers of configured buckets.
+
+Run from within the repository root with
+
+    python benchmarks/bench_parse_objpath.py
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import timeit
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, '..'))
+
+from dtool_lookup_server_notification_plugin import Config, _parse_objpath  # NOQA
+from dtool_lookup_server_notification_plugin.config import BucketIndex  # NOQA
+
+OBJ_KEY = 'u/lp1029/6ea79d31-f100-486a-9e78-c5b609cb35de/dtool'
+
+
+def linear_scan(buckets, objpath):
+    """Bucket resolution as implemented in plugin versions <= 0.2.2."""
+    base_uri = None
+    objpath_without_bucket = None
+    for bucket, uri in buckets.items():
+        if objpath.startswith(bucket):
+            base_uri = uri
+            objpath_without_bucket = objpath[len(bucket)+1:]
+    return base_uri, objpath_without_bucket
+
+
+def random_bucket_name(rng):
+    length = rng.randint(3, 63)
+    return ''.join(rng.choice(string.ascii_lowercase + string.digits + '-')
+                   for _ in range(length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--buckets', type=int, nargs='+', default=[10, 1000, 10000],
+                        help='number of configured buckets')
+    parser.add_argument('--number', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+
+    print('{:>8} {:>16} {:>16} {:>20} {:>8}'.format(
+        'buckets', 'linear [us]', 'index [us]', '_parse_objpath [us]', 'speedup'))
+    for num_buckets in args.buckets:
+        buckets = {}
+        while len(buckets) < num_buckets:
+            name = random_bucket_name(rng)
+            buckets[name] = 's3://' + name
+        objpaths = ['{}_{}'.format(bucket, OBJ_KEY)
+                    for bucket in rng.sample(list(buckets), min(100, num_buckets))]
+        index = BucketIndex(buckets)
+        Config.BUCKET_TO_BASE_URI = index
+
+        def run(func):
+            t = min(timeit.repeat(lambda: [func(p) for p in objpaths],
+                                  number=max(1, args.number // len(objpaths)),
+                                  repeat=args.repeat))
+            return 1e6 * t / (max(1, args.number // len(objpaths)) * len(objpaths))
+
+        t_linear = run(lambda p: linear_scan(buckets, p))
+        t_index = run(index.longest_prefix)
+        t_parse = run(_parse_objpath)
+        print('{:>8} {:>16.3f} {:>16.3f} {:>20.3f} {:>8.1f}'.format(
+            num_buckets, t_linear, t_index, t_parse, t_linear / t_index))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,27 @@
-import ipaddress
+import hashlib
 import json
 import logging
+import os
 import re
+from contextlib import contextmanager
 from functools import wraps
 
+import yaml
+
 import dtoolcore, dtool_s3
+from botocore.exceptions import BotoCoreError, ClientError
+from dtool_s3.storagebroker import S3StorageBroker
+from dtoolcore.storagebroker import DiskStorageBroker
 from flask import (
     abort,
     current_app,
     request
 )
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import and_, text
 
 from dtool_lookup_server import (
+    AuthenticationError,
     mongo,
     sql_db,
     ValidationError,
@@ -22,9 +32,11 @@ from dtool_lookup_server.sql_models import (
     Dataset,
 )
 from dtool_lookup_server.utils import (
-    base_uri_exists,
+    _json_serial,
+    generate_dataset_info,
+    get_user_obj,
+    register_dataset,
 )
-
 try:
     from importlib.metadata import version, PackageNotFoundError
 except ModuleNotFoundError:
@@ -44,40 +56,67 @@ if __version__ is None:
         __version__ = None
 
 
+AFFIRMATIVE_EXPRESSIONS = ['true', '1', 'y', 'yes', 'on']
+
+from .cache import LRUCache
 from .config import Config
+from .log import LazyJSON, configure_logging
+from .metrics import stage
+from .s3 import plugin_storage_access
+from .stats import Counters, register_stats
+from .worker import BatchCollector, KeyedLock, SingleFlight, _get_extension
 
-AFFIRMATIVE_EXPRESSIONS = ['true', '1', 'y', 'yes', 'on']
 UUID_REGEX_PATTERN = '[0-9A-F]{8}-[0-9A-F]{4}-[4][0-9A-F]{3}-[89AB][0-9A-F]{3}-[0-9A-F]{12}'
 UUID_REGEX = re.compile(UUID_REGEX_PATTERN, re.IGNORECASE)
 
 logger = logging.getLogger(__name__)
+configure_logging()
 
 
 def _log_nested(log_func, dct):
-    for l in json.dumps(dct, indent=2, default=str).splitlines():
-        log_func(l)
+    """Log nested content, serialized only if the level is enabled."""
+    log_func("%s", LazyJSON(dct))
 
 
 def filter_ips(f):
     @wraps(f)
     def wrapped(*args, **kwargs):
-        ip = ipaddress.ip_address(request.remote_addr)
-        logger.info("Accessed from %s", ip)
-        if ip in Config.ALLOW_ACCESS_FROM:
+        if request.remote_addr in Config.allow_list():
+            logger.debug("Accessed from %s", request.remote_addr)
             return f(*args, **kwargs)
         else:
+            logger.info("Access from %s denied", request.remote_addr)
             return abort(403)
 
     return wrapped
 
 
+def admin_required(f):
+    """Respond with 401 to unknown users and with 403 to users who are not
+    admins.
+
+    Apply after jwt_required."""
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        try:
+            user = get_user_obj(get_jwt_identity())
+        except AuthenticationError:
+            abort(401)
+        if not user.is_admin:
+            logger.info("Access of non-admin user '%s' denied", user.username)
+            abort(403)
+        return f(*args, **kwargs)
+
+    return wrapped
+
+
 def _parse_obj_key(key):
     # Just looking at the end of the key is a bit risky, you might find
     # anything below the data prefix, including another wrapped dataset, hence:
     # TODO: check for relative position below top-level
     components = key.split('/')
     if len(components) > 1:
-        if components[-2] in ['data', 'tags', 'annotations']:
+        if components[-2] in ['data', 'tags', 'annotations', 'overlays', 'fragments']:
             # The UUID is the component before 'data'
             uuid = components[-3]
             kind = components[-2]
@@ -97,6 +136,36 @@ def _parse_obj_key(key):
     return uuid, kind
 
 
+OBJECT_KEY_CLASS_NAMES = ['finalizing', 'metadata', 'payload']
+
+
+class ObjectKeyClassifier(object):
+    """Sort object keys into classes by the kind of the object.
+
+    Only the creation of 'finalizing' objects (admin metadata, manifest) and
+    'metadata' objects (README, tags, annotations) may change the index entry
+    of a dataset. Creation of 'payload' objects (item data, overlays,
+    fragments) can be acknowledged without any further processing.
+    """
+
+    def __init__(self):
+        self.counters = Counters(*OBJECT_KEY_CLASS_NAMES)
+
+    def classify(self, object_key):
+        """Return class of the object and count it."""
+        _, kind = _parse_obj_key(object_key)
+        key_class = Config.OBJECT_KEY_CLASSES.get(kind, 'finalizing')
+        self.counters.increment(key_class)
+        return key_class
+
+    def to_dict(self):
+        return self.counters.to_dict()
+
+
+object_key_classifier = ObjectKeyClassifier()
+register_stats('object_key_classes', object_key_classifier.to_dict)
+
+
 def _parse_objpath(objpath):
     """
     Extract base URI and UUID from the URL. The URL has the form
@@ -104,20 +173,41 @@ def _parse_objpath(objpath):
     or
         https://<server-name>/elastic-search/notify/all/<bucket-name>_<prefix><uuid>/dtool
     The objpath is the last part of the URL that follows /notify/all/.
+    If several configured bucket names prefix the objpath, the longest one
+    applies.
     """
-    base_uri = None
-    objpath_without_bucket = None
-    for bucket, uri in Config.BUCKET_TO_BASE_URI.items():
-        if objpath.startswith(bucket):
-            base_uri = uri
-            # +1 because there is an underscore after the bucket name
-            objpath_without_bucket = objpath[len(bucket)+1:]
+    buckets = Config.bucket_index()
+    bucket = buckets.longest_prefix(objpath)
+    if bucket is None:
+        logger.warning("No base URI configured for any bucket prefixing '%s'.",
+                       objpath)
+        return None, None, None
+
+    base_uri = buckets[bucket]
+    # +1 because there is an underscore after the bucket name
+    objpath_without_bucket = objpath[len(bucket)+1:]
 
     uuid, kind = _parse_obj_key(objpath_without_bucket)
 
     return base_uri, uuid, kind
 
 
+def _extract_uuid(object_key):
+    """Extract the UUID of the containing dataset from an object key."""
+    # We need to find the dataset UUID in the obejct key. A viable approach
+    # is to just look for the first valid v4 UUID in the string. This would
+    # conflict with a prefix that contains a v4 UUID as well.
+    uuid_match = UUID_REGEX.search(object_key)
+    if uuid_match is None:
+        # This should not happen, all s3 objects created via dtool
+        # must have a valid UUID within its object key.
+        raise ValueError("The object key %s does not contain any valid UUID.", object_key)
+
+    uuid = uuid_match.group(0)
+    logger.debug("Extracted UUID '%s' from object key '%s'.", uuid, object_key)
+    return uuid
+
+
 def _reconstruct_uri(base_uri, object_key):
     """Reconstruct dataset URI on S3 bucket from bucket name and object key."""
     # The expected structure of an object key (without preceding bucket name)
@@ -151,23 +241,24 @@ def _reconstruct_uri(base_uri, object_key):
     #   {BASE_URI}/{UUID}
     # Note that the mapping (BASE_URI, UUID) <-> URI is only bijective
     # for the s3 storage broker. It cannot be generalized to other storage.
-    # We need to find the dataset UUID in the obejct key. A viable approach
-    # is to just look for the first valid v4 UUID in the string. This would
-    # conflict with a prefix that contains a v4 UUID as well.
+    uuid = _extract_uuid(object_key)
+    return _reconstruct_uris([(base_uri, uuid)])[(base_uri, uuid)]
 
-    uuid_match = UUID_REGEX.search(object_key)
-    if uuid_match is None:
-        # This should not happen, all s3 objects created via dtool
-        # must have a valid UUID within its object key.
-        raise ValueError("The object key %s does not contain any valid UUID.", object_key)
 
-    uuid = uuid_match.group(0)
-    logger.debug("Extracted UUID '%s' from object key '%s'.", uuid, object_key)
+def _reconstruct_uris(datasets):
+    """Reconstruct dataset URIs for a collection of (base URI, UUID) tuples.
 
-    # check whether this (BASE_URI, UUID) combination has been registered before
-    uri = _retrieve_uri(base_uri, uuid)
+    Returns a dictionary mapping every (base URI, UUID) tuple to a dataset URI.
+    All tuples are looked up in the index with a single database query."""
+    # check whether these (BASE_URI, UUID) combinations have been registered before
+    uris = _retrieve_uris(datasets)
+
+    for base_uri, uuid in datasets:
+        if (base_uri, uuid) in uris:
+            logger.debug("Dataset registered before under URI '%s'.",
+                         uris[(base_uri, uuid)])
+            continue
 
-    if uri is None:
         # instead of using the dtoolcore._generate_uri proxy, we explicitly
         # use the dtool_s3.storagebroker.S3StorageBroker.generate_uri class
         # method as we know the name does not play a role here.
@@ -175,60 +266,334 @@ def _reconstruct_uri(base_uri, object_key):
         #     name='dummy', uuid=uuid, base_uri=base_uri)
         # instead of the explicit use of dtool_s3 above, we revert to the
         # following
-        return dtoolcore._generate_uri({'uuid': uuid, 'name': uuid}, base_uri)
+        uri = dtoolcore._generate_uri({'uuid': uuid, 'name': uuid}, base_uri)
         # just to make our current tests pass.
         # TODO: kick out dtoolcore._generate_uri once we have proper S3-based tests
 
         logger.debug(("Dataset has not been registered yet, "
                       "reconstructed URI '%s' from base URI '%s' and UUID '%s'."),
                      uri, base_uri, uuid)
-    else:
-        logger.debug("Dataset registered before under URI '%s'.", uri)
+        uris[(base_uri, uuid)] = uri
+
+    return uris
+
 
-    return uri
+# Cache of resolved dataset URIs, keyed by (base URI, UUID). Only registered
+# datasets are cached, entries are invalidated on deletion.
+uri_cache = LRUCache(max_size=Config.URI_CACHE_SIZE, ttl=Config.URI_CACHE_TTL)
+register_stats('uri_cache', uri_cache.to_dict)
 
 
 def _retrieve_uri(base_uri, uuid):
     """Retrieve URI(s) from database given as base URI and an UUID"""
-    if not base_uri_exists(base_uri):
-        raise(ValidationError(
-            "Base URI is not registered: {}".format(base_uri)
-        ))
+    return _retrieve_uris([(base_uri, uuid)]).get((base_uri, uuid))
+
+
+@stage('resolve_uri')
+def _retrieve_uris(datasets):
+    """Retrieve URIs from database for a collection of (base URI, UUID) tuples.
+
+    Returns a dictionary that contains only the registered datasets. Raises
+    ValidationError if any of the base URIs is not registered."""
+    uris = {}
+    datasets = set(datasets)
+    for dataset in datasets:
+        uri = uri_cache.get(dataset)
+        if uri is not None:
+            uris[dataset] = uri
+
+    datasets = datasets - uris.keys()
+    if len(datasets) == 0:
+        logger.debug("Retrieved all %d dataset URIs from cache.", len(uris))
+        return uris
+
+    base_uris = {base_uri for base_uri, _ in datasets}
+    uuids = {uuid for _, uuid in datasets}
 
     # Query database to construct the respective URI. We cannot just
     # concatenate base URI and UUID since the URI may depend on the name of
-    # the dataset which we do not have.
-    uris = []
-    query_result = sql_db.session.query(Dataset, BaseURI)  \
-        .filter(Dataset.uuid == uuid)  \
-        .filter(BaseURI.id == Dataset.base_uri_id)  \
-        .filter(BaseURI.base_uri == base_uri)
-    logger.debug("Query result:")
-    _log_nested(logger.debug, query_result)
-
-    for dataset, base_uri in query_result:
+    # the dataset which we do not have. The outer join yields at least one
+    # row per registered base URI, hence the same query validates the
+    # existence of all base URIs.
+    query_result = sql_db.session.query(BaseURI.base_uri, Dataset.uuid, Dataset.name)  \
+        .outerjoin(Dataset, and_(BaseURI.id == Dataset.base_uri_id,
+                                 Dataset.uuid.in_(uuids)))  \
+        .filter(BaseURI.base_uri.in_(base_uris))
+
+    registered_base_uris = set()
+    for base_uri, uuid, name in query_result:
+        registered_base_uris.add(base_uri)
         # this general treatment makes sense for arbitrary storage brokers, but
         # for the current (2022-02) implementation of the s3 broker, the actual
         # dataset name is irrelevant for the URI. Furthermore. there should
         # always be only one entry for a particular (BASE_URI, UUID) tuple
         # on an s3 bucket.
-        return dtoolcore._generate_uri(
-            {'uuid': dataset.uuid, 'name': dataset.name}, base_uri.base_uri)
+        if uuid is not None and (base_uri, uuid) in datasets:
+            uris[(base_uri, uuid)] = dtoolcore._generate_uri(
+                {'uuid': uuid, 'name': name}, base_uri)
+            uri_cache.put((base_uri, uuid), uris[(base_uri, uuid)])
 
-    return None
+    unregistered_base_uris = base_uris - registered_base_uris
+    if len(unregistered_base_uris) > 0:
+        raise(ValidationError(
+            "Base URI is not registered: {}".format(
+                ', '.join(sorted(unregistered_base_uris)))
+        ))
+
+    logger.debug("Retrieved %d dataset URIs from cache and index, %d not registered.",
+                 len(uris), len(datasets - uris.keys()))
+    return uris
 
 
 def delete_dataset(base_uri, uuid):
     """Delete a dataset in the lookup server."""
     uri = _retrieve_uri(base_uri, uuid)
-    current_app.logger.info('Deleting dataset with URI {}'.format(uri))
+    current_app.logger.info('Deleting dataset with URI %s', uri)
+    delete_datasets({(base_uri, uuid): uri})
+
+
+@stage('delete')
+def delete_datasets(datasets):
+    """Delete several datasets in the lookup server at once.
+
+    datasets maps (base URI, UUID) to the dataset URI. The datasets are
+    removed with a single statement from each database. If the removal from
+    the Mongo database fails, the committed removal from the SQL database is
+    reverted for all datasets still present in the Mongo database. Returns
+    the number of datasets removed from the SQL database."""
+    uris = sorted(set(datasets.values()))
+    if len(uris) == 0:
+        return 0
+
+    logger.info("Deleting %d datasets.", len(uris))
 
-    # Delete datasets with this URI
-    sql_db.session.query(Dataset)  \
-        .filter(Dataset.uri == uri)  \
-        .delete()
-    sql_db.session.commit()
+    table = Dataset.__table__
+    session = sql_db.session
+    try:
+        # keep removed rows to restore them if the Mongo database fails
+        rows = [dict(row._mapping) for row in session.execute(
+            table.select().where(table.c.uri.in_(uris)))]
+        session.execute(table.delete().where(table.c.uri.in_(uris)))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
 
     # Remove from Mongo database
-    # https://pymongo.readthedocs.io/en/stable/api/pymongo/collection.html#pymongo.collection.Collection.delete_one
-    mongo.db[MONGO_COLLECTION].delete_one({"uri": {"$eq": uri}})
+    # https://pymongo.readthedocs.io/en/stable/api/pymongo/collection.html#pymongo.collection.Collection.delete_many
+    try:
+        mongo.db[MONGO_COLLECTION].delete_many({"uri": {"$in": uris}})
+    except Exception:
+        # delete_many may have removed some of the documents before failing
+        try:
+            remaining = {document['uri'] for document in mongo.db[MONGO_COLLECTION].find(
+                {"uri": {"$in": uris}}, {"uri": True, "_id": False})}
+        except Exception:
+            logger.exception("Failed to look up datasets left in Mongo database, "
+                             "assuming none has been deleted.")
+            remaining = set(uris)
+        rows = [row for row in rows if row['uri'] in remaining]
+        logger.error("Failed to delete %d datasets from Mongo database, "
+                     "restoring %d SQL entries.", len(uris), len(rows))
+        if len(rows) > 0:
+            session.execute(table.insert(), rows)
+            session.commit()
+        raise
+
+    for key in datasets.keys():
+        uri_cache.invalidate(key)
+
+    return len(rows)
+
+
+DELETION_BATCHER_EXTENSION_NAME = 'dtool_lookup_server_notification_plugin_deletion'
+
+
+def get_deletion_batcher():
+    """Return the collector of dataset deletions of the current app."""
+    return _get_extension(
+        DELETION_BATCHER_EXTENSION_NAME,
+        lambda app: BatchCollector(app, delete_datasets,
+                                   period=Config.DELETION_BATCH_PERIOD,
+                                   max_size=Config.DELETION_BATCH_SIZE,
+                                   name='notification-deletion'),
+        BatchCollector.shutdown)
+
+
+def schedule_deletion(datasets):
+    """Delete datasets, collected over Config.DELETION_BATCH_PERIOD if set.
+
+    datasets maps (base URI, UUID) to the dataset URI. Datasets without URI,
+    i.e. never indexed, are skipped."""
+    datasets = {key: uri for key, uri in datasets.items() if uri is not None}
+    if len(datasets) == 0:
+        return
+    if Config.DELETION_BATCH_PERIOD > 0:
+        try:
+            get_deletion_batcher().add(datasets)
+            return
+        except RuntimeError:
+            logger.warning("Deletion batcher not available, deleting %d "
+                           "datasets immediately.", len(datasets))
+    delete_datasets(datasets)
+
+
+def cancel_deletion(base_uri, uuid):
+    """Remove a dataset from the collected deletions, i.e. when it has been
+    registered again. Return True if its deletion was pending."""
+    deletion_batcher = current_app.extensions.get(DELETION_BATCHER_EXTENSION_NAME)
+    if deletion_batcher is None or not deletion_batcher.remove((base_uri, uuid)):
+        return False
+    logger.info("Cancelled pending deletion of dataset %s in '%s'.", uuid, base_uri)
+    return True
+
+
+@contextmanager
+def _advisory_lock(name):
+    """Hold an advisory lock of the SQL database for name, if enabled.
+
+    Only PostgreSQL and MySQL support advisory locks, other databases
+    are not locked."""
+    if not Config.REGISTRATION_ADVISORY_LOCK or \
+            sql_db.engine.dialect.name not in ('postgresql', 'mysql'):
+        yield
+        return
+
+    dialect = sql_db.engine.dialect.name
+
+    digest = hashlib.sha1(name.encode('utf-8')).digest()
+    with sql_db.engine.connect() as connection:
+        if dialect == 'postgresql':
+            key = int.from_bytes(digest[:8], 'big', signed=True)
+            lock = text('SELECT pg_advisory_lock(:key)').bindparams(key=key)
+            unlock = text('SELECT pg_advisory_unlock(:key)').bindparams(key=key)
+        else:
+            key = digest.hex()
+            lock = text('SELECT GET_LOCK(:key, -1)').bindparams(key=key)
+            unlock = text('SELECT RELEASE_LOCK(:key)').bindparams(key=key)
+        connection.execute(lock)
+        try:
+            yield
+        finally:
+            connection.execute(unlock)
+
+
+# changes to the index entry of a dataset within this process, by dataset URI
+dataset_locks = KeyedLock()
+
+
+@contextmanager
+def _dataset_lock(dataset_uri):
+    """Serialize all changes to the index entry of a dataset within this
+    process and, if enabled, across processes by an advisory lock."""
+    with dataset_locks.hold(dataset_uri), _advisory_lock(dataset_uri):
+        yield
+
+
+registration_flights = SingleFlight()
+
+register_stats('single_flight', registration_flights.to_dict)
+
+
+# Kinds of objects that affect only a single field of the index entry
+INCREMENTAL_UPDATE_KINDS = ['README.yml', 'tags', 'annotations']
+
+
+@stage('update_metadata')
+@plugin_storage_access()
+def _update_dataset_metadata(dataset_uri, kinds):
+    """Update README, tags or annotations of a registered dataset in place.
+
+    Only the changed components are fetched from the storage, the manifest
+    is never loaded. Returns False if a full registration is required
+    instead, i.e. if other kinds of objects have changed or if the dataset
+    has not been registered yet."""
+    if not Config.INCREMENTAL_UPDATES or len(kinds) == 0:
+        return False
+
+    if not set(kinds).issubset(INCREMENTAL_UPDATE_KINDS):
+        return False
+
+    # a full registration in progress must not overwrite this update with
+    # the components it has read before
+    with _dataset_lock(dataset_uri):
+        return _load_and_update_dataset_metadata(dataset_uri, kinds)
+
+
+def _load_and_update_dataset_metadata(dataset_uri, kinds):
+    dataset = dtoolcore.DataSet.from_uri(dataset_uri)
+
+    update = {}
+    if 'README.yml' in kinds:
+        update['readme'] = yaml.load(
+            dataset.get_readme_content(), Loader=yaml.FullLoader)
+    if 'tags' in kinds:
+        update['tags'] = dataset.list_tags()
+    if 'annotations' in kinds:
+        update['annotations'] = {
+            annotation_name: dataset.get_annotation(annotation_name)
+            for annotation_name in dataset.list_annotation_names()}
+
+    # same serialization of dates as within generate_dataset_info
+    update = json.loads(json.dumps(update, default=_json_serial))
+
+    result = mongo.db[MONGO_COLLECTION].update_one(
+        {"uri": {"$eq": dataset_uri}}, {"$set": update})
+    if result.matched_count == 0:
+        logger.debug("Dataset '%s' not registered yet, incremental update "
+                     "not possible.", dataset_uri)
+        return False
+
+    logger.info("Updated %s of dataset '%s'.", ', '.join(update.keys()), dataset_uri)
+    return True
+
+
+def manifest_signature(dataset):
+    """Return ETag and size of the manifest object of a dataset on S3, or
+    modification time and size on disk, without reading the manifest.
+
+    Returns None if the storage is not supported or the request fails."""
+    storage_broker = dataset._storage_broker
+    try:
+        if isinstance(storage_broker, S3StorageBroker):
+            response = storage_broker.s3client.head_object(
+                Bucket=storage_broker.bucket, Key=storage_broker.get_manifest_key())
+            return '{}:{}'.format(response['ETag'].strip('"'), response['ContentLength'])
+        if isinstance(storage_broker, DiskStorageBroker):
+            st = os.stat(storage_broker.get_manifest_key())
+            return '{}:{}'.format(st.st_mtime_ns, st.st_size)
+    except (OSError, BotoCoreError, ClientError) as exc:
+        logger.warning("Could not determine manifest signature of dataset '%s': %s",
+                       dataset.uri, exc)
+    return None
+
+
+@plugin_storage_access()
+def _load_and_register_dataset(dataset_uri, base_uri, dataset=None):
+    with _dataset_lock(dataset_uri):
+        if dataset is None:
+            with stage('from_uri'):
+                dataset = dtoolcore.DataSet.from_uri(dataset_uri)
+        # the manifest is loaded lazily, within generate_dataset_info
+        with stage('generate_dataset_info'):
+            # taken before reading the manifest, a later change of the
+            # manifest always yields a different signature
+            signature = manifest_signature(dataset)
+            dataset_info = generate_dataset_info(dataset, base_uri)
+            if signature is not None:
+                dataset_info['manifest_signature'] = signature
+        # a deletion collected before would remove the dataset registered now
+        cancel_deletion(base_uri, dataset.uuid)
+        with stage('register_dataset'):
+            register_dataset(dataset_info)
+
+
+def _register_dataset_from_uri(dataset_uri, base_uri, dataset=None):
+    """Read a dataset from the storage and register it in the index.
+
+    A dataset already loaded from dataset_uri may be passed to avoid reading
+    it again. Registrations of a dataset requested while one is in progress
+    wait for it to finish and are then carried out by a single rerun. Raises
+    dtoolcore.DtoolCoreTypeError if the dataset is not complete yet."""
+    registration_flights.run(
+        dataset_uri, _load_and_register_dataset, dataset_uri, base_uri, dataset)
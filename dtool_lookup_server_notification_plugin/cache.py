@@ -0,0 +1,311 @@
+"""Bounded in-process caches."""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache with optional time to live.
+
+    A max_size of 0 disables the cache, a ttl of 0 lets entries live until
+    they are evicted or invalidated.
+    """
+
+    def __init__(self, max_size=1000, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expiry, value)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        """Return cached value or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl > 0 and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """Insert value, evict least recently used entries beyond max_size."""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove entry. Return True if there was one."""
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def to_dict(self):
+        """Return cache statistics."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups > 0 else 0.0,
+            }
+
+
+class SequencerTable(object):
+    """Thread-safe, bounded table of the latest S3 event sequencer per key.
+
+    Sequencers are hexadecimal strings of varying length. As specified by
+    S3, the shorter one is padded with zeros on the right before comparing.
+    The least recently updated keys are evicted beyond max_size, a max_size
+    of 0 accepts all events.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._sequencers = OrderedDict()  # key -> upper case sequencer
+        self.accepted = 0
+        self.discarded = 0
+
+    def __len__(self):
+        return len(self._sequencers)
+
+    @staticmethod
+    def _is_older(sequencer, other):
+        width = max(len(sequencer), len(other))
+        return sequencer.ljust(width, '0') < other.ljust(width, '0')
+
+    def accept(self, key, sequencer):
+        """Record sequencer of an event for key.
+
+        Returns False if an event with a later sequencer has been recorded
+        for key already, True otherwise."""
+        if self.max_size <= 0 or not sequencer:
+            return True
+        sequencer = sequencer.upper()
+        with self._lock:
+            latest = self._sequencers.get(key)
+            if latest is not None and self._is_older(sequencer, latest):
+                self.discarded += 1
+                return False
+            self.accepted += 1
+            self._sequencers[key] = sequencer
+            self._sequencers.move_to_end(key)
+            while len(self._sequencers) > self.max_size:
+                self._sequencers.popitem(last=False)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._sequencers.clear()
+            self.accepted = 0
+            self.discarded = 0
+
+    def to_dict(self):
+        """Return table statistics."""
+        with self._lock:
+            return {
+                'size': len(self._sequencers),
+                'max_size': self.max_size,
+                'accepted': self.accepted,
+                'discarded': self.discarded,
+            }
+
+
+class ContentCache(object):
+    """Thread-safe cache of object contents validated by their ETag.
+
+    Entries are evicted least recently used first once their total size
+    exceeds max_bytes. Evicted entries are spilled to files within
+    directory if given, bounded by max_disk_bytes in the same manner. A
+    max_bytes of 0 disables the cache.
+
+    ETags announced by notifications are remembered per key until the next
+    lookup, a cached entry with the announced ETag is known to be current
+    without asking the storage.
+    """
+
+    def __init__(self, max_bytes=0, directory='', max_disk_bytes=0,
+                 max_announced=10000):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (etag, content, size)
+        self._size = 0
+        self._files = OrderedDict()  # key -> size of spilled entry
+        self._disk_size = 0
+        self._announced = LRUCache(max_size=max_announced)
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def announce(self, key, etag):
+        """Remember the current ETag of key as announced by a notification."""
+        if self.max_bytes > 0 and etag:
+            self._announced.put(key, etag.strip('"'))
+
+    def lookup(self, key):
+        """Return cached (ETag, content, announced) or None.
+
+        announced is True if a notification has announced the cached ETag."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            elif key in self._files:
+                entry = self._load(key)
+        if entry is None:
+            return None
+        announced = self._announced.get(key, count=False)
+        self._announced.invalidate(key)
+        return entry[0], entry[1], announced == entry[0]
+
+    def put(self, key, etag, content):
+        """Insert content of key at ETag, evict entries beyond max_bytes."""
+        if self.max_bytes <= 0 or not etag:
+            return
+        size = len(content.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (etag.strip('"'), content, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._size -= evicted[2]
+                self._spill(evicted_key, evicted)
+
+    def count(self, result):
+        """Count the result of a lookup, 'hit', 'revalidated' or 'miss'."""
+        with self._lock:
+            if result == 'hit':
+                self.hits += 1
+            elif result == 'revalidated':
+                self.revalidated += 1
+            else:
+                self.misses += 1
+
+    def invalidate(self, key):
+        """Remove entry. Return True if there was one."""
+        with self._lock:
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._files):
+                self._remove(key)
+            self._entries.clear()
+            self._size = 0
+            self._announced.clear()
+            self.hits = 0
+            self.revalidated = 0
+            self.misses = 0
+
+    def _path(self, key):
+        name = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def _remove(self, key):
+        removed = False
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
+            removed = True
+        size = self._files.pop(key, None)
+        if size is not None:
+            self._disk_size -= size
+            removed = True
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+        return removed
+
+    def _spill(self, key, entry):
+        if not self.directory or entry[2] > self.max_disk_bytes:
+            return
+        path = self._path(key)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump([entry[0], entry[1]], f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            logger.exception("Could not spill cached content to '%s'.", path)
+            return
+        self._files[key] = entry[2]
+        self._disk_size += entry[2]
+        while self._disk_size > self.max_disk_bytes:
+            self._remove(next(iter(self._files)))
+
+    def _load(self, key):
+        """Move spilled entry of key back into memory."""
+        try:
+            with open(self._path(key)) as f:
+                etag, content = json.load(f)
+        except (OSError, ValueError):
+            logger.exception("Could not load spilled content of %s.", key)
+            self._remove(key)
+            return None
+        self._remove(key)
+        size = len(content.encode('utf-8'))
+        self._entries[key] = (etag, content, size)
+        self._size += size
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self._size -= evicted[2]
+            self._spill(evicted_key, evicted)
+        return self._entries[key]
+
+    def to_dict(self):
+        """Return cache statistics."""
+        with self._lock:
+            lookups = self.hits + self.revalidated + self.misses
+            return {
+                'size': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'spilled': len(self._files),
+                'spilled_bytes': self._disk_size,
+                'hits': self.hits,
+                'revalidated': self.revalidated,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.revalidated) / lookups
+                if lookups > 0 else 0.0,
+            }
@@ -0,0 +1,59 @@
+"""Command line utility functions."""
+import sys
+
+import click
+import dtoolcore.utils
+
+from flask.cli import AppGroup
+
+from dtool_lookup_server.utils import base_uri_exists
+
+from .config import Config
+from .reconcile import reconcile_base_uri
+
+notification_cli = AppGroup('notification', help="Notification plugin commands.")
+
+OUTCOME_COLORS = {
+    'registered': 'green',
+    'updated': 'green',
+    'deleted': 'yellow',
+    'incomplete': None,
+    'failed': 'red',
+}
+
+
+@notification_cli.command(name="reconcile")
+@click.argument('base_uris', nargs=-1)
+@click.option('-w', '--workers', default=4, show_default=True,
+              help="Number of datasets compared in parallel.")
+@click.option('-n', '--dry-run', is_flag=True,
+              help="Only report differences, do not modify the index.")
+def reconcile(base_uris, workers, dry_run):
+    """Register, update or delete index entries of datasets that differ from
+    the storage, i.e. after notifications have been lost.
+
+    Reconciles all base URIs configured for buckets if none are given."""
+    if len(base_uris) == 0:
+        base_uris = sorted(set(Config.BUCKET_TO_BASE_URI.values()))
+
+    base_uris = [dtoolcore.utils.sanitise_uri(base_uri) for base_uri in base_uris]
+    for base_uri in base_uris:
+        if not base_uri_exists(base_uri):
+            click.secho(
+                "Base URI '{}' not registered".format(base_uri),
+                fg="red",
+                err=True
+            )
+            sys.exit(1)
+
+    def echo(uri, outcome):
+        click.secho("{}: {}".format(outcome.capitalize(), uri),
+                    fg=OUTCOME_COLORS[outcome])
+
+    for base_uri in base_uris:
+        click.secho("Reconciling '{}'{}".format(
+            base_uri, " (dry run)" if dry_run else ""), bold=True)
+        counts = reconcile_base_uri(base_uri, num_workers=workers,
+                                    dry_run=dry_run, callback=echo)
+        click.echo(', '.join('{} {}'.format(count, outcome)
+                             for outcome, count in counts.items()))
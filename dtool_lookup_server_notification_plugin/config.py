@@ -1,19 +1,380 @@
+import bisect
 import ipaddress
 import json
 import os
+import re
+import threading
 
-from . import __version__
+from . import __version__, AFFIRMATIVE_EXPRESSIONS
+from .cache import LRUCache
 
-class Config(object):
-    # Dictionary for conversion of bucket names to base URIs
-    BUCKET_TO_BASE_URI = json.loads(
+
+class BucketIndex(dict):
+    """Dictionary of bucket names to base URIs with longest-prefix lookup.
+
+    Bucket names are grouped by length. A lookup probes one candidate prefix
+    per distinct name length, longest first, hence its cost does not depend
+    on the number of buckets.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._index()
+
+    def _index(self):
+        self._lengths = sorted({len(bucket) for bucket in self}, reverse=True)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._index()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._index()
+
+    def clear(self):
+        super().clear()
+        self._index()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._index()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._index()
+        return item
+
+    def setdefault(self, key, default=None):
+        value = super().setdefault(key, default)
+        self._index()
+        return value
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._index()
+
+    def longest_prefix(self, path, separator='_'):
+        """Return the longest bucket name followed by separator in path."""
+        for length in self._lengths:
+            if len(path) > length and path[length] == separator \
+                    and path[:length] in self:
+                return path[:length]
+        return None
+
+
+class IPAllowList(object):
+    """Allow-list of IPv4 and IPv6 networks with fast membership tests.
+
+    The networks are compiled into merged, sorted integer intervals per IP
+    version and looked up by bisection. Recent verdicts are cached per
+    address string.
+    """
+
+    def __init__(self, networks, cache_size=4096):
+        if isinstance(networks, (str, ipaddress.IPv4Network, ipaddress.IPv6Network)):
+            networks = [networks]
+        self.networks = [ipaddress.ip_network(n) for n in networks]
+
+        self._intervals = {4: ([], []), 6: ([], [])}  # version -> (starts, ends)
+        for version in self._intervals:
+            intervals = sorted(
+                (int(n.network_address), int(n.broadcast_address))
+                for n in self.networks if n.version == version)
+            starts, ends = self._intervals[version]
+            for start, end in intervals:
+                if len(ends) > 0 and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+
+        self._verdicts = LRUCache(max_size=cache_size)
+
+    @classmethod
+    def from_string(cls, s):
+        """Parse a JSON list or a comma- or whitespace-separated list."""
+        s = s.strip()
+        if s.startswith('['):
+            return cls(json.loads(s))
+        return cls([n for n in re.split(r'[,\s]+', s) if len(n) > 0])
+
+    def _contains(self, address):
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        starts, ends = self._intervals[ip.version]
+        i = bisect.bisect_right(starts, int(ip)) - 1
+        return i >= 0 and int(ip) <= ends[i]
+
+    def __contains__(self, address):
+        verdict = self._verdicts.get(address)
+        if verdict is None:
+            verdict = self._contains(address)
+            self._verdicts.put(address, verdict)
+        return verdict
+
+    def __str__(self):
+        return ','.join(str(n) for n in self.networks)
+
+
+def _bucket_index_from_env():
+    return BucketIndex(json.loads(
         os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_BUCKET_TO_BASE_URI',
-                       '{"bucket": "s3://bucket"}'))
+                       '{"bucket": "s3://bucket"}')))
+
 
-    # Limit notification access to IPs starting with this string
-    ALLOW_ACCESS_FROM = ipaddress.ip_network(
+def _allow_list_from_env():
+    return IPAllowList.from_string(
         os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_ALLOW_ACCESS_FROM',
-                       '0.0.0.0/0'))  # Default is access from any IP
+                       '0.0.0.0/0'))  # Default is access from any IPv4
+
+
+class Config(object):
+    # Dictionary for conversion of bucket names to base URIs
+    BUCKET_TO_BASE_URI = _bucket_index_from_env()
+
+    # Limit notification access to IPs within these networks, either a JSON
+    # list or a comma-separated list
+    ALLOW_ACCESS_FROM = _allow_list_from_env()
+
+    # Path of a JSON file with the keys "bucket_to_base_uri" and
+    # "allow_access_from" overriding the two settings above. The file is read
+    # at startup and again on reload, empty disables the file
+    CONFIG_FILE = os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_CONFIG_FILE', '')
+
+    # Seconds between checks of CONFIG_FILE for modifications that trigger a
+    # reload, 0 reloads only on SIGHUP or POST to /webhook/config/reload
+    CONFIG_RELOAD_INTERVAL = float(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_CONFIG_RELOAD_INTERVAL', 0))
+
+    # Acknowledge webhook notifications immediately and process them in the
+    # background
+    ASYNC_PROCESSING = os.environ.get(
+        'DTOOL_LOOKUP_SERVER_NOTIFY_ASYNC_PROCESSING',
+        'False').lower() in AFFIRMATIVE_EXPRESSIONS
+
+    # Number of background worker threads for asynchronous processing
+    WORKER_POOL_SIZE = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_WORKER_POOL_SIZE', 4))
+
+    # Maximum number of notifications waiting for asynchronous processing
+    QUEUE_SIZE = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_QUEUE_SIZE', 1000))
+
+    # Quiet period in seconds after the last object creation within a dataset
+    # before the dataset is registered, 0 registers immediately
+    DEBOUNCE_PERIOD = float(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_DEBOUNCE_PERIOD', 0))
+
+    # Period in seconds over which removed datasets are collected and deleted
+    # at once, 0 deletes immediately
+    DELETION_BATCH_PERIOD = float(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_DELETION_BATCH_PERIOD', 0))
+
+    # Delete collected datasets before the end of the period once their
+    # number reaches this size
+    DELETION_BATCH_SIZE = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_DELETION_BATCH_SIZE', 1000))
+
+    # Maximum number of object keys the latest S3 event sequencer is kept for
+    # to ignore events arriving out of order, 0 disables
+    SEQUENCER_TABLE_SIZE = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_SEQUENCER_TABLE_SIZE', 10000))
+
+    # Maximum number of received records remembered by request id, bucket,
+    # object key and eTag to ignore redelivered notifications, 0 disables
+    DEDUP_CACHE_SIZE = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_DEDUP_CACHE_SIZE', 0))
+
+    # Time in seconds received records are remembered for
+    DEDUP_CACHE_TTL = float(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_DEDUP_CACHE_TTL', 600))
+
+    # Update only README, tags or annotations of registered datasets if
+    # only these have changed instead of registering the whole dataset again
+    INCREMENTAL_UPDATES = os.environ.get(
+        'DTOOL_LOOKUP_SERVER_NOTIFY_INCREMENTAL_UPDATES',
+        'True').lower() in AFFIRMATIVE_EXPRESSIONS
+
+    # Maximum number of dataset URIs cached for (base URI, UUID), 0 disables
+    URI_CACHE_SIZE = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_URI_CACHE_SIZE', 10000))
+
+    # Time to live of cached dataset URIs in seconds, 0 never expires
+    URI_CACHE_TTL = float(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_URI_CACHE_TTL', 300))
+
+    # Log format of the plugin, 'text' or 'json' for one-line JSON records
+    LOG_FORMAT = os.environ.get(
+        'DTOOL_LOOKUP_SERVER_NOTIFY_LOG_FORMAT', 'text').lower()
+
+    # Truncate payloads logged at debug level beyond this number of
+    # characters, 0 logs payloads in full
+    LOG_MAX_LENGTH = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_LOG_MAX_LENGTH', 10000))
+
+    # Classification of objects by the kind inferred from their key. Creation
+    # of 'finalizing' or 'metadata' objects triggers registration of the
+    # dataset, creation of 'payload' objects is ignored. Unlisted kinds are
+    # treated as 'finalizing'.
+    OBJECT_KEY_CLASSES = json.loads(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_OBJECT_KEY_CLASSES',
+                       '{"dtool": "finalizing", '
+                       '"manifest.json": "finalizing", '
+                       '"__REGISTRATION_KEY__": "finalizing", '
+                       '"README.yml": "metadata", '
+                       '"tags": "metadata", '
+                       '"annotations": "metadata", '
+                       '"data": "payload", '
+                       '"overlays": "payload", '
+                       '"fragments": "payload", '
+                       '"structure.json": "payload", '
+                       '"README.txt": "payload"}'))
+
+    # Number of retries to register a dataset that is not complete yet, the
+    # delay starts at RETRY_BASE_DELAY seconds and doubles with every retry
+    # up to RETRY_MAX_DELAY seconds, 0 disables retries
+    RETRY_MAX_ATTEMPTS = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_RETRY_MAX_ATTEMPTS', 5))
+
+    RETRY_BASE_DELAY = float(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_RETRY_BASE_DELAY', 10))
+
+    RETRY_MAX_DELAY = float(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_RETRY_MAX_DELAY', 600))
+
+    # Maximum number of datasets kept on the list of given up retries
+    DEAD_LETTER_SIZE = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_DEAD_LETTER_SIZE', 1000))
+
+    # Path of an SQLite database journaling accepted notification events
+    # until they have been processed, empty disables the journal
+    JOURNAL_PATH = os.environ.get(
+        'DTOOL_LOOKUP_SERVER_NOTIFY_JOURNAL_PATH', '')
+
+    # Journaled events are discarded after failing this many replays
+    JOURNAL_MAX_ATTEMPTS = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_JOURNAL_MAX_ATTEMPTS', 3))
+
+    # Seconds between reconciling slices of the configured base URIs with
+    # the storage in the background, 0 disables periodic reconciliation
+    RECONCILIATION_INTERVAL = float(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_RECONCILIATION_INTERVAL', 0))
+
+    # Number of datasets reconciled per slice
+    RECONCILIATION_SLICE_SIZE = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_RECONCILIATION_SLICE_SIZE', 100))
+
+    # Maximum number of datasets reconciled per second, 0 means no limit
+    RECONCILIATION_RATE = float(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_RECONCILIATION_RATE', 1))
+
+    # Path of a JSON file keeping the position of the periodic reconciliation
+    # within every base URI across restarts, empty keeps it in memory only
+    RECONCILIATION_CURSOR_PATH = os.environ.get(
+        'DTOOL_LOOKUP_SERVER_NOTIFY_RECONCILIATION_CURSOR_PATH', '')
+
+    # Sample the call stacks of one in every PROFILE_SAMPLE_RATE notification
+    # requests every PROFILE_INTERVAL seconds, 0 disables profiling
+    PROFILE_SAMPLE_RATE = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_PROFILE_SAMPLE_RATE', 0))
+
+    PROFILE_INTERVAL = float(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_PROFILE_INTERVAL', 0.001))
+
+    # Directory to write sampled call stacks to, empty keeps them in memory
+    PROFILE_DIR = os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_PROFILE_DIR', '')
+
+    # Maximum size in bytes of manifests, READMEs and annotations cached in
+    # memory by S3 object key and ETag, 0 disables the cache
+    CONTENT_CACHE_SIZE = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_CONTENT_CACHE_SIZE', 0))
+
+    # Directory to spill entries evicted from memory to, up to
+    # CONTENT_CACHE_DISK_SIZE bytes, empty disables spilling
+    CONTENT_CACHE_DIR = os.environ.get(
+        'DTOOL_LOOKUP_SERVER_NOTIFY_CONTENT_CACHE_DIR', '')
+
+    CONTENT_CACHE_DISK_SIZE = int(
+        os.environ.get('DTOOL_LOOKUP_SERVER_NOTIFY_CONTENT_CACHE_DISK_SIZE', 1024**3))
+
+    # Register datasets notified via the elastic search routes provisionally
+    # from the admin metadata of the notification, with empty README and
+    # manifest, and read them from the storage in the background
+    PROVISIONAL_REGISTRATION = os.environ.get(
+        'DTOOL_LOOKUP_SERVER_NOTIFY_PROVISIONAL_REGISTRATION',
+        'False').lower() in AFFIRMATIVE_EXPRESSIONS
+
+    # Serialize registrations of the same dataset by several server processes
+    # with an advisory lock of the SQL database, PostgreSQL and MySQL only
+    REGISTRATION_ADVISORY_LOCK = os.environ.get(
+        'DTOOL_LOOKUP_SERVER_NOTIFY_REGISTRATION_ADVISORY_LOCK',
+        'False').lower() in AFFIRMATIVE_EXPRESSIONS
+
+    # Reuse S3 sessions and clients of storage brokers within every thread
+    S3_CLIENT_POOLING = os.environ.get(
+        'DTOOL_LOOKUP_SERVER_NOTIFY_S3_CLIENT_POOLING',
+        'True').lower() in AFFIRMATIVE_EXPRESSIONS
+
+    @classmethod
+    def bucket_index(cls):
+        """Return BUCKET_TO_BASE_URI as BucketIndex."""
+        buckets = cls.BUCKET_TO_BASE_URI  # read once, a reload may swap it
+        if not isinstance(buckets, BucketIndex):
+            # a plain dictionary has been assigned at runtime
+            buckets = cls.BUCKET_TO_BASE_URI = BucketIndex(buckets)
+        return buckets
+
+    @classmethod
+    def allow_list(cls):
+        """Return ALLOW_ACCESS_FROM as IPAllowList."""
+        allow_list = cls.ALLOW_ACCESS_FROM  # read once, a reload may swap it
+        if not isinstance(allow_list, IPAllowList):
+            # a network or list of networks has been assigned at runtime
+            allow_list = cls.ALLOW_ACCESS_FROM = IPAllowList(allow_list)
+        return allow_list
+
+    _reload_lock = threading.Lock()
+
+    @classmethod
+    def reload(cls, path=None):
+        """Rebuild BUCKET_TO_BASE_URI and ALLOW_ACCESS_FROM from the
+        environment and the configuration file and swap them in.
+
+        Both structures are built completely before they replace the current
+        ones by a single assignment each, hence concurrent lookups see either
+        the old or the new structure. Raises OSError or ValueError and keeps
+        the current configuration if the file is invalid."""
+        if path is None:
+            path = cls.CONFIG_FILE
+        with cls._reload_lock:
+            bucket_index = _bucket_index_from_env()
+            allow_list = _allow_list_from_env()
+            if path:
+                with open(path) as f:
+                    overrides = json.load(f)
+                if not isinstance(overrides, dict):
+                    raise ValueError("'{}' does not contain a JSON object.".format(path))
+
+                if 'bucket_to_base_uri' in overrides:
+                    if not isinstance(overrides['bucket_to_base_uri'], dict):
+                        raise ValueError("'bucket_to_base_uri' in '{}' is not "
+                                         "a JSON object.".format(path))
+                    bucket_index = BucketIndex(overrides['bucket_to_base_uri'])
+
+                if 'allow_access_from' in overrides:
+                    if isinstance(overrides['allow_access_from'], str):
+                        allow_list = IPAllowList.from_string(overrides['allow_access_from'])
+                    else:
+                        allow_list = IPAllowList(overrides['allow_access_from'])
+
+            cls.BUCKET_TO_BASE_URI = bucket_index
+            cls.ALLOW_ACCESS_FROM = allow_list
 
     @classmethod
     def to_dict(cls):
@@ -23,7 +384,12 @@ class Config(object):
             # select only capitalized fields
             if k.upper() == k:
                 if isinstance(v, ipaddress.IPv4Network) or \
-                        isinstance(v, ipaddress.IPv6Network):
+                        isinstance(v, ipaddress.IPv6Network) or \
+                        isinstance(v, IPAllowList):
                     v = str(v)
                 d[k.lower()] = v
-        return d
\ No newline at end of file
+        return d
+
+
+if Config.CONFIG_FILE:
+    Config.reload()
@@ -1,9 +1,15 @@
 import json
+import logging
 import os
+import queue
+import time
+
+from collections import OrderedDict
 
 import dtoolcore
 
-from dtool_lookup_server import AuthenticationError
+from dtool_lookup_server import AuthenticationError, ValidationError
+from dtool_lookup_server.utils import register_dataset
 from flask import (
     abort,
     Blueprint,
@@ -16,33 +22,141 @@ from flask_jwt_extended import (
     jwt_required,
 )
 
-from dtool_lookup_server.utils import (
-    generate_dataset_info,
-    register_dataset,
-)
 
 from .config import Config
 from . import (
-    delete_dataset,
+    admin_required,
+    cancel_deletion,
+    _dataset_lock,
     filter_ips,
     _parse_objpath,
-    _retrieve_uri
+    _register_dataset_from_uri,
+    _retrieve_uri,
+    _retrieve_uris,
+    _update_dataset_metadata,
+    schedule_deletion,
+)
+from .metrics import (
+    CONTENT_TYPE,
+    events_total,
+    metrics,
+    request_duration_seconds,
 )
+from .profile import profiled, profiler
+from .reload import reload_config_response
+from .retry import cancel_retry, schedule_retry
+from .stats import Counters, collect_stats, register_stats
+from .worker import get_ingestion_queue
+
+logger = logging.getLogger(__name__)
+
+# admin metadata required to register a dataset provisionally
+PROVISIONAL_REGISTRATION_KEYS = ['uuid', 'name', 'type', 'creator_username', 'frozen_at']
+
+# actions of the elastic search bulk API and whether a source line follows
+BULK_ACTIONS = {'index': True, 'create': True, 'update': True, 'delete': False}
+
+provisional_counters = Counters('registered', 'completed')
+
+register_stats('provisional_registration', provisional_counters.to_dict)
 
 
 elastic_search_bp = Blueprint("elastic-search", __name__, url_prefix="/elastic-search")
 
 
+def _register_provisionally(admin_metadata, dataset_uri, base_uri):
+    """Register a dataset not registered yet from the admin metadata of a
+    notification alone, with an empty README and manifest. The dataset is
+    then read from the storage and registered completely, in the background
+    if processing asynchronously.
+
+    Returns False if provisional registration is disabled, the dataset has
+    been registered already or the admin metadata is not complete."""
+    if not Config.PROVISIONAL_REGISTRATION:
+        return False
+    if any(key not in admin_metadata for key in PROVISIONAL_REGISTRATION_KEYS) \
+            or admin_metadata['type'] != 'dataset':
+        return False
+
+    uuid = admin_metadata['uuid']
+    # serialized with full registrations of the same dataset, which must
+    # not be replaced by the provisional entry
+    with _dataset_lock(dataset_uri):
+        if _retrieve_uri(base_uri, uuid) is not None:
+            return False
+        # a deletion collected before would remove the dataset registered now
+        cancel_deletion(base_uri, uuid)
+        register_dataset(dict(
+            admin_metadata, uri=dataset_uri, base_uri=base_uri, readme={},
+            manifest={'items': {}}, annotations={}, tags=[], provisional=True))
+    provisional_counters.increment('registered')
+    logger.info("Registered dataset '%s' provisionally.", dataset_uri)
+
+    if Config.ASYNC_PROCESSING:
+        try:
+            get_ingestion_queue().put(_complete_registration, dataset_uri, base_uri)
+            return True
+        except (queue.Full, RuntimeError):
+            logger.warning("Ingestion queue not available, completing registration "
+                           "of dataset '%s' immediately.", dataset_uri)
+    _complete_registration(dataset_uri, base_uri)
+    return True
+
+
+def _complete_registration(dataset_uri, base_uri):
+    """Replace a provisional index entry by the complete dataset."""
+    try:
+        _register_dataset_from_uri(dataset_uri, base_uri)
+    except dtoolcore.DtoolCoreTypeError as exc:
+        schedule_retry(dataset_uri, base_uri, error=str(exc))
+        return
+    cancel_retry(dataset_uri)
+    provisional_counters.increment('completed')
+
+
+def _register(dataset_uri, base_uri, kinds, admin_metadata=None):
+    """Register a dataset, or update the given kinds of objects only.
+
+    kinds contains None if the dataset has been finalized."""
+    try:
+        if None in kinds and admin_metadata is not None and \
+                _register_provisionally(admin_metadata, dataset_uri, base_uri):
+            return
+        if None in kinds or not _update_dataset_metadata(dataset_uri, list(kinds)):
+            _register_dataset_from_uri(dataset_uri, base_uri)
+        cancel_retry(dataset_uri)
+    except dtoolcore.DtoolCoreTypeError as exc:
+        # DtoolCoreTypeError is raised if this is not a dataset yet, i.e.
+        # if the dataset has only partially been copied. There should be
+        # another notification once everything is final, but
+        # notifications may arrive out of order. Retry later.
+        current_app.logger.debug('DtoolCoreTypeError raised for dataset '
+                                 'with URI %s', dataset_uri)
+        schedule_retry(dataset_uri, base_uri, error=str(exc))
+
+
+def _count_event(event_name, objpath):
+    # only configured bucket names, a label per requested path would add a
+    # time series each
+    bucket_name = Config.bucket_index().longest_prefix(objpath) or 'unknown'
+    events_total.inc('elastic-search', event_name, bucket_name)
+
+
 @elastic_search_bp.route("/notify/all/<path:objpath>", methods=["POST"])
 @filter_ips
+@request_duration_seconds.time('elastic-search')
+@profiled('elastic-search')
 def notify_create_or_update(objpath):
     """Notify the lookup server about creation of a new object or modification
     of an object's metadata."""
+    _count_event('create_or_update', objpath)
     json = request.get_json()
     if json is None:
         abort(400)
 
     dataset_uri = None
+    kind = None
+    admin_metadata = None
 
     # The metadata is only attached to the 'dtool' object of the respective
     # UUID and finalizes creation of a dataset. We can register that dataset
@@ -53,12 +167,12 @@ def notify_create_or_update(objpath):
         if 'name' in admin_metadata and 'uuid' in admin_metadata:
             bucket = json['bucket']
 
-            base_uri = Config.BUCKET_TO_BASE_URI[bucket]
+            base_uri = Config.bucket_index()[bucket]
 
             dataset_uri = dtoolcore._generate_uri(admin_metadata, base_uri)
 
-            current_app.logger.info('Registering dataset with URI {}'
-                                    .format(dataset_uri))
+            current_app.logger.info('Registering dataset with URI %s',
+                                    dataset_uri)
     else:
         base_uri, uuid, kind = _parse_objpath(objpath)
         # We also need to update the database if the metadata has changed.
@@ -66,26 +180,18 @@ def notify_create_or_update(objpath):
             dataset_uri = _retrieve_uri(base_uri, uuid)
 
     if dataset_uri is not None:
-        try:
-            dataset = dtoolcore.DataSet.from_uri(dataset_uri)
-            dataset_info = generate_dataset_info(dataset, base_uri)
-            register_dataset(dataset_info)
-        except dtoolcore.DtoolCoreTypeError:
-            # DtoolCoreTypeError is raised if this is not a dataset yet, i.e.
-            # if the dataset has only partially been copied. There will be
-            # another notification once everything is final. We simply
-            # ignore this.
-            current_app.logger.debug('DtoolCoreTypeError raised for dataset '
-                                     'with URI {}'.format(dataset_uri))
-            pass
+        _register(dataset_uri, base_uri, [kind], admin_metadata)
 
     return jsonify({})
 
 
 @elastic_search_bp.route("/notify/all/<path:objpath>", methods=["DELETE"])
 @filter_ips
+@request_duration_seconds.time('elastic-search')
+@profiled('elastic-search')
 def notify_delete(objpath):
     """Notify the lookup server about deletion of an object."""
+    _count_event('delete', objpath)
     # The only information that we get is the URL. We need to convert the URL
     # into the respective UUID of the dataset.
     url = request.url
@@ -94,11 +200,216 @@ def notify_delete(objpath):
     if url.endswith('/dtool'):
         base_uri, uuid, kind = _parse_objpath(objpath)
         assert kind == 'dtool'
-        delete_dataset(base_uri, uuid)
+        # datasets never indexed have nothing to delete
+        schedule_deletion(_retrieve_uris([(base_uri, uuid)]))
 
     return jsonify({})
 
 
+def _iter_ndjson(stream):
+    """Yield JSON documents from a stream of newline-delimited JSON.
+
+    The stream is read line by line. Raises ValueError on malformed lines."""
+    for line in stream:
+        line = line.strip()
+        if len(line) > 0:
+            yield json.loads(line)
+
+
+def _bulk_error(item, status, error_type, reason):
+    item.update(status=status, error={'type': error_type, 'reason': reason})
+    item.pop('result', None)
+
+
+def _retrieve_bulk_uris(datasets):
+    """Retrieve URIs of (base URI, UUID) tuples with a single index lookup.
+
+    Returns the URIs of all registered datasets and the error of every
+    base URI that is not registered. Only if there is any, the URIs are
+    retrieved once per base URI to tell the failing ones apart."""
+    try:
+        return _retrieve_uris(datasets), {}
+    except ValidationError:
+        pass
+
+    uris = {}
+    errors = {}
+    datasets_by_base_uri = OrderedDict()
+    for base_uri, uuid in datasets:
+        datasets_by_base_uri.setdefault(base_uri, []).append((base_uri, uuid))
+    for base_uri, base_uri_datasets in datasets_by_base_uri.items():
+        try:
+            uris.update(_retrieve_uris(base_uri_datasets))
+        except ValidationError as exc:
+            errors[base_uri] = str(exc)
+    return uris, errors
+
+
+@elastic_search_bp.route("/_bulk", methods=["POST", "PUT"])
+@elastic_search_bp.route("/<index>/_bulk", methods=["POST", "PUT"])
+@filter_ips
+@request_duration_seconds.time('elastic-search-bulk')
+@profiled('elastic-search')
+def bulk(index=None):
+    """Notify the lookup server about many objects at once via the elastic
+    search bulk API.
+
+    The body is read line by line. All objects of a dataset collapse into a
+    single registration or deletion, according to the last action on its
+    objects. Dataset URIs are resolved with a single index lookup. The
+    response lists the result of every action in order, actions that cannot
+    be processed fail on their own."""
+    start = time.perf_counter()
+    items = []
+    # (base URI, UUID) -> last action on the dataset, i.e. 'register' or
+    # 'delete', and the state collected for it
+    actions = OrderedDict()
+    # resolve all buckets of the request in one snapshot of the mapping
+    buckets = Config.bucket_index()
+
+    def supersede(key, action):
+        """Return the state of the action on a dataset, an action of another
+        kind before is dropped."""
+        state = actions.get(key)
+        if state is not None and state['action'] != action:
+            for other_item in state['items']:
+                other_item['result'] = 'noop'
+            state = None
+        if state is None:
+            state = actions[key] = {'action': action, 'items': [], 'kinds': set(),
+                                    'dataset_uri': None, 'admin_metadata': None}
+        return state
+
+    try:
+        documents = _iter_ndjson(request.stream)
+        for document in documents:
+            if not isinstance(document, dict) or len(document) != 1 or \
+                    next(iter(document)) not in BULK_ACTIONS:
+                abort(400)
+            action, metadata = next(iter(document.items()))
+            if not isinstance(metadata, dict):
+                abort(400)
+            source = next(documents, None) if BULK_ACTIONS[action] else None
+            if action == 'update' and isinstance(source, dict):
+                source = source.get('doc')
+
+            objpath = str(metadata.get('_id', ''))
+            item = {
+                '_index': metadata.get('_index', index),
+                '_type': metadata.get('_type', '_doc'),
+                '_id': objpath,
+                'status': 200,
+                'result': 'noop',
+            }
+            items.append({action: item})
+
+            if action == 'delete':
+                _count_event('delete', objpath)
+                base_uri, uuid, _ = _parse_objpath(objpath)
+                if base_uri is None:
+                    _bulk_error(item, 400, 'illegal_argument_exception',
+                                "No base URI configured for '{}'.".format(objpath))
+                    continue
+                if not objpath.endswith('/dtool'):
+                    continue
+                # a later deletion supersedes an earlier registration
+                supersede((base_uri, uuid), 'delete')['items'].append(item)
+                continue
+
+            _count_event('create_or_update', objpath)
+            if not isinstance(source, dict):
+                _bulk_error(item, 400, 'parse_exception',
+                            "Missing document of '{}'.".format(objpath))
+                continue
+
+            kind = None
+            dataset_uri = None
+            admin_metadata = None
+            if 'metadata' in source:
+                admin_metadata = source['metadata']
+                if 'name' not in admin_metadata or 'uuid' not in admin_metadata:
+                    continue
+                base_uri = buckets.get(source.get('bucket'))
+                if base_uri is None:
+                    _bulk_error(item, 400, 'illegal_argument_exception',
+                                "No base URI configured for bucket '{}'."
+                                .format(source.get('bucket')))
+                    continue
+                uuid = admin_metadata['uuid']
+                dataset_uri = dtoolcore._generate_uri(admin_metadata, base_uri)
+            else:
+                base_uri, uuid, kind = _parse_objpath(objpath)
+                if base_uri is None:
+                    _bulk_error(item, 400, 'illegal_argument_exception',
+                                "No base URI configured for '{}'.".format(objpath))
+                    continue
+                if kind not in ['README.yml', 'tags', 'annotations']:
+                    continue
+
+            # a later registration supersedes an earlier deletion
+            state = supersede((base_uri, uuid), 'register')
+            state['kinds'].add(kind)
+            state['items'].append(item)
+            if dataset_uri is not None:
+                state['dataset_uri'] = dataset_uri
+                state['admin_metadata'] = admin_metadata
+    except ValueError as exc:
+        logger.warning("Malformed bulk request: %s", exc)
+        abort(400)
+
+    # datasets not finalized within this request must have been registered before
+    uris, errors = _retrieve_bulk_uris(
+        [key for key, state in actions.items()
+         if state['action'] == 'delete' or state['dataset_uri'] is None])
+
+    deletions = OrderedDict()
+    for (base_uri, uuid), state in actions.items():
+        if base_uri in errors and (state['action'] == 'delete' or
+                                   state['dataset_uri'] is None):
+            for item in state['items']:
+                _bulk_error(item, 400, 'illegal_argument_exception', errors[base_uri])
+            continue
+
+        if state['action'] == 'delete':
+            deletions[(base_uri, uuid)] = state['items']
+            continue
+
+        dataset_uri = state['dataset_uri'] or uris.get((base_uri, uuid))
+        if dataset_uri is None:
+            continue
+        for item in state['items']:
+            item['result'] = 'updated'
+        try:
+            _register(dataset_uri, base_uri, state['kinds'], state['admin_metadata'])
+        except Exception as exc:
+            logger.exception("Registration of dataset '%s' failed.", dataset_uri)
+            for item in state['items']:
+                _bulk_error(item, 500, type(exc).__name__, str(exc))
+
+    if len(deletions) > 0:
+        deleted = {key: uris[key] for key in deletions.keys() if key in uris}
+        try:
+            schedule_deletion(deleted)
+        except Exception as exc:
+            logger.exception("Deletion of %d datasets failed.", len(deleted))
+            for dataset_items in deletions.values():
+                for item in dataset_items:
+                    _bulk_error(item, 500, type(exc).__name__, str(exc))
+        else:
+            for key, dataset_items in deletions.items():
+                for item in dataset_items:
+                    if key in deleted:
+                        item['result'] = 'deleted'
+                    else:
+                        item.update(status=404, result='not_found')
+
+    return jsonify({
+        'took': int(1000 * (time.perf_counter() - start)),
+        'errors': any('error' in item for result in items for item in result.values()),
+        'items': items,
+    })
+
+
 @elastic_search_bp.route("/_cluster/health", methods=["GET"])
 def health():
     """This route is used by the S3 storage to test whether the URI exists."""
@@ -113,4 +424,36 @@ def plugin_config():
         config = Config.to_dict()
     except AuthenticationError:
         abort(401)
-    return jsonify(config)
\ No newline at end of file
+    return jsonify(config)
+
+
+@elastic_search_bp.route("/config/reload", methods=["POST"])
+@jwt_required()
+@admin_required
+def plugin_config_reload():
+    """Reload bucket to base URI mapping and IP allow-list, admins only."""
+    return reload_config_response()
+
+
+@elastic_search_bp.route("/stats", methods=["GET"])
+@jwt_required()
+@admin_required
+def plugin_stats():
+    """Return runtime statistics of the elastic search plugin, admins only."""
+    return jsonify(collect_stats())
+
+
+@elastic_search_bp.route("/metrics", methods=["GET"])
+@filter_ips
+def plugin_metrics():
+    """Return metrics of the elastic search plugin in Prometheus text format."""
+    return metrics.collect(), 200, {'Content-Type': CONTENT_TYPE}
+
+
+@elastic_search_bp.route("/profile", methods=["GET"])
+@jwt_required()
+@admin_required
+def plugin_profile():
+    """Return sampled call stacks of the elastic search plugin in collapsed format."""
+    return profiler.collapsed(request.args.get('name')), 200, \
+        {'Content-Type': 'text/plain; charset=utf-8'}
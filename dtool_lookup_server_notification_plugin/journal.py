@@ -0,0 +1,290 @@
+"""Durable journal of accepted notification events."""
+import fcntl
+import glob
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from .config import Config
+from .stats import Counters, register_stats
+from .worker import _get_extension
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_EXTENSION_NAME = 'dtool_lookup_server_notification_plugin_journal'
+
+journal_counters = Counters('appended', 'acknowledged', 'replayed', 'discarded')
+register_stats('journal', journal_counters.to_dict)
+
+
+class _Operation(object):
+    """Journal operation waiting for the next group commit."""
+
+    def __init__(self, kind, payload):
+        self.kind = kind  # 'append', 'acknowledge' or 'attempt'
+        self.payload = payload
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class EventJournal(object):
+    """Journal of notification events in an SQLite database in WAL mode.
+
+    Events are appended before processing and acknowledged, i.e. removed,
+    after processing. Events never acknowledged, i.e. due to a crash or an
+    exception during processing, are replayed at startup. Concurrent
+    operations from several threads are collected while a commit is in
+    progress and committed as a group within a single transaction by one of
+    the waiting threads.
+
+    A journal is owned by a single process, which holds an exclusive lock of
+    the file as long as the journal is open. Opening a journal owned by
+    another running process raises BlockingIOError.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # released by the operating system if the process dies
+        self._lock_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self._lock_fd)
+            raise
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=FULL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS events ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'received_at REAL NOT NULL, '
+            'event_name TEXT, '
+            'event_data TEXT NOT NULL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, '
+            'event_key TEXT)')
+        columns = [row[1] for row in self._connection.execute(
+            'PRAGMA table_info(events)')]
+        if 'event_key' not in columns:  # journal of an earlier version
+            self._connection.execute('ALTER TABLE events ADD COLUMN event_key TEXT')
+
+        self._connection_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._pending = []
+        self._committing = False
+
+    def append(self, events, keys=None):
+        """Durably record (event name, event data) tuples, return their ids.
+
+        keys identify the events, i.e. to recognize a redelivered event.
+        None does not identify any event."""
+        events = list(events)
+        if keys is None:
+            keys = [None] * len(events)
+        ids = self._submit('append', list(zip(events, keys)))
+        journal_counters.increment('appended', len(ids))
+        return ids
+
+    def acknowledge(self, ids):
+        """Remove processed events from the journal, together with all events
+        of the same key appended before, i.e. deliveries that failed."""
+        ids = list(ids)
+        self._submit('acknowledge', ids)
+        journal_counters.increment('acknowledged', len(ids))
+
+    def unfinished(self):
+        """Return list of (id, attempts, event name, event data) of all events
+        not acknowledged yet, in order of arrival."""
+        with self._connection_lock:
+            rows = self._connection.execute(
+                'SELECT id, attempts, event_name, event_data FROM events '
+                'ORDER BY id').fetchall()
+        return [(id, attempts, event_name, json.loads(event_data))
+                for id, attempts, event_name, event_data in rows]
+
+    def count_attempt(self, ids):
+        """Increase the number of processing attempts of events."""
+        return self._submit('attempt', list(ids))
+
+    def __len__(self):
+        with self._connection_lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM events').fetchone()[0]
+
+    def close(self):
+        with self._connection_lock:
+            self._connection.close()
+        os.close(self._lock_fd)
+
+    def remove(self):
+        """Close and delete the journal."""
+        with self._connection_lock:
+            self._connection.close()
+            # delete before releasing the lock, nobody may reopen it
+            for path in [self.path, self.path + '-wal', self.path + '-shm']:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        os.close(self._lock_fd)
+
+    def _submit(self, kind, payload):
+        operation = _Operation(kind, payload)
+        with self._condition:
+            self._pending.append(operation)
+            while not operation.done:
+                if self._committing:
+                    self._condition.wait()
+                    continue
+                # lead the next group commit
+                self._committing = True
+                group, self._pending = self._pending, []
+                # operations submitted during the commit join the next group
+                self._condition.release()
+                try:
+                    self._commit(group)
+                finally:
+                    self._condition.acquire()
+                    for op in group:
+                        op.done = True
+                    self._committing = False
+                    self._condition.notify_all()
+        if operation.error is not None:
+            raise operation.error
+        return operation.result
+
+    def _commit(self, group):
+        """Execute a group of operations within a single transaction."""
+        with self._connection_lock:
+            self._execute(group)
+
+    def _execute(self, group):
+        cursor = self._connection.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for operation in group:
+                if operation.kind == 'append':
+                    ids = []
+                    received_at = time.time()
+                    for (event_name, event_data), event_key in operation.payload:
+                        cursor.execute(
+                            'INSERT INTO events (received_at, event_name, event_data, '
+                            'event_key) VALUES (?, ?, ?, ?)',
+                            (received_at, event_name, json.dumps(event_data), event_key))
+                        ids.append(cursor.lastrowid)
+                    operation.result = ids
+                elif operation.kind == 'acknowledge':
+                    cursor.executemany(
+                        'DELETE FROM events WHERE event_key IN '
+                        '(SELECT event_key FROM events WHERE id = ?) AND id < ?',
+                        [(id, id) for id in operation.payload])
+                    cursor.executemany('DELETE FROM events WHERE id = ?',
+                                       [(id,) for id in operation.payload])
+                elif operation.kind == 'attempt':
+                    cursor.executemany(
+                        'UPDATE events SET attempts = attempts + 1 WHERE id = ?',
+                        [(id,) for id in operation.payload])
+            cursor.execute('COMMIT')
+        except Exception as exc:
+            logger.exception("Failed to commit %d journal operations.", len(group))
+            if self._connection.in_transaction:
+                cursor.execute('ROLLBACK')
+            for operation in group:
+                operation.error = exc
+        finally:
+            cursor.close()
+
+
+def _process_journal_path():
+    return '{}.{}.{}'.format(Config.JOURNAL_PATH, os.getpid(), secrets.token_hex(4))
+
+
+def get_journal():
+    """Return the event journal of the current process or None if disabled.
+
+    Every process journals to a file of its own next to Config.JOURNAL_PATH."""
+    if not Config.JOURNAL_PATH:
+        return None
+    # The connection is left open at interpreter shutdown for the ingestion
+    # queue to acknowledge the events processed while draining.
+    return _get_extension(
+        JOURNAL_EXTENSION_NAME,
+        lambda app: EventJournal(_process_journal_path()),
+        lambda journal: None)
+
+
+def abandoned_journal_paths():
+    """Return paths of all journals next to Config.JOURNAL_PATH, including
+    the one journal of earlier versions at Config.JOURNAL_PATH itself.
+
+    Journals of running processes are among them, but cannot be opened."""
+    if not Config.JOURNAL_PATH:
+        return []
+    paths = [path for path in glob.glob(glob.escape(Config.JOURNAL_PATH) + '.*')
+             if not path.endswith(('-wal', '-shm', '-journal'))]
+    if os.path.exists(Config.JOURNAL_PATH):
+        paths.insert(0, Config.JOURNAL_PATH)
+    return paths
+
+
+def replay_journal(process):
+    """Process all events left unfinished by processes no longer running.
+
+    process is called with a list of (event name, event data) tuples.
+    Events that failed Config.JOURNAL_MAX_ATTEMPTS times are discarded.
+    Journals are deleted once all of their events are done. Returns the
+    number of events processed."""
+    replayed = 0
+    for path in abandoned_journal_paths():
+        try:
+            journal = EventJournal(path)
+        except BlockingIOError:
+            logger.debug("Journal '%s' is owned by a running process.", path)
+            continue
+        except (OSError, sqlite3.Error):
+            logger.exception("Could not open journal '%s'.", path)
+            continue
+        try:
+            replayed += _replay(journal, process)
+        finally:
+            if len(journal) == 0:
+                journal.remove()
+            else:
+                journal.close()
+    return replayed
+
+
+def _replay(journal, process):
+    entries = journal.unfinished()
+    if len(entries) == 0:
+        return 0
+
+    logger.info("Replaying %d unfinished events from journal '%s'.",
+                len(entries), journal.path)
+
+    discarded = [id for id, attempts, _, _ in entries
+                 if attempts >= Config.JOURNAL_MAX_ATTEMPTS]
+    if len(discarded) > 0:
+        logger.error("Discarding %d events from journal after %d failed "
+                     "attempts.", len(discarded), Config.JOURNAL_MAX_ATTEMPTS)
+        journal.acknowledge(discarded)
+        journal_counters.increment('discarded', len(discarded))
+
+    entries = [entry for entry in entries
+               if entry[1] < Config.JOURNAL_MAX_ATTEMPTS]
+    for id, _, event_name, event_data in entries:
+        journal.count_attempt([id])
+        try:
+            process([(event_name, event_data)])
+        except Exception:
+            logger.exception("Replay of journaled event %d failed.", id)
+            continue
+        journal.acknowledge([id])
+        journal_counters.increment('replayed')
+
+    return len(entries)
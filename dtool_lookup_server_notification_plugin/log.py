@@ -0,0 +1,67 @@
+"""Logging helpers that defer serialization of payloads."""
+import json
+import logging
+import time
+
+from .config import Config
+
+PACKAGE_LOGGER_NAME = 'dtool_lookup_server_notification_plugin'
+
+
+class LazyJSON(object):
+    """Serialize an object to JSON only when formatted into a log message.
+
+    Pass instances as arguments to logging calls, i.e.
+
+        logger.debug("Request JSON: %s", LazyJSON(json_content))
+
+    Nothing is serialized if the level is disabled. Serialized content
+    longer than Config.LOG_MAX_LENGTH characters is truncated.
+    """
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        indent = None if Config.LOG_FORMAT == 'json' else 2
+        try:
+            s = json.dumps(self.obj, indent=indent, default=str)
+        except (TypeError, ValueError):
+            s = repr(self.obj)
+        max_length = Config.LOG_MAX_LENGTH
+        if max_length > 0 and len(s) > max_length:
+            s = '{}... ({} characters truncated)'.format(
+                s[:max_length], len(s) - max_length)
+        return s
+
+
+class JSONFormatter(logging.Formatter):
+    """Format every log record as a single line of JSON."""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+                    + '.{:03d}Z'.format(int(record.msecs)),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """Emit one-line JSON records for the plugin's loggers if configured."""
+    if Config.LOG_FORMAT != 'json':
+        return
+    logger = logging.getLogger(PACKAGE_LOGGER_NAME)
+    if any(isinstance(h.formatter, JSONFormatter) for h in logger.handlers):
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(JSONFormatter())
+    logger.addHandler(handler)
+    logger.propagate = False
@@ -0,0 +1,231 @@
+"""Metrics in Prometheus text exposition format.
+
+Counters and histograms are aggregated per thread without any locking and
+only summed up when collected. Metrics of finished threads are merged into
+a common total, hence the memory needed does not grow with the number of
+threads spawned over time.
+"""
+import bisect
+import threading
+import time
+
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+METRIC_PREFIX = 'dtool_lookup_server_notification_'
+
+# upper bounds in seconds, from S3 round trips to registering large datasets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=''):
+    labels = ['{}="{}"'.format(name, _escape(value))
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self._registry = registry
+        self.name = METRIC_PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _check(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError("{} expects labels {}.".format(self.name, self.labelnames))
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+    kind = 'counter'
+
+    def inc(self, *labelvalues, value=1):
+        self._check(labelvalues)
+        shard = self._registry._shard()
+        key = (self, labelvalues)
+        shard[key] = shard.get(key, 0) + value
+
+    def _merge(self, total, value):
+        return (total or 0) + value
+
+    def _format(self, samples):
+        for labelvalues, value in samples:
+            yield '{}{} {}'.format(self.name, _format_labels(self.labelnames, labelvalues),
+                                   _format_value(value))
+
+
+class Histogram(_Metric):
+    """Distribution of observed values within cumulative buckets."""
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        self._check(labelvalues)
+        shard = self._registry._shard()
+        key = (self, labelvalues)
+        counts = shard.get(key)
+        if counts is None:
+            # counts per bucket, +Inf bucket, sum
+            counts = shard[key] = [0]*(len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """Observe the duration of the enclosed block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def _merge(self, total, counts):
+        if total is None:
+            return list(counts)
+        return [t + c for t, c in zip(total, counts)]
+
+    def _format(self, samples):
+        for labelvalues, counts in samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(self.labelnames, labelvalues,
+                                   'le="{}"'.format(_format_value(float(bound)))),
+                    cumulative)
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield '{}_sum{} {}'.format(self.name, labels, _format_value(counts[-1]))
+            yield '{}_count{} {}'.format(self.name, labels, cumulative)
+
+
+class MetricsRegistry(object):
+    """Collection of metrics aggregated per thread."""
+
+    def __init__(self):
+        self._metrics = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # (thread, shard)
+        self._retired = {}  # merged shards of finished threads
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(self, name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self, name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _merge_into(self, total, shard):
+        # copying a dictionary is atomic, the owning thread may carry on
+        for key, value in shard.copy().items():
+            metric = key[0]
+            total[key] = metric._merge(total.get(key), value)
+
+    def collect(self):
+        """Return all metrics in Prometheus text exposition format."""
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge_into(self._retired, shard)
+            self._shards = alive
+
+            total = {}
+            self._merge_into(total, self._retired)
+            for _, shard in self._shards:
+                self._merge_into(total, shard)
+
+        samples = {}
+        for (metric, labelvalues), value in total.items():
+            samples.setdefault(metric, []).append((labelvalues, value))
+
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric._format(sorted(samples.get(metric, []))))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            for _, shard in self._shards:
+                shard.clear()
+            self._retired.clear()
+
+
+metrics = MetricsRegistry()
+
+events_total = metrics.counter(
+    'events_total', 'Notified events by route, event name and bucket.',
+    ['route', 'event_name', 'bucket'])
+
+ignored_events_total = metrics.counter(
+    'ignored_events_total', 'Events ignored without accessing storage or index.',
+    ['reason'])
+
+errors_total = metrics.counter(
+    'errors_total', 'Errors by processing stage and exception type.',
+    ['stage', 'error'])
+
+request_duration_seconds = metrics.histogram(
+    'request_duration_seconds', 'Duration of notification requests.', ['route'])
+
+stage_duration_seconds = metrics.histogram(
+    'stage_duration_seconds', 'Duration of processing stages.', ['stage'])
+
+content_cache_lookups_total = metrics.counter(
+    'content_cache_lookups_total',
+    'Objects read from the storage by content cache result.', ['result'])
+
+s3_clients_total = metrics.counter(
+    's3_clients_total', 'S3 clients requested by storage brokers, created or reused.',
+    ['result'])
+
+
+@contextmanager
+def stage(name):
+    """Time a processing stage and count exceptions raised within."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as exc:
+        errors_total.inc(name, type(exc).__name__)
+        raise
+    finally:
+        stage_duration_seconds.observe(time.perf_counter() - start, name)
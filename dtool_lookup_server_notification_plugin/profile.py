@@ -0,0 +1,152 @@
+"""Sample call stacks of one in every N notification requests.
+
+A sampled call is observed by a helper thread that records the call stack
+of the calling thread at a fixed interval. Stacks are aggregated in the
+collapsed format read by flame graph tools, i.e. one line of frames from
+the outermost to the innermost call separated by semicolons followed by
+the number of samples. Calls not sampled only pay for a counter.
+"""
+import functools
+import itertools
+import logging
+import os
+import sys
+import threading
+
+from collections import Counter
+
+from .config import Config
+from .stats import register_stats
+
+logger = logging.getLogger(__name__)
+
+
+def _frame_name(frame):
+    return '{}:{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+
+
+class StackSampler(object):
+    """Aggregate collapsed call stacks of every Nth call per name.
+
+    every=0 disables sampling. If a directory is given, the stacks of a name
+    are written to <directory>/<name>.collapsed after every sampled call."""
+
+    def __init__(self, every=0, interval=0.001, directory=''):
+        self.every = every
+        self.interval = interval
+        self.directory = directory
+        self._calls = {}  # name -> count of calls not nested within a sample
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stacks = {}  # name -> Counter of collapsed stacks
+        self._sampled_calls = 0
+
+    def should_sample(self, name=None):
+        """Return whether to sample this call of name, every Nth per name.
+
+        Calls nested within a sampled call are not counted."""
+        if self.every <= 0 or getattr(self._local, 'active', False):
+            return False
+        calls = self._calls.get(name)
+        if calls is None:
+            with self._lock:
+                calls = self._calls.setdefault(name, itertools.count(1))
+        # itertools.count is atomic with respect to threads
+        return next(calls) % self.every == 0
+
+    def run(self, name, func, *args, **kwargs):
+        """Call func(*args, **kwargs) while sampling its call stack."""
+        thread_id = threading.get_ident()
+        outer_frame = sys._getframe()
+        stacks = Counter()
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(self.interval):
+                frame = sys._current_frames().get(thread_id)
+                frames = []
+                while frame is not None and frame is not outer_frame:
+                    frames.append(_frame_name(frame))
+                    frame = frame.f_back
+                if frame is outer_frame:  # still within func
+                    frames.append(name)
+                    stacks[';'.join(reversed(frames))] += 1
+
+        sampler = threading.Thread(target=sample, name='notification-profiler',
+                                   daemon=True)
+        self._local.active = True
+        sampler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            done.set()
+            sampler.join()
+            self._local.active = False
+            self._add(name, stacks)
+
+    def _add(self, name, stacks):
+        with self._lock:
+            self._sampled_calls += 1
+            self._stacks.setdefault(name, Counter()).update(stacks)
+            if self.directory:
+                try:
+                    self._dump(name)
+                except OSError:
+                    logger.exception("Could not write call stacks of '%s'.", name)
+
+    def _dump(self, name):
+        path = os.path.join(self.directory, '{}.collapsed'.format(name))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self._format(self._stacks[name]))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _format(stacks):
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in sorted(stacks.items()))
+
+    def collapsed(self, name=None):
+        """Return collapsed stacks of a name, or of all names if None."""
+        with self._lock:
+            stacks = Counter()
+            for key, counter in self._stacks.items():
+                if name is None or key == name:
+                    stacks.update(counter)
+            return self._format(stacks)
+
+    def clear(self):
+        with self._lock:
+            self._stacks.clear()
+            self._sampled_calls = 0
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'every': self.every,
+                'sampled_calls': self._sampled_calls,
+                'samples': {name: sum(counter.values())
+                            for name, counter in self._stacks.items()},
+            }
+
+
+profiler = StackSampler(every=Config.PROFILE_SAMPLE_RATE,
+                        interval=Config.PROFILE_INTERVAL,
+                        directory=Config.PROFILE_DIR)
+
+register_stats('profile', profiler.to_dict)
+
+
+def profiled(name):
+    """Decorator sampling the call stacks of every Nth call as name.
+
+    Calls nested within a sampled call of the same thread are part of the
+    outer sample and do not count towards N."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if profiler.should_sample(name):
+                return profiler.run(name, func, *args, **kwargs)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,416 @@
+"""Reconcile the index with the datasets actually present in the storage."""
+import fcntl
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import dtoolcore
+
+from dtool_s3.storagebroker import S3StorageBroker
+from flask import current_app
+
+from dtool_lookup_server import mongo, sql_db, MONGO_COLLECTION
+from dtool_lookup_server.sql_models import BaseURI, Dataset
+from dtool_lookup_server.utils import _extract_frozen_at_as_datatime
+
+from . import _register_dataset_from_uri, delete_datasets, manifest_signature
+from .config import Config
+from .s3 import plugin_storage_access
+from .stats import Counters, register_stats
+from .worker import _get_extension, get_ingestion_queue
+
+logger = logging.getLogger(__name__)
+
+RECONCILIATION_OUTCOMES = ['unchanged', 'registered', 'updated', 'deleted',
+                           'incomplete', 'failed']
+
+# number of datasets removed from the index with a single statement
+DELETION_CHUNK_SIZE = 1000
+
+RECONCILER_EXTENSION_NAME = 'dtool_lookup_server_notification_plugin_reconciler'
+
+
+def iter_dataset_uris(base_uri, start_after=None, page_size=1000):
+    """Yield URIs of all datasets within a base URI in lexicographic order.
+
+    Only URIs after start_after are yielded if given. Datasets within S3
+    buckets are listed page by page without reading any of their metadata.
+    Other storage brokers list all URIs at once."""
+    base_uri = dtoolcore.utils.sanitise_uri(base_uri)
+    parsed_uri = dtoolcore.utils.generous_parse_uri(base_uri)
+    if parsed_uri.scheme == 's3':
+        # registration keys 'dtool-<UUID>' sort like URIs 's3://<bucket>/<UUID>'
+        start_key = ''
+        if start_after is not None:
+            start_key = 'dtool-' + dtoolcore.utils.generous_parse_uri(
+                start_after).path.strip('/')
+        with plugin_storage_access():
+            _, client, _ = S3StorageBroker._get_resource_and_client(parsed_uri.netloc)
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=parsed_uri.netloc, Prefix='dtool-',
+                                       StartAfter=start_key,
+                                       PaginationConfig={'PageSize': page_size}):
+            for obj in page.get('Contents', []):
+                uuid = obj['Key'].split('-', 1)[1]
+                yield S3StorageBroker.generate_uri(None, uuid, base_uri)
+    else:
+        config_path = dtoolcore.utils.DEFAULT_CONFIG_PATH
+        with plugin_storage_access():
+            storage_broker = dtoolcore._get_storage_broker(base_uri, config_path)
+            uris = storage_broker.list_dataset_uris(base_uri, config_path)
+        for uri in sorted(uris):
+            if start_after is None or uri > start_after:
+                yield uri
+
+
+def manifest_fingerprint(manifest):
+    """Hash of the items of a manifest, independent of its serialization."""
+    items = json.dumps(manifest.get('items', {}), sort_keys=True)
+    return hashlib.sha1(items.encode('utf-8')).hexdigest()
+
+
+@plugin_storage_access()
+def reconcile_dataset(dataset_uri, base_uri, dry_run=False):
+    """Register or update a single dataset if its index entry is outdated.
+
+    The entry is compared by the time of freezing in the SQL database and
+    the signature of the manifest object, i.e. its ETag and size, stored in
+    the Mongo database at registration. Manifests are only compared in full
+    for entries without signature. Returns one of 'unchanged', 'registered',
+    'updated' and 'incomplete'."""
+    try:
+        dataset = dtoolcore.DataSet.from_uri(dataset_uri)
+    except dtoolcore.DtoolCoreTypeError:
+        return 'incomplete'  # proto dataset
+
+    row = sql_db.session.query(Dataset).filter(Dataset.uri == dataset_uri).first()
+    collection = mongo.db[MONGO_COLLECTION]
+    document = collection.find_one(
+        {"uri": {"$eq": dataset_uri}}, {"manifest_signature": True})
+
+    if row is None or document is None:
+        outcome = 'registered'
+    else:
+        frozen_at = _extract_frozen_at_as_datatime(dataset._admin_metadata)
+        if row.frozen_at == frozen_at:
+            signature = manifest_signature(dataset)
+            if signature is not None and \
+                    document.get('manifest_signature') == signature:
+                return 'unchanged'
+            if signature is None or 'manifest_signature' not in document:
+                # registered without signature, compare the manifests once
+                document = collection.find_one(
+                    {"uri": {"$eq": dataset_uri}}, {"manifest": True})
+                # not cached within dataset, registration must read the
+                # manifest after taking the signature
+                if manifest_fingerprint(document.get('manifest', {})) == \
+                        manifest_fingerprint(dataset._storage_broker.get_manifest()):
+                    if signature is not None and not dry_run:
+                        collection.update_one(
+                            {"uri": {"$eq": dataset_uri}},
+                            {"$set": {"manifest_signature": signature}})
+                    return 'unchanged'
+        outcome = 'updated'
+        if not dry_run and row.frozen_at != frozen_at:
+            # register_dataset only creates missing SQL entries
+            row.frozen_at = frozen_at
+            sql_db.session.commit()
+
+    if not dry_run:
+        # reuses the admin metadata read above
+        _register_dataset_from_uri(dataset_uri, base_uri, dataset=dataset)
+    return outcome
+
+
+def _find_unlisted(base_uri, listed_uris):
+    """Return (base URI, UUID) -> URI of indexed datasets not listed."""
+    query = sql_db.session.query(Dataset.uri, Dataset.uuid) \
+        .join(BaseURI, BaseURI.id == Dataset.base_uri_id) \
+        .filter(BaseURI.base_uri == base_uri) \
+        .yield_per(DELETION_CHUNK_SIZE)
+    return {(base_uri, uuid): uri for uri, uuid in query if uri not in listed_uris}
+
+
+def reconcile_base_uri(base_uri, num_workers=4, dry_run=False, callback=None):
+    """Bring the index entries of a base URI in line with the storage.
+
+    Datasets are enumerated as a stream and compared by a pool of
+    num_workers threads, with at most twice as many datasets in flight.
+    Only the URIs of listed datasets are kept in memory to remove entries
+    of datasets not present anymore afterwards. callback(uri, outcome) is
+    called for every dataset that is not unchanged. Returns the number of
+    datasets per outcome."""
+    base_uri = dtoolcore.utils.sanitise_uri(base_uri)
+    app = current_app._get_current_object()
+    counters = Counters(*RECONCILIATION_OUTCOMES)
+    listed_uris = set()
+    in_flight = threading.BoundedSemaphore(2*num_workers)
+    callback_lock = threading.Lock()
+
+    def report(uri, outcome):
+        counters.increment(outcome)
+        if callback is not None and outcome != 'unchanged':
+            with callback_lock:
+                callback(uri, outcome)
+
+    def work(uri):
+        try:
+            with app.app_context():
+                try:
+                    outcome = reconcile_dataset(uri, base_uri, dry_run)
+                except Exception:
+                    logger.exception("Reconciliation of dataset '%s' failed.", uri)
+                    outcome = 'failed'
+            report(uri, outcome)
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=num_workers,
+                            thread_name_prefix='reconciliation') as executor:
+        for uri in iter_dataset_uris(base_uri):
+            listed_uris.add(uri)
+            in_flight.acquire()
+            executor.submit(work, uri)
+
+    # only reached if the enumeration completed
+    unlisted = _find_unlisted(base_uri, listed_uris)
+    unlisted_items = list(unlisted.items())
+    for i in range(0, len(unlisted_items), DELETION_CHUNK_SIZE):
+        chunk = dict(unlisted_items[i:i+DELETION_CHUNK_SIZE])
+        if not dry_run:
+            delete_datasets(chunk)
+        for uri in chunk.values():
+            report(uri, 'deleted')
+
+    return counters.to_dict()
+
+
+@plugin_storage_access()
+def dataset_exists(dataset_uri):
+    """Return False only if the storage confirms that a dataset is gone."""
+    try:
+        storage_broker = dtoolcore._get_storage_broker(
+            dataset_uri, dtoolcore.utils.DEFAULT_CONFIG_PATH)
+        return storage_broker.has_admin_metadata()
+    except Exception:
+        logger.exception("Could not check existence of dataset '%s'.", dataset_uri)
+        return True
+
+
+def reconcile_slice(base_uri, start_after=None, slice_size=100, throttle=None,
+                    dry_run=False, callback=None):
+    """Reconcile the next slice_size datasets of a base URI after start_after.
+
+    Index entries within the range of the slice are removed if their
+    datasets are confirmed to be gone. throttle() is called after every
+    dataset and may block to limit the rate. Returns the URI to continue
+    after with the next slice, or None if the base URI has been completed."""
+    base_uri = dtoolcore.utils.sanitise_uri(base_uri)
+    uris = list(itertools.islice(
+        iter_dataset_uris(base_uri, start_after=start_after, page_size=slice_size),
+        slice_size))
+    end = uris[-1] if len(uris) == slice_size else None
+
+    def report(uri, outcome):
+        if callback is not None:
+            callback(uri, outcome)
+        if throttle is not None:
+            throttle()
+
+    for uri in uris:
+        try:
+            outcome = reconcile_dataset(uri, base_uri, dry_run)
+        except Exception:
+            logger.exception("Reconciliation of dataset '%s' failed.", uri)
+            sql_db.session.rollback()
+            outcome = 'failed'
+        report(uri, outcome)
+
+    # the database may order URIs differently, existence is checked anyway
+    query = sql_db.session.query(Dataset.uri, Dataset.uuid) \
+        .join(BaseURI, BaseURI.id == Dataset.base_uri_id) \
+        .filter(BaseURI.base_uri == base_uri)
+    if start_after is not None:
+        query = query.filter(Dataset.uri > start_after)
+    if end is not None:
+        query = query.filter(Dataset.uri <= end)
+    if len(uris) > 0:
+        query = query.filter(~Dataset.uri.in_(uris))
+    unlisted = {(base_uri, uuid): uri
+                for uri, uuid in query.order_by(Dataset.uri).yield_per(DELETION_CHUNK_SIZE)}
+    unlisted_items = [(key, uri) for key, uri in unlisted.items()
+                      if not dataset_exists(uri)]
+    for i in range(0, len(unlisted_items), DELETION_CHUNK_SIZE):
+        chunk = dict(unlisted_items[i:i+DELETION_CHUNK_SIZE])
+        if not dry_run:
+            delete_datasets(chunk)
+        for uri in chunk.values():
+            report(uri, 'deleted')
+
+    return end
+
+
+class CursorStore(object):
+    """Position of the periodic reconciliation within every base URI.
+
+    Cursors are persisted to a JSON file if a path is given. Of several
+    processes sharing the file, only the one that has acquired it may
+    advance the cursors."""
+
+    def __init__(self, path=''):
+        self.path = path
+        self._lock = threading.Lock()
+        self._cursors = {}
+        self._lock_fd = None
+        self._load()
+
+    def _load(self):
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self._cursors = json.load(f)
+            except (OSError, ValueError):
+                logger.exception("Could not read reconciliation cursors from "
+                                 "'%s', starting over.", self.path)
+
+    def acquire(self):
+        """Return whether this process owns the cursors, try to take them
+        over otherwise. Without path, the cursors are always owned."""
+        if not self.path or self._lock_fd is not None:
+            return True
+        # released by the operating system if the process dies
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        with self._lock:
+            # continue where the previous owner stopped
+            self._load()
+        return True
+
+    def release(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def get(self, base_uri):
+        return self._cursors.get(base_uri)
+
+    def set(self, base_uri, cursor):
+        with self._lock:
+            self._cursors[base_uri] = cursor
+            if self.path:
+                # replace atomically to never leave a truncated file behind
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(self._cursors, f)
+                os.replace(tmp_path, self.path)
+
+    def to_dict(self):
+        with self._lock:
+            return dict(self._cursors)
+
+
+reconciliation_counters = Counters('slices', 'cycles', *RECONCILIATION_OUTCOMES)
+
+
+class PeriodicReconciler(object):
+    """Background thread reconciling one slice of a base URI at a time.
+
+    Every interval seconds, the next slice of the next base URI in turn is
+    reconciled. Datasets within a slice are reconciled one after another at
+    no more than rate datasets per second, and slices are postponed while
+    notifications are queued for processing, so the reconciliation never
+    competes with live notifications for more than a single request to the
+    storage. Of several processes sharing a cursor path, only one reconciles
+    at a time."""
+
+    def __init__(self, app, interval=60, slice_size=100, rate=1.0, cursor_path=''):
+        self._app = app
+        self.interval = interval
+        self.slice_size = slice_size
+        self.rate = rate
+        self.cursors = CursorStore(cursor_path)
+        self._next_base_uri = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='notification-reconciliation', daemon=True)
+        self._thread.start()
+
+    def _throttle(self):
+        if self.rate > 0:
+            self._stopped.wait(1. / self.rate)
+        if self._stopped.is_set():
+            raise InterruptedError("Periodic reconciliation has been stopped.")
+
+    def _busy(self):
+        return Config.ASYNC_PROCESSING and len(get_ingestion_queue()) > 0
+
+    def run_once(self):
+        """Reconcile the next slice of the next base URI in turn."""
+        base_uris = sorted(set(Config.BUCKET_TO_BASE_URI.values()))
+        if len(base_uris) == 0:
+            return
+        if not self.cursors.acquire():
+            logger.debug("Periodic reconciliation runs in another process.")
+            return
+        base_uri = base_uris[self._next_base_uri % len(base_uris)]
+        self._next_base_uri += 1
+        cursor = self.cursors.get(base_uri)
+        cursor = reconcile_slice(
+            base_uri, start_after=cursor, slice_size=self.slice_size,
+            throttle=self._throttle,
+            callback=lambda uri, outcome: reconciliation_counters.increment(outcome))
+        self.cursors.set(base_uri, cursor)
+        reconciliation_counters.increment('slices')
+        if cursor is None:
+            logger.info("Periodic reconciliation of '%s' completed.", base_uri)
+            reconciliation_counters.increment('cycles')
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self._app.app_context():
+                if self._busy():
+                    logger.debug("Periodic reconciliation postponed.")
+                    continue
+                try:
+                    self.run_once()
+                except InterruptedError:
+                    return
+                except Exception:
+                    logger.exception("Periodic reconciliation failed.")
+
+    def stop(self):
+        self._stopped.set()
+        self.cursors.release()
+
+
+def get_reconciler():
+    """Return the periodic reconciler of the current app, create if necessary."""
+    return _get_extension(
+        RECONCILER_EXTENSION_NAME,
+        lambda app: PeriodicReconciler(
+            app, interval=Config.RECONCILIATION_INTERVAL,
+            slice_size=Config.RECONCILIATION_SLICE_SIZE,
+            rate=Config.RECONCILIATION_RATE,
+            cursor_path=Config.RECONCILIATION_CURSOR_PATH),
+        PeriodicReconciler.stop)
+
+
+def _reconciliation_stats():
+    stats = reconciliation_counters.to_dict()
+    reconciler = current_app.extensions.get(RECONCILER_EXTENSION_NAME)
+    if reconciler is not None:
+        stats['cursors'] = reconciler.cursors.to_dict()
+    return stats
+
+
+register_stats('reconciliation', _reconciliation_stats)
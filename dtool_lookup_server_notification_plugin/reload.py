@@ -0,0 +1,127 @@
+"""Reload bucket to base URI mapping and IP allow-list at runtime.
+
+A reload is triggered by SIGHUP, by a POST request to the reload routes or,
+if CONFIG_RELOAD_INTERVAL is set, by a modification of CONFIG_FILE. Every
+server process reloads on its own, hence multi-process deployments should
+signal every process or rely on the file watch.
+"""
+import logging
+import os
+import signal
+import threading
+import time
+
+from flask import current_app, jsonify
+
+from .config import Config
+from .stats import Counters, register_stats
+from .worker import _get_extension
+
+logger = logging.getLogger(__name__)
+
+CONFIG_WATCHER_EXTENSION_NAME = 'dtool_lookup_server_notification_plugin_config_watcher'
+
+reload_counters = Counters('reloads', 'failures')
+_last_reload = {'time': None, 'error': None}
+
+
+def reload_config():
+    """Reload the configuration, return the error message if it failed."""
+    try:
+        Config.reload()
+    except (OSError, ValueError) as exc:
+        reload_counters.increment('failures')
+        _last_reload['error'] = str(exc)
+        logger.error("Reloading configuration from '%s' failed, keeping "
+                     "current configuration: %s", Config.CONFIG_FILE, exc)
+        return str(exc)
+    reload_counters.increment('reloads')
+    _last_reload.update(time=time.time(), error=None)
+    logger.info("Reloaded configuration from '%s' with %d buckets.",
+                Config.CONFIG_FILE, len(Config.bucket_index()))
+    return None
+
+
+def reload_config_response():
+    """Reload and return the configuration, or the error if reloading failed."""
+    error = reload_config()
+    if error is not None:
+        return jsonify({'error': error}), 500
+    return jsonify(Config.to_dict())
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class ConfigFileWatcher(object):
+    """Reload the configuration whenever the configuration file changes."""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._signature = _file_signature(path)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='notification-config-watcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def check(self):
+        """Reload if the file has changed since the last check."""
+        signature = _file_signature(self.path)
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+        reload_config()
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def get_config_watcher():
+    """Return the configuration file watcher of the current app, create if necessary."""
+    return _get_extension(
+        CONFIG_WATCHER_EXTENSION_NAME,
+        lambda app: ConfigFileWatcher(Config.CONFIG_FILE,
+                                      interval=Config.CONFIG_RELOAD_INTERVAL),
+        ConfigFileWatcher.stop)
+
+
+def install_reload_signal_handler():
+    """Reload the configuration in a helper thread on SIGHUP.
+
+    Signal handlers can only be installed from the main thread. Returns
+    whether the handler has been installed."""
+    if not hasattr(signal, 'SIGHUP') \
+            or threading.current_thread() is not threading.main_thread():
+        return False
+
+    def handler(signum, frame):
+        # do not rebuild within the interrupted main thread
+        threading.Thread(target=reload_config, name='notification-config-reload',
+                         daemon=True).start()
+
+    signal.signal(signal.SIGHUP, handler)
+    return True
+
+
+def _reload_stats():
+    stats = reload_counters.to_dict()
+    stats.update(config_file=Config.CONFIG_FILE,
+                 last_reload=_last_reload['time'],
+                 last_error=_last_reload['error'])
+    stats['watching'] = CONFIG_WATCHER_EXTENSION_NAME in current_app.extensions
+    return stats
+
+
+register_stats('config_reload', _reload_stats)
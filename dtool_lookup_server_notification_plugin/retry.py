@@ -0,0 +1,139 @@
+"""Retry registration of datasets that are not complete yet."""
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+import dtoolcore
+
+from flask import current_app
+
+from . import _register_dataset_from_uri
+from .config import Config
+from .stats import Counters, register_stats
+from .worker import KeyedTimer, _get_extension
+
+logger = logging.getLogger(__name__)
+
+RETRY_TIMER_EXTENSION_NAME = 'dtool_lookup_server_notification_plugin_retry'
+
+
+class DeadLetterList(object):
+    """Thread-safe, bounded record of datasets that never became valid.
+
+    The oldest entries are dropped beyond max_size."""
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # dataset URI -> entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, dataset_uri):
+        return dataset_uri in self._entries
+
+    def add(self, dataset_uri, base_uri, attempts, error):
+        with self._lock:
+            self._entries.pop(dataset_uri, None)
+            self._entries[dataset_uri] = {
+                'uri': dataset_uri,
+                'base_uri': base_uri,
+                'attempts': attempts,
+                'error': error,
+                'time': time.time(),
+            }
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def remove(self, dataset_uri):
+        """Remove entry. Return True if there was one."""
+        with self._lock:
+            return self._entries.pop(dataset_uri, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def to_list(self):
+        with self._lock:
+            return list(self._entries.values())
+
+
+retry_counters = Counters('scheduled', 'succeeded', 'dead_lettered')
+dead_letters = DeadLetterList(max_size=Config.DEAD_LETTER_SIZE)
+
+
+def _retry_stats():
+    return dict(retry_counters.to_dict(), dead_letters=dead_letters.to_list())
+
+
+register_stats('retry', _retry_stats)
+
+
+def get_retry_timer():
+    """Return the timer scheduling retries of the current app."""
+    # pending retries are dropped on shutdown, another notification will follow
+    return _get_extension(
+        RETRY_TIMER_EXTENSION_NAME,
+        lambda app: KeyedTimer(name='notification-retry'),
+        lambda timer: timer.shutdown(flush=False))
+
+
+def retry_delay(attempt):
+    """Delay in seconds before the given attempt, doubled with every attempt."""
+    return min(Config.RETRY_BASE_DELAY * 2 ** (attempt - 1), Config.RETRY_MAX_DELAY)
+
+
+def schedule_retry(dataset_uri, base_uri, attempt=1, error=None):
+    """Retry registration of an incomplete dataset after a delay.
+
+    Further failures of notifications for a dataset with a pending retry do
+    not postpone or add retries. Datasets still incomplete after
+    Config.RETRY_MAX_ATTEMPTS retries are put on the dead letter list."""
+    if Config.RETRY_MAX_ATTEMPTS <= 0:
+        return
+
+    if attempt > Config.RETRY_MAX_ATTEMPTS:
+        logger.warning("Dataset '%s' still incomplete after %d retries, "
+                       "giving up.", dataset_uri, Config.RETRY_MAX_ATTEMPTS)
+        dead_letters.add(dataset_uri, base_uri, attempt - 1, error)
+        retry_counters.increment('dead_lettered')
+        return
+
+    timer = get_retry_timer()
+    if attempt == 1 and dataset_uri in timer:
+        return
+
+    delay = retry_delay(attempt)
+    logger.debug("Retry %d of registering dataset '%s' in %s s.",
+                 attempt, dataset_uri, delay)
+    timer.schedule(dataset_uri, delay, _retry,
+                   current_app._get_current_object(), dataset_uri, base_uri, attempt)
+    retry_counters.increment('scheduled')
+
+
+def cancel_retry(dataset_uri):
+    """Forget about pending retries of a successfully registered dataset.
+    Return True if a retry was pending."""
+    dead_letters.remove(dataset_uri)
+    # no timer unless retries have been scheduled, do not start one here
+    timer = current_app.extensions.get(RETRY_TIMER_EXTENSION_NAME)
+    if timer is None:
+        return False
+    return timer.cancel(dataset_uri)
+
+
+def _retry(app, dataset_uri, base_uri, attempt):
+    with app.app_context():
+        try:
+            _register_dataset_from_uri(dataset_uri, base_uri)
+        except dtoolcore.DtoolCoreTypeError as exc:
+            schedule_retry(dataset_uri, base_uri, attempt + 1, str(exc))
+            return
+
+        logger.info("Registered dataset '%s' at retry %d.", dataset_uri, attempt)
+        dead_letters.remove(dataset_uri)
+        retry_counters.increment('succeeded')
@@ -0,0 +1,149 @@
+"""Reduce the cost of reading datasets from S3.
+
+Registration reads the manifest, README and annotations of a dataset anew
+whenever any of its objects changes. The text objects read via
+S3StorageBroker.get_text are cached, and a cached object is only fetched
+again if S3 reports a different ETag for it.
+
+Every S3 storage broker sets up a new boto3 session with its own connection
+pool, i.e. credentials are resolved and TLS connections established for
+every notification. Sessions, clients and resources are kept per thread
+and bucket configuration instead, since boto3 resources must not be shared
+between threads.
+
+Both replace methods of dtool_s3's S3StorageBroker for the whole process,
+but only take effect on storage access by the plugin itself, i.e. within
+plugin_storage_access(). Any other use of dtool_s3 within the server
+behaves as before.
+"""
+import logging
+import threading
+import urllib.parse
+
+from contextlib import contextmanager
+
+import botocore.exceptions
+
+from dtoolcore.utils import get_config_value
+from dtool_s3.storagebroker import S3StorageBroker
+
+from .cache import ContentCache
+from .config import Config
+from .metrics import content_cache_lookups_total, s3_clients_total
+from .stats import Counters, register_stats
+
+logger = logging.getLogger(__name__)
+
+content_cache = ContentCache(max_bytes=Config.CONTENT_CACHE_SIZE,
+                             directory=Config.CONTENT_CACHE_DIR,
+                             max_disk_bytes=Config.CONTENT_CACHE_DISK_SIZE)
+
+register_stats('content_cache', content_cache.to_dict)
+
+_get_text = S3StorageBroker.get_text
+
+_local = threading.local()
+
+
+@contextmanager
+def plugin_storage_access():
+    """Cache text objects and reuse S3 clients of storage brokers used within."""
+    depth = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+    try:
+        yield
+    finally:
+        _local.depth = depth
+
+
+def _within_plugin():
+    return getattr(_local, 'depth', 0) > 0
+
+
+def _count(result):
+    content_cache.count(result)
+    content_cache_lookups_total.inc(result)
+
+
+def get_text(storage_broker, key):
+    """Return text of key within the bucket of storage_broker, cached."""
+    if content_cache.max_bytes <= 0 or not _within_plugin():
+        return _get_text(storage_broker, key)
+
+    cache_key = (storage_broker.bucket, key)
+    cached = content_cache.lookup(cache_key)
+    obj = storage_broker.s3resource.Object(storage_broker.bucket, key)
+    if cached is None:
+        response = obj.get()
+    else:
+        etag, content, announced = cached
+        if announced:
+            _count('hit')
+            return content
+        try:
+            response = obj.get(IfNoneMatch='"{}"'.format(etag))
+        except botocore.exceptions.ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') not in ('304', 'NotModified'):
+                raise
+            _count('revalidated')
+            return content
+
+    content = response['Body'].read().decode('utf-8')
+    content_cache.put(cache_key, response.get('ETag'), content)
+    _count('miss')
+    return content
+
+
+def announce_etag(base_uri, object_key, etag):
+    """Remember the ETag of an object created according to a notification."""
+    parsed_uri = urllib.parse.urlparse(base_uri)
+    if parsed_uri.scheme == 's3':
+        content_cache.announce((parsed_uri.netloc, object_key), etag)
+
+
+_get_resource_and_client = S3StorageBroker._get_resource_and_client.__func__
+
+client_counters = Counters('created', 'reused')
+
+
+def _client_stats():
+    stats = client_counters.to_dict()
+    total = stats['created'] + stats['reused']
+    stats['reuse_ratio'] = stats['reused'] / total if total > 0 else 0.0
+    return stats
+
+
+register_stats('s3_clients', _client_stats)
+
+
+def get_resource_and_client(cls, bucket_name):
+    """Return S3 resource, client and unsigned client for a bucket, reused
+    within the current thread as long as the configuration of the bucket
+    does not change."""
+    if not Config.S3_CLIENT_POOLING or not _within_plugin():
+        return _get_resource_and_client(cls, bucket_name)
+
+    key = (bucket_name,) + tuple(
+        get_config_value(name.format(bucket_name)) for name in [
+            "DTOOL_S3_ENDPOINT_{}",
+            "DTOOL_S3_ACCESS_KEY_ID_{}",
+            "DTOOL_S3_SECRET_ACCESS_KEY_{}"])
+    clients = _local.__dict__.setdefault('clients', {})
+    if key in clients:
+        client_counters.increment('reused')
+        s3_clients_total.inc('reused')
+    else:
+        logger.debug("Creating S3 clients for bucket '%s' in thread '%s'.",
+                     bucket_name, threading.current_thread().name)
+        # drop clients of the same bucket with outdated configuration
+        for outdated_key in [k for k in clients if k[0] == bucket_name]:
+            del clients[outdated_key]
+        clients[key] = _get_resource_and_client(cls, bucket_name)
+        client_counters.increment('created')
+        s3_clients_total.inc('created')
+    return clients[key]
+
+
+# all readers of text objects, i.e. of manifest, README and annotations, end up here
+S3StorageBroker.get_text = get_text
+S3StorageBroker._get_resource_and_client = classmethod(get_resource_and_client)
@@ -0,0 +1,38 @@
+"""Runtime statistics of the notification plugin."""
+import threading
+
+_providers = {}
+
+
+class Counters(object):
+    """Thread-safe set of named counters."""
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._counts = {name: 0 for name in names}
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + value
+
+    def __getitem__(self, name):
+        return self._counts.get(name, 0)
+
+    def reset(self):
+        with self._lock:
+            for name in self._counts:
+                self._counts[name] = 0
+
+    def to_dict(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+def register_stats(name, provider):
+    """Register a callable that returns the statistics of a component."""
+    _providers[name] = provider
+
+
+def collect_stats():
+    """Return statistics of all registered components."""
+    return {name: provider() for name, provider in _providers.items()}
@@ -1,11 +1,15 @@
 """Receive and process Amazon S3 event notifications."""
 import json
 import logging
+import queue
+import threading
 import urllib
+from collections import OrderedDict
 
 from flask import (
     abort,
     Blueprint,
+    current_app,
     jsonify,
     request
 )
@@ -18,25 +22,43 @@ import dtoolcore
 
 from dtool_lookup_server import (
     AuthenticationError,
-    mongo,
-    sql_db,
-    MONGO_COLLECTION
-)
-from dtool_lookup_server.sql_models import (
-    Dataset,
-)
-from dtool_lookup_server.utils import (
-    generate_dataset_info,
-    register_dataset,
 )
 
+from .cache import LRUCache, SequencerTable
 from .config import Config
+from .journal import get_journal, replay_journal
+from .log import LazyJSON
+from .metrics import (
+    CONTENT_TYPE,
+    events_total,
+    ignored_events_total,
+    metrics,
+    request_duration_seconds,
+    stage,
+)
+from .profile import profiled, profiler
+from .reconcile import dataset_exists, get_reconciler
+from .reload import (
+    get_config_watcher,
+    install_reload_signal_handler,
+    reload_config_response,
+)
+from .retry import cancel_retry, schedule_retry
+from .s3 import announce_etag
 from . import (
+    admin_required,
     filter_ips,
-    _log_nested,
+    _extract_uuid,
     _parse_obj_key,
-    _reconstruct_uri
+    _reconstruct_uri,
+    _reconstruct_uris,
+    _register_dataset_from_uri,
+    _update_dataset_metadata,
+    object_key_classifier,
+    schedule_deletion,
 )
+from .stats import collect_stats, register_stats
+from .worker import get_debouncer, get_ingestion_queue
 
 # event names from https://docs.aws.amazon.com/AmazonS3/latest/userguide/notification-how-to-event-types-and-destinations.html
 OBJECT_CREATED_EVENT_NAMES = [
@@ -159,32 +181,44 @@ OBJECT_REMOVED_EVENT_NAMES = [
 
 logger = logging.getLogger(__name__)
 
+# latest sequencer of events per (base URI, object key)
+sequencer_table = SequencerTable(max_size=Config.SEQUENCER_TABLE_SIZE)
+register_stats('sequencer_table', sequencer_table.to_dict)
+
+# records already received, to ignore redelivered notifications
+dedup_cache = LRUCache(max_size=Config.DEDUP_CACHE_SIZE, ttl=Config.DEDUP_CACHE_TTL)
+register_stats('dedup_cache', dedup_cache.to_dict)
 
-def _process_object_created(base_uri, object_key):
-    """Try to register new or update existing dataset entry if object created."""
 
-    uuid, kind = _parse_obj_key(object_key)
+def _process_object_created(base_uri, object_key, dataset_uri=None, kinds=None):
+    """Try to register new or update existing dataset entry if object created.
+
+    kinds is the collection of kinds of all objects created within the
+    dataset. If only README, tags or annotations have been created, only
+    these are updated. Otherwise, or if kinds is None, the whole dataset is
+    registered."""
 
     # We also need to update the database if the metadata has changed.
     # Here, we just brute-force attempt registration at every object write
     # as notifications may appear in arbitrary order. Another option might
     # be to look out for either the README.yml or the the 'dtool' object
     # of the respective UUID that finalizes creation of a dataset.
-    dataset_uri = _reconstruct_uri(base_uri, object_key)
+    if dataset_uri is None:
+        dataset_uri = _reconstruct_uri(base_uri, object_key)
 
     if dataset_uri is not None:
         try:
-            dataset = dtoolcore.DataSet.from_uri(dataset_uri)
-            dataset_info = generate_dataset_info(dataset, base_uri)
-            register_dataset(dataset_info)
-        except dtoolcore.DtoolCoreTypeError:
+            if kinds is None or not _update_dataset_metadata(dataset_uri, kinds):
+                _register_dataset_from_uri(dataset_uri, base_uri)
+            cancel_retry(dataset_uri)
+        except dtoolcore.DtoolCoreTypeError as exc:
             # DtoolCoreTypeError is raised if this is not a dataset yet, i.e.
-            # if the dataset has only partially been copied. There will be
-            # another notification once everything is final. We simply
-            # ignore this.
+            # if the dataset has only partially been copied. There should be
+            # another notification once everything is final, but
+            # notifications may arrive out of order. Retry later.
             logger.debug('DtoolCoreTypeError raised for dataset '
                          'with URI %s', dataset_uri)
-            pass
+            schedule_retry(dataset_uri, base_uri, error=str(exc))
     else:
         logger.info(("Creation of '%s' within '%s' does not constitute the "
                      "creation of a complete dataset or update of its metadata. "
@@ -193,7 +227,7 @@ def _process_object_created(base_uri, object_key):
     return {}
 
 
-def _process_object_removed(base_uri, object_key):
+def _process_object_removed(base_uri, object_key, dataset_uri=None):
     """Notify the lookup server about deletion of an object."""
     # The only information that we get is the URL. We need to convert the URL
     # into the respective UUID of the dataset.
@@ -201,81 +235,364 @@ def _process_object_removed(base_uri, object_key):
     # only delete dataset from index if the `dtool` object is deleted
 
     if object_key.endswith('/dtool'):  # somewhat dangerous if another item is named dtool
-        uri = _reconstruct_uri(base_uri, object_key)
+        if dataset_uri is None:
+            dataset_uri = _reconstruct_uri(base_uri, object_key)
         uuid, kind = _parse_obj_key(object_key)
         assert kind == 'dtool'
 
-        logger.info('Deleting dataset with URI {}'.format(uri))
-
-        # Delete datasets with this URI
-        sql_db.session.query(Dataset) \
-            .filter(Dataset.uri == uri) \
-            .delete()
-        sql_db.session.commit()
-
-        # Remove from Mongo database
-        # https://pymongo.readthedocs.io/en/stable/api/pymongo/collection.html#pymongo.collection.Collection.delete_one
-        mongo.db[MONGO_COLLECTION].delete_one({"uri": {"$eq": uri}})
+        logger.info('Deleting dataset with URI %s', dataset_uri)
+        schedule_deletion({(base_uri, _extract_uuid(object_key)): dataset_uri})
 
     return {}
 
 
-def _process_event(event_name, event_data):
-    """"Delegate S3 notification event processing o correct handler."""
-    response = {}
+def _register_debounced(app, base_uri, object_key, dataset_uri):
+    """Register dataset after its debounce period has elapsed."""
+    with app.app_context():
+        if Config.ASYNC_PROCESSING:
+            try:
+                get_ingestion_queue().put(
+                    _process_object_created, base_uri, object_key, dataset_uri)
+                return
+            except (queue.Full, RuntimeError):
+                logger.warning("Ingestion queue not available, registering "
+                               "dataset '%s' immediately.", dataset_uri)
+        _process_object_created(base_uri, object_key, dataset_uri)
+
+
+def _schedule_object_created(base_uri, uuid, object_key, dataset_uri):
+    """Register dataset once no further objects have been created within the
+    debounce period. Any number of object creations within that period
+    collapse into a single registration of the whole dataset."""
+    logger.debug("Registration of dataset '%s' postponed by %s s.",
+                 dataset_uri, Config.DEBOUNCE_PERIOD)
+    get_debouncer().schedule(
+        (base_uri, uuid), Config.DEBOUNCE_PERIOD, _register_debounced,
+        current_app._get_current_object(), base_uri, object_key, dataset_uri)
+
+
+def _parse_event_data(event_data):
+    """Extract base URI and de-escaped object key from S3 event data.
+
+    Returns None as base URI if no base URI is configured for the bucket
+    and None as object key if the event data lacks bucket or object key."""
+    try:
+        bucket_name = event_data['bucket']['name']
+        object_key = event_data['object']['key']
+    except (KeyError, TypeError) as exc:
+        logger.error("No bucket name or object key in event data: %s", exc)
+        return None, None
+
+    # object keys are %xx-escaped, bucket names as well?
+    logger.info("Received notification for raw bucket name '%s' and raw object key '%s'",
+                bucket_name, object_key)
+    bucket_name = urllib.parse.unquote(bucket_name, encoding='utf-8', errors='replace')
+    object_key = urllib.parse.unquote(object_key, encoding='utf-8', errors='replace')
+    logger.info(
+        "Received notification for de-escaped bucket name '%s' and de-escaped object key '%s'",
+        bucket_name, object_key)
+
+    # TODO: the same bucket name may exist at different locations wit different base URIS
+    # look up in one snapshot of the mapping, it may be swapped by a reload
+    base_uri = Config.bucket_index().get(bucket_name)
+    if base_uri is None:
+        logger.error("No base URI configured for bucket '%s'.", bucket_name)
+
+    return base_uri, object_key
+
+
+def _dedup_key(record):
+    """Identify a record by request id, bucket, object key and eTag.
+
+    Returns None if the record carries no request id."""
+    try:
+        request_id = record['responseElements']['x-amz-request-id']
+        bucket_name = record['s3']['bucket']['name']
+        object_key = record['s3']['object']['key']
+    except (KeyError, TypeError):
+        return None
+    return (request_id, bucket_name, object_key,
+            record['s3']['object'].get('eTag'))
+
+
+@stage('parse')
+def _group_events_by_dataset(events):
+    """Validate S3 notification events and group them by dataset.
+
+    The events are (event name, event data) tuples. Returns a dictionary
+    mapping (base URI, UUID) to the list of (event name, object key, event
+    data) tuples of the respective dataset, in order of arrival."""
     # TODO: consider s3SchemaVersion
+    events_by_dataset = OrderedDict()
+    for event_name, event_data in events:
+        if event_name not in [*OBJECT_CREATED_EVENT_NAMES, *OBJECT_REMOVED_EVENT_NAMES]:
+            logger.info("Event '%s' ignored.", event_name)
+            ignored_events_total.inc('unsupported_event')
+            continue
+
+        base_uri, object_key = _parse_event_data(event_data)
+        # a single broken record must not block the others of the batch
+        if object_key is None:
+            logger.warning("Event '%s' without bucket name or object key. "
+                           "Ignored.", event_name)
+            ignored_events_total.inc('malformed')
+            continue
+        if base_uri is None:
+            logger.warning("Event '%s' for '%s' within unknown bucket. Ignored.",
+                           event_name, object_key)
+            ignored_events_total.inc('unknown_bucket')
+            continue
+
+        # S3 orders events per object key by sequencer, i.e. a delayed
+        # creation must not revert a later removal
+        sequencer = event_data['object'].get('sequencer')
+        if not sequencer_table.accept((base_uri, object_key), sequencer):
+            logger.info("Event '%s' for '%s' within '%s' with sequencer %s is "
+                        "older than events processed before. Ignored.",
+                        event_name, object_key, base_uri, sequencer)
+            ignored_events_total.inc('stale')
+            continue
 
-    if event_name in [*OBJECT_CREATED_EVENT_NAMES, *OBJECT_REMOVED_EVENT_NAMES]:
         try:
-            bucket_name = event_data['bucket']['name']
-        except KeyError as exc:
-            logger.error(str(exc))
-            abort(400)
+            uuid = _extract_uuid(object_key)
+        except ValueError:
+            logger.warning("Object key '%s' within '%s' does not contain any "
+                           "valid UUID. Ignored.", object_key, base_uri)
+            ignored_events_total.inc('no_uuid')
+            continue
+
+        if event_name in OBJECT_CREATED_EVENT_NAMES and \
+                object_key_classifier.classify(object_key) == 'payload':
+            logger.info("Creation of payload object '%s' within '%s' ignored.",
+                        object_key, base_uri)
+            ignored_events_total.inc('payload')
+            continue
 
-        try:
-            object_key = event_data['object']['key']
-        except KeyError as exc:
-            logger.error(str(exc))
-            abort(400)
+        if event_name in OBJECT_CREATED_EVENT_NAMES:
+            announce_etag(base_uri, object_key, event_data['object'].get('eTag'))
 
-        # object keys are %xx-escaped, bucket names as well?
-        logger.info("Received notification for raw bucket name '%s' and raw object key '%s'",
-                    bucket_name, object_key)
-        bucket_name = urllib.parse.unquote(bucket_name, encoding='utf-8', errors='replace')
-        object_key = urllib.parse.unquote(object_key, encoding='utf-8', errors='replace')
-        logger.info(
-            "Received notification for de-escaped bucket name '%s' and de-escaped object key '%s'",
-            bucket_name, object_key)
-
-        # TODO: the same bucket name may exist at different locations wit different base URIS
-        if bucket_name not in Config.BUCKET_TO_BASE_URI:
-            logger.error("No base URI configured for bucket '%s'.", bucket_name)
-            abort(400)
+        events_by_dataset.setdefault((base_uri, uuid), []).append(
+            (event_name, object_key, event_data))
 
-        base_uri = Config.BUCKET_TO_BASE_URI[bucket_name]
+    return events_by_dataset
 
-        if event_name in OBJECT_CREATED_EVENT_NAMES:
-            logger.info("Object '%s' created within '%s'", object_key, base_uri)
-            response = _process_object_created(base_uri, object_key)
-        elif event_name in OBJECT_REMOVED_EVENT_NAMES:
-            logger.info("Object '%s' removed from '%s'", object_key, base_uri)
-            response = _process_object_removed(base_uri, object_key)
 
-    else:
-        logger.info("Event '%s' ignored.", event_name)
+def _process_dataset_events(events_by_dataset, verify_removal=False):
+    """Process S3 notification events grouped by dataset.
+
+    All dataset URIs are resolved with a single index lookup. Since every
+    handler acts on the dataset as a whole, only the most recent relevant
+    event of every dataset is processed. With verify_removal, datasets are
+    only deleted if the storage confirms that they are gone, i.e. for events
+    that may have been superseded by events not known here."""
+    response = {}
+
+    if len(events_by_dataset) == 0:
+        return response
+
+    dataset_uris = _reconstruct_uris(events_by_dataset.keys())
+    # deleted at once after all events have been processed
+    removed_datasets = OrderedDict()
+
+    for (base_uri, uuid), dataset_events in events_by_dataset.items():
+        dataset_uri = dataset_uris[(base_uri, uuid)]
+        # Any object creation triggers a registration attempt of the dataset,
+        # only the removal of the 'dtool' object its deletion. Removals of
+        # other objects do not affect the dataset entry. Collect the kinds
+        # of all objects created after the last removal of the 'dtool' object.
+        created_kinds = set()
+        last_created_key = None
+        for event_name, object_key, _ in reversed(dataset_events):
+            if event_name in OBJECT_CREATED_EVENT_NAMES:
+                logger.info("Object '%s' created within '%s'", object_key, base_uri)
+                _, kind = _parse_obj_key(object_key)
+                created_kinds.add(kind)
+                if last_created_key is None:
+                    last_created_key = object_key
+            elif object_key.endswith('/dtool'):
+                if last_created_key is not None:
+                    logger.info("Removal of '%s' from '%s' superseded by later "
+                                "object creation.", object_key, base_uri)
+                    break
+                logger.info("Object '%s' removed from '%s'", object_key, base_uri)
+                if Config.DEBOUNCE_PERIOD > 0 and get_debouncer().cancel((base_uri, uuid)):
+                    logger.debug("Cancelled pending registration of dataset '%s'.",
+                                 dataset_uri)
+                removed_datasets[(base_uri, uuid)] = dataset_uri
+                break
+            else:
+                logger.info("Removal of '%s' from '%s' ignored.", object_key, base_uri)
+
+        if last_created_key is not None:
+            if Config.DEBOUNCE_PERIOD > 0:
+                _schedule_object_created(base_uri, uuid, last_created_key, dataset_uri)
+            else:
+                response = _process_object_created(
+                    base_uri, last_created_key, dataset_uri, created_kinds)
+
+        if len(dataset_events) > 1:
+            logger.debug("Coalesced %d events for dataset '%s'.",
+                         len(dataset_events), dataset_uri)
+
+    if verify_removal:
+        for key, dataset_uri in list(removed_datasets.items()):
+            if dataset_exists(dataset_uri):
+                logger.info("Dataset '%s' still exists, removal superseded.",
+                            dataset_uri)
+                del removed_datasets[key]
+
+    if len(removed_datasets) > 0:
+        logger.info("Deleting %d datasets.", len(removed_datasets))
+        schedule_deletion(removed_datasets)
 
     return response
 
 
+def _process_event(events, verify_removal=False):
+    """"Delegate a batch of S3 notification events to the correct handlers.
+
+    The events are (event name, event data) tuples."""
+    return _process_dataset_events(_group_events_by_dataset(events),
+                                   verify_removal=verify_removal)
+
+
+def _replay_event(events):
+    """Process journaled events of a process no longer running.
+
+    The events may have been delivered again and superseded since, hence
+    datasets are only deleted if they are gone."""
+    return _process_event(events, verify_removal=True)
+
+
+def _event_key(event_name, event_data):
+    """Identify an event by bucket, object key, event name and sequencer.
+
+    Returns None if the event carries no sequencer."""
+    try:
+        sequencer = event_data['object'].get('sequencer')
+        if sequencer is None:
+            return None
+        return json.dumps([event_data['bucket']['name'], event_data['object']['key'],
+                           event_name, sequencer])
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+@profiled('process')
+def _process_journaled_events(events_by_dataset, event_ids):
+    """Process grouped events and remove them from the journal afterwards.
+
+    Events are left in the journal if processing fails."""
+    response = _process_dataset_events(events_by_dataset)
+    if len(event_ids) > 0:
+        get_journal().acknowledge(event_ids)
+    return response
+
+
+def _accept_events(events):
+    """Validate and journal events, then process or enqueue them.
+
+    Only events that are going to be processed are journaled."""
+    # validate synchronously before journaling
+    events_by_dataset = _group_events_by_dataset(events)
+
+    if len(events_by_dataset) == 0:
+        return jsonify({})
+
+    event_ids = []
+    journal = get_journal()
+    if journal is not None:
+        accepted = [(event_name, event_data)
+                    for dataset_events in events_by_dataset.values()
+                    for event_name, _, event_data in dataset_events]
+        # a successful redelivery acknowledges earlier failed deliveries
+        event_ids = journal.append(
+            accepted, keys=[_event_key(*event) for event in accepted])
+
+    if Config.ASYNC_PROCESSING:
+        # leave all S3 and database access to the background workers
+        try:
+            get_ingestion_queue().put(
+                _process_journaled_events, events_by_dataset, event_ids)
+        except queue.Full:
+            logger.warning("Ingestion queue full, rejected notification.")
+            if len(event_ids) > 0:
+                # the sender will retry
+                journal.acknowledge(event_ids)
+            abort(503)
+        return jsonify({}), 202
+
+    return jsonify(_process_journaled_events(events_by_dataset, event_ids))
+
+
+def _replay_journal(app):
+    """Process events left unfinished by a previous run of the server."""
+    with app.app_context():
+        try:
+            replay_journal(_replay_event)
+        except Exception:
+            logger.exception("Replay of event journal failed.")
+
+
 webhook_bp = Blueprint("webhook", __name__, url_prefix="/webhook")
 
 
+@webhook_bp.record_once
+def _replay_journal_on_registration(state):
+    """Replay the event journal in the background once the plugin is loaded.
+
+    The lookup server sets up its databases before registering plugins."""
+    if not Config.JOURNAL_PATH:
+        return
+    threading.Thread(target=_replay_journal, args=(state.app,),
+                     name='notification-journal-replay', daemon=True).start()
+
+
+@webhook_bp.record_once
+def _start_reconciler_on_registration(state):
+    """Start the periodic reconciliation once the plugin is loaded."""
+    if Config.RECONCILIATION_INTERVAL <= 0:
+        return
+    with state.app.app_context():
+        get_reconciler()
+
+
+@webhook_bp.record_once
+def _watch_config_on_registration(state):
+    """Reload the configuration on SIGHUP and on modifications of the
+    configuration file once the plugin is loaded."""
+    if not Config.CONFIG_FILE:
+        return
+    if not install_reload_signal_handler():
+        logger.warning("Could not install SIGHUP handler for reloading the "
+                       "configuration outside of the main thread.")
+    if Config.CONFIG_RELOAD_INTERVAL > 0:
+        with state.app.app_context():
+            get_config_watcher()
+
+
+def _bucket_label(event_data):
+    """Return the configured name of the bucket of an event for labelling
+    metrics, 'unknown' for any other name. Labels must not be taken from
+    requests as they are, every distinct value adds a time series."""
+    try:
+        bucket_name = urllib.parse.unquote(
+            event_data['bucket']['name'], encoding='utf-8', errors='replace')
+    except (KeyError, TypeError):
+        return 'unknown'
+    if bucket_name not in Config.bucket_index():
+        return 'unknown'
+    return bucket_name
+
+
 # wildcard route,
 # see https://flask.palletsprojects.com/en/2.0.x/patterns/singlepageapplications/
 # strict_slashes=False matches '/notify' and '/notify/'
 @webhook_bp.route('/notify', defaults={'path': ''}, methods=['POST'], strict_slashes=False)
 @webhook_bp.route('/notify/<path:path>', methods=['POST'])
 @filter_ips
+@request_duration_seconds.time('webhook')
+@profiled('webhook')
 def notify(path):
     """Notify the lookup server about creation, modification or deletion of a
     dataset."""
@@ -286,8 +603,7 @@ def notify(path):
     if request.content_type.startswith('application/x-www-form-urlencoded'):
         logger.debug("Received 'application/x-www-form-urlencoded' content.")
         form = request.form
-        logger.debug("Form:")
-        _log_nested(logger.debug, form)
+        logger.debug("Form: %s", LazyJSON(form))
         if 'Message' in form:
             logger.debug("Try to parse 'Message' field of form as JSON.")
             try:
@@ -298,8 +614,7 @@ def notify(path):
     else: # general treatment, usually for 'application/json'
         json_content = request.get_json()
 
-    logger.debug("Request JSON:")
-    _log_nested(logger.debug, json_content)
+    logger.debug("Request JSON: %s", LazyJSON(json_content))
     if json_content is None:
         logger.error("No JSON attached.")
         # health check: NetApp Storage GRID performs a health check post request,
@@ -307,22 +622,50 @@ def notify(path):
         #  Action=Publish&Message=StorageGRID+Test+Message&TopicArn=urn%3Atest%3Asns%3Atest%3Atest%3Atest&Version=2010-03-31
         return {}
 
-    logger.debug("Records:")
-    _log_nested(logger.debug, json_content['Records'])
-
     try:
-        event_name = json_content['Records'][0]['eventName']
+        records = json_content['Records']
     except KeyError:
-        logger.error("No 'eventName' in 'Records''.")
+        logger.error("No 'Records' attached.")
         abort(400)
 
-    try:
-        event_data = json_content['Records'][0]['s3']
-    except KeyError:
-        logger.error("No 's3' in 'Records'.")
-        abort(400)
+    logger.debug("Records: %s", LazyJSON(records))
 
-    return jsonify(_process_event(event_name, event_data))
+    events = []
+    dedup_keys = []
+    for record in records:
+        try:
+            event_name = record['eventName']
+        except KeyError:
+            logger.error("No 'eventName' in 'Records''.")
+            abort(400)
+
+        try:
+            event_data = record['s3']
+        except KeyError:
+            logger.error("No 's3' in 'Records'.")
+            abort(400)
+
+        events_total.inc('webhook', event_name, _bucket_label(event_data))
+
+        if dedup_cache.max_size > 0:
+            dedup_key = _dedup_key(record)
+            if dedup_key is not None:
+                if dedup_cache.get(dedup_key) is not None:
+                    logger.info("Record %s received before. Ignored.", dedup_key)
+                    ignored_events_total.inc('duplicate')
+                    continue
+                dedup_cache.put(dedup_key, True)
+                dedup_keys.append(dedup_key)
+
+        events.append((event_name, event_data))
+
+    try:
+        return _accept_events(events)
+    except Exception:
+        # let the sender retry records not accepted
+        for dedup_key in dedup_keys:
+            dedup_cache.invalidate(dedup_key)
+        raise
 
 
 @webhook_bp.route("/config", methods=["GET"])
@@ -334,3 +677,35 @@ def plugin_config():
     except AuthenticationError:
         abort(401)
     return jsonify(config)
+
+
+@webhook_bp.route("/config/reload", methods=["POST"])
+@jwt_required()
+@admin_required
+def plugin_config_reload():
+    """Reload bucket to base URI mapping and IP allow-list, admins only."""
+    return reload_config_response()
+
+
+@webhook_bp.route("/stats", methods=["GET"])
+@jwt_required()
+@admin_required
+def plugin_stats():
+    """Return runtime statistics of the plugin, admins only."""
+    return jsonify(collect_stats())
+
+
+@webhook_bp.route("/metrics", methods=["GET"])
+@filter_ips
+def plugin_metrics():
+    """Return metrics of the plugin in Prometheus text format."""
+    return metrics.collect(), 200, {'Content-Type': CONTENT_TYPE}
+
+
+@webhook_bp.route("/profile", methods=["GET"])
+@jwt_required()
+@admin_required
+def plugin_profile():
+    """Return sampled call stacks of the plugin in collapsed format."""
+    return profiler.collapsed(request.args.get('name')), 200, \
+        {'Content-Type': 'text/plain; charset=utf-8'}
@@ -0,0 +1,407 @@
+"""Process notifications asynchronously in background threads."""
+import atexit
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import current_app
+
+from .config import Config
+
+logger = logging.getLogger(__name__)
+
+INGESTION_QUEUE_EXTENSION_NAME = 'dtool_lookup_server_notification_plugin_worker'
+DEBOUNCER_EXTENSION_NAME = 'dtool_lookup_server_notification_plugin_debouncer'
+
+_lock = threading.Lock()
+
+
+class IngestionQueue(object):
+    """Bounded queue of tasks processed by a pool of worker threads.
+
+    Every task runs within an application context of the Flask app the queue
+    has been created for. Registration is dominated by waiting for S3 and the
+    databases, hence threads suffice to process notifications in parallel
+    without having to set up app and database connections in every process
+    of a process pool.
+    """
+
+    def __init__(self, app, num_workers=4, max_size=1000):
+        self._app = app
+        self._queue = queue.Queue(maxsize=max_size)
+        self._shutdown = False
+        self._workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(
+                target=self._work, name='notification-worker-{}'.format(i),
+                daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def put(self, func, *args, **kwargs):
+        """Enqueue func(*args, **kwargs) without blocking.
+
+        Raises queue.Full if the queue has reached its maximum size and
+        RuntimeError if the queue has been shut down."""
+        if self._shutdown:
+            raise RuntimeError("Ingestion queue has been shut down.")
+        self._queue.put_nowait((func, args, kwargs))
+
+    def join(self):
+        """Block until all enqueued tasks have been processed."""
+        self._queue.join()
+
+    def shutdown(self, wait=True):
+        """Stop accepting tasks and stop workers after draining the queue."""
+        if self._shutdown:
+            return
+        self._shutdown = True
+        logger.info("Shutting down ingestion queue with %d pending tasks.",
+                    self._queue.qsize())
+        # one sentinel per worker, queued behind all pending tasks
+        for _ in self._workers:
+            self._queue.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    break
+                func, args, kwargs = task
+                with self._app.app_context():
+                    func(*args, **kwargs)
+            except Exception:
+                logger.exception("Processing of queued notification failed.")
+            finally:
+                self._queue.task_done()
+
+
+class KeyedTimer(object):
+    """Call functions after a delay with at most one pending call per key.
+
+    All calls are made from a single background thread in order of their
+    deadlines. Scheduling a call for a key that already has a pending call
+    replaces the pending call.
+    """
+
+    def __init__(self, name='keyed-timer'):
+        self._condition = threading.Condition()
+        self._pending = {}  # key -> (deadline, func, args)
+        self._heap = []  # (deadline, sequence number, key)
+        self._counter = itertools.count()
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    def schedule(self, key, delay, func, *args, reset=True):
+        """Call func(*args) after delay seconds.
+
+        If a call is pending for key already, it is replaced. The pending
+        deadline is postponed if reset is True and kept otherwise."""
+        with self._condition:
+            deadline = time.monotonic() + delay
+            if not reset and key in self._pending:
+                deadline = self._pending[key][0]
+            self._pending[key] = (deadline, func, args)
+            heapq.heappush(self._heap, (deadline, next(self._counter), key))
+            self._condition.notify()
+
+    def cancel(self, key):
+        """Cancel pending call for key. Return True if there was one."""
+        with self._condition:
+            return self._pending.pop(key, None) is not None
+
+    def flush(self):
+        """Make all pending calls immediately in the calling thread."""
+        with self._condition:
+            pending = sorted(self._pending.values(), key=lambda p: p[0])
+            self._pending.clear()
+            self._heap.clear()
+        for _, func, args in pending:
+            self._call(func, args)
+
+    def shutdown(self, flush=True):
+        """Stop the timer thread, make all pending calls if flush is True."""
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify()
+        self._thread.join()
+        if flush:
+            self.flush()
+
+    def _call(self, func, args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception("Delayed processing of notification failed.")
+
+    def _next_due(self):
+        """Pop the next due call or return the time to wait for it."""
+        while len(self._heap) > 0:
+            deadline, _, key = self._heap[0]
+            if key not in self._pending or self._pending[key][0] != deadline:
+                heapq.heappop(self._heap)  # outdated entry
+                continue
+            timeout = deadline - time.monotonic()
+            if timeout > 0:
+                return None, timeout
+            heapq.heappop(self._heap)
+            return self._pending.pop(key), None
+        return None, None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._shutdown:
+                        return
+                    due, timeout = self._next_due()
+                    if due is not None:
+                        break
+                    self._condition.wait(timeout)
+            _, func, args = due
+            self._call(func, args)
+
+
+class BatchCollector(object):
+    """Collect keyed items and process them in batches in a background thread.
+
+    A batch is passed to func as a dictionary within an application context
+    of app, period seconds after its first item has been added or as soon as
+    it has reached max_size items. Adding an item with the key of a pending
+    item replaces the pending item.
+    """
+
+    def __init__(self, app, func, period, max_size=1000, name='batch-collector'):
+        self._app = app
+        self._func = func
+        self.period = period
+        self.max_size = max_size
+        self._condition = threading.Condition()
+        self._items = OrderedDict()
+        self._deadline = None
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, items):
+        """Add all items of a dictionary to the current batch.
+
+        Raises RuntimeError if the collector has been shut down."""
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Batch collector has been shut down.")
+            self._items.update(items)
+            if self._deadline is None:
+                self._deadline = time.monotonic() + self.period
+            self._condition.notify()
+
+    def remove(self, key):
+        """Remove a pending item. Return True if there was one."""
+        with self._condition:
+            return self._items.pop(key, None) is not None
+
+    def flush(self):
+        """Process the current batch immediately in the calling thread."""
+        with self._condition:
+            batch = self._take()
+        self._process(batch)
+
+    def shutdown(self, flush=True):
+        """Stop the background thread, process the current batch if flush is True."""
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify()
+        self._thread.join()
+        if flush:
+            self.flush()
+
+    def _take(self):
+        batch, self._items = self._items, OrderedDict()
+        self._deadline = None
+        return batch
+
+    def _process(self, batch):
+        if len(batch) == 0:
+            return
+        try:
+            with self._app.app_context():
+                self._func(batch)
+        except Exception:
+            logger.exception("Processing of batch of %d items failed.", len(batch))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._shutdown:
+                        return
+                    if len(self._items) >= self.max_size:
+                        break
+                    if self._deadline is None:
+                        self._condition.wait()
+                        continue
+                    timeout = self._deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                batch = self._take()
+            self._process(batch)
+
+
+class _Flight(object):
+    """A single call on behalf of all callers attached to it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Run at most one call per key at a time.
+
+    A call for a key with a call in flight marks the key dirty and waits
+    for the flight in progress to finish, then calls again once on behalf
+    of all callers that arrived in the meantime. These callers share the
+    result or exception of that single rerun, which is guaranteed to start
+    after each of them arrived.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = {}  # key -> flight in progress
+        self._pending = {}  # key -> flight to start once the one in progress is done
+        self.started = 0
+        self.attached = 0
+
+    def __len__(self):
+        return len(self._running)
+
+    def run(self, key, func, *args, **kwargs):
+        """Return func(*args, **kwargs), or the result of a call for key
+        started after this one has been requested."""
+        attached = False
+        with self._lock:
+            running = self._running.get(key)
+            if running is None:
+                flight = self._running[key] = _Flight()
+                self.started += 1
+            elif key in self._pending:
+                # the rerun has not started yet
+                flight = self._pending[key]
+                attached = True
+                self.attached += 1
+            else:
+                flight = self._pending[key] = _Flight()
+                self.started += 1
+
+        if attached:
+            flight.done.wait()
+        else:
+            if running is not None:
+                running.done.wait()
+                with self._lock:
+                    del self._pending[key]
+                    self._running[key] = flight
+            try:
+                flight.result = func(*args, **kwargs)
+            except Exception as exc:
+                flight.error = exc
+            finally:
+                with self._lock:
+                    if key not in self._pending:
+                        del self._running[key]
+                flight.done.set()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def to_dict(self):
+        """Return statistics."""
+        with self._lock:
+            return {
+                'in_flight': len(self._running),
+                'started': self.started,
+                'attached': self.attached,
+            }
+
+
+class KeyedLock(object):
+    """Mutual exclusion per key.
+
+    The lock of a key only exists while it is held or waited for."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}  # key -> [lock, number of holders and waiters]
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextmanager
+    def hold(self, key):
+        """Hold the lock of key within the context."""
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+def _get_extension(name, factory, shutdown):
+    """Return background processing extension of current app, create if necessary."""
+    app = current_app._get_current_object()
+    with _lock:
+        if name not in app.extensions:
+            extension = factory(app)
+            # process pending notifications on clean interpreter shutdown
+            atexit.register(shutdown, extension)
+            app.extensions[name] = extension
+    return app.extensions[name]
+
+
+def get_ingestion_queue():
+    """Return the ingestion queue of the current app, create if necessary."""
+    return _get_extension(
+        INGESTION_QUEUE_EXTENSION_NAME,
+        lambda app: IngestionQueue(app, num_workers=Config.WORKER_POOL_SIZE,
+                                   max_size=Config.QUEUE_SIZE),
+        IngestionQueue.shutdown)
+
+
+def get_debouncer():
+    """Return the timer for debouncing notifications of the current app."""
+    return _get_extension(
+        DEBOUNCER_EXTENSION_NAME,
+        lambda app: KeyedTimer(name='notification-debouncer'),
+        KeyedTimer.shutdown)
@@ -31,6 +31,9 @@ setup(
             'dtool_lookup_server_notification_plugin_elasticsearch=dtool_lookup_server_notification_plugin.elasticsearch:elastic_search_bp',
             'dtool_lookup_server_notification_plugin_webhook=dtool_lookup_server_notification_plugin.webhook:webhook_bp',
         ],
+        'flask.commands': [
+            'notification=dtool_lookup_server_notification_plugin.cli:notification_cli',
+        ],
     },
     setup_requires=['setuptools_scm'],
     install_requires=[
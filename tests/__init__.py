@@ -269,3 +269,112 @@ def access_restriction(request):
     @request.addfinalizer
     def teardown():
         Config.ALLOW_ACCESS_FROM = backup
+
+
+@pytest.fixture
+def async_processing(request):
+    from dtool_lookup_server_notification_plugin.config import Config
+
+    backup = Config.ASYNC_PROCESSING
+    Config.ASYNC_PROCESSING = True
+
+    @request.addfinalizer
+    def teardown():
+        Config.ASYNC_PROCESSING = backup
+
+
+@pytest.fixture
+def debounce_period(request):
+    from dtool_lookup_server_notification_plugin.config import Config
+
+    backup = Config.DEBOUNCE_PERIOD
+    Config.DEBOUNCE_PERIOD = 60
+
+    @request.addfinalizer
+    def teardown():
+        Config.DEBOUNCE_PERIOD = backup
+
+
+@pytest.fixture
+def deletion_batch_period(request):
+    from dtool_lookup_server_notification_plugin.config import Config
+
+    backup = Config.DELETION_BATCH_PERIOD
+    Config.DELETION_BATCH_PERIOD = 60
+
+    @request.addfinalizer
+    def teardown():
+        Config.DELETION_BATCH_PERIOD = backup
+
+
+@pytest.fixture
+def journal_path(request, tmp_dir_fixture):  # NOQA
+    from dtool_lookup_server_notification_plugin.config import Config
+
+    backup = Config.JOURNAL_PATH
+    Config.JOURNAL_PATH = os.path.join(tmp_dir_fixture, 'journal.sqlite')
+
+    @request.addfinalizer
+    def teardown():
+        Config.JOURNAL_PATH = backup
+
+    return Config.JOURNAL_PATH
+
+
+@pytest.fixture
+def deduplication(request):
+    from dtool_lookup_server_notification_plugin.webhook import dedup_cache
+
+    backup = dedup_cache.max_size
+    dedup_cache.max_size = 100
+
+    @request.addfinalizer
+    def teardown():
+        dedup_cache.max_size = backup
+        dedup_cache.clear()
+
+
+@pytest.fixture
+def profiling(request):
+    from dtool_lookup_server_notification_plugin.profile import profiler
+
+    backup = profiler.every
+    profiler.every = 1
+
+    @request.addfinalizer
+    def teardown():
+        profiler.every = backup
+        profiler.clear()
+
+
+@pytest.fixture
+def provisional_registration(request):
+    from dtool_lookup_server_notification_plugin.config import Config
+
+    backup = Config.PROVISIONAL_REGISTRATION
+    Config.PROVISIONAL_REGISTRATION = True
+
+    @request.addfinalizer
+    def teardown():
+        Config.PROVISIONAL_REGISTRATION = backup
+
+
+@pytest.fixture
+def config_file(request, tmp_dir_fixture):  # NOQA
+    from dtool_lookup_server_notification_plugin.config import Config
+
+    path = os.path.join(tmp_dir_fixture, 'config.json')
+    with open(path, 'w') as f:
+        json.dump({
+            'bucket_to_base_uri': {'tenant': 's3://tenant'},
+            'allow_access_from': ['10.0.0.0/8'],
+        }, f)
+
+    backup = (Config.CONFIG_FILE, Config.BUCKET_TO_BASE_URI, Config.ALLOW_ACCESS_FROM)
+    Config.CONFIG_FILE = path
+
+    @request.addfinalizer
+    def teardown():
+        Config.CONFIG_FILE, Config.BUCKET_TO_BASE_URI, Config.ALLOW_ACCESS_FROM = backup
+
+    return path
@@ -0,0 +1,47 @@
+"""Test the IP allow-list used to restrict access to notification routes."""
+import ipaddress
+
+from dtool_lookup_server_notification_plugin.config import IPAllowList
+
+
+def test_allow_list_multiple_networks():
+    allow_list = IPAllowList.from_string(
+        '10.0.0.0/16, 10.0.128.0/17 192.168.1.1,fd00::/8')
+
+    assert '10.0.0.1' in allow_list
+    assert '10.0.255.255' in allow_list
+    assert '10.1.0.0' not in allow_list
+    assert '192.168.1.1' in allow_list
+    assert '192.168.1.2' not in allow_list
+    assert 'fd12:3456::1' in allow_list
+    assert 'fe80::1' not in allow_list
+    assert '::ffff:10.0.0.1' in allow_list  # IPv4-mapped IPv6 address
+    assert 'not-an-address' not in allow_list
+    assert None not in allow_list
+
+    # merged intervals
+    assert allow_list._intervals[4][0] == [
+        int(ipaddress.ip_address('10.0.0.0')),
+        int(ipaddress.ip_address('192.168.1.1'))]
+
+    # cached verdicts
+    assert '10.0.0.1' in allow_list
+    assert allow_list._verdicts.hits == 1
+
+
+def test_allow_list_from_json_and_networks():
+    allow_list = IPAllowList.from_string('["1.2.3.0/24", "::1"]')
+    assert '1.2.3.4' in allow_list
+    assert '::1' in allow_list
+    assert '1.2.4.4' not in allow_list
+    assert str(allow_list) == '1.2.3.0/24,::1/128'
+
+    allow_list = IPAllowList(ipaddress.ip_network('1.2.3.4'))
+    assert '1.2.3.4' in allow_list
+    assert '127.0.0.1' not in allow_list
+    assert str(allow_list) == '1.2.3.4/32'
+
+    allow_list = IPAllowList.from_string('0.0.0.0/0')
+    assert '127.0.0.1' in allow_list
+    assert '::1' not in allow_list
+    assert str(allow_list) == '0.0.0.0/0'
@@ -0,0 +1,104 @@
+"""Test the bounded in-process caches."""
+import os
+import time
+
+from dtool_lookup_server_notification_plugin.cache import (
+    ContentCache,
+    LRUCache,
+    SequencerTable,
+)
+
+from . import tmp_dir_fixture  # NOQA
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1  # 'b' is least recently used now
+    cache.put('c', 3)
+
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+    stats = cache.to_dict()
+    assert stats['hits'] == 3
+    assert stats['misses'] == 1
+    assert stats['hit_ratio'] == 0.75
+
+
+def test_lru_cache_ttl_and_invalidation():
+    cache = LRUCache(max_size=10, ttl=0.05)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.invalidate('a')
+    assert not cache.invalidate('a')
+    assert 'a' not in cache
+    assert 'b' in cache
+
+    time.sleep(0.1)
+    assert cache.get('b') is None
+    assert len(cache) == 0
+
+
+def test_lru_cache_disabled():
+    cache = LRUCache(max_size=0)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+
+
+def test_sequencer_table_discards_older_events():
+    table = SequencerTable(max_size=2)
+
+    assert table.accept('a', '16D67651D0E38940')
+    assert table.accept('a', '16D67651D0E38940')  # same event again
+    assert not table.accept('a', '16D67651D0E3893F')
+    # shorter sequencers are padded with zeros on the right
+    assert table.accept('a', '16d67651d0e39')
+    assert not table.accept('a', '16D67651D0E38941')
+    assert table.accept('a', None)  # events without sequencer always accepted
+
+    # least recently updated key evicted
+    assert table.accept('b', '01')
+    assert table.accept('c', '01')
+    assert table.accept('a', '00')  # history of 'a' lost
+
+    assert table.to_dict() == {
+        'size': 2, 'max_size': 2, 'accepted': 6, 'discarded': 2}
+
+
+def test_content_cache(tmp_dir_fixture):  # NOQA
+    cache = ContentCache(max_bytes=10, directory=tmp_dir_fixture, max_disk_bytes=8)
+    cache.put('a', '"etag-a"', 'aaaa')
+    cache.put('b', 'etag-b', 'bbbb')
+    assert cache.lookup('a') == ('etag-a', 'aaaa', False)
+
+    # evicts least recently used 'b' to disk
+    cache.put('c', 'etag-c', 'cccc')
+    assert len(cache) == 2
+    assert cache.to_dict()['spilled'] == 1
+
+    # loaded back from disk, 'a' spilled in turn
+    cache.announce('b', 'etag-b')
+    assert cache.lookup('b') == ('etag-b', 'bbbb', True)
+    assert cache.lookup('b') == ('etag-b', 'bbbb', False)
+    assert cache.to_dict()['spilled'] == 1
+
+    # spills 'c' and 'b', dropping least recently spilled 'a' from disk
+    cache.put('d', 'etag-d', 'dddddddddd')
+    assert cache.lookup('d') == ('etag-d', 'dddddddddd', False)
+    assert cache.lookup('a') is None
+    assert cache.to_dict()['spilled_bytes'] == 8
+
+    # larger than the cache
+    cache.put('e', 'etag-e', 'eeeeeeeeeee')
+    assert cache.lookup('e') is None
+
+    cache.clear()
+    assert os.listdir(tmp_dir_fixture) == []
+
+    cache = ContentCache(max_bytes=0)
+    cache.put('a', 'etag-a', 'aaaa')
+    assert cache.lookup('a') is None
@@ -3,9 +3,23 @@
 import json
 import dtool_lookup_server_notification_plugin
 
-from . import tmp_app_with_users  # NOQA
+from . import tmp_app_with_users, config_file, tmp_dir_fixture  # NOQA
 from . import snowwhite_token
 
+OBJECT_KEY_CLASSES = {
+    "dtool": "finalizing",
+    "manifest.json": "finalizing",
+    "__REGISTRATION_KEY__": "finalizing",
+    "README.yml": "metadata",
+    "tags": "metadata",
+    "annotations": "metadata",
+    "data": "payload",
+    "overlays": "payload",
+    "fragments": "payload",
+    "structure.json": "payload",
+    "README.txt": "payload",
+}
+
 
 # these two routes yield the same result
 def test_elasticsearch_config_info_route(tmp_app_with_users):  # NOQA
@@ -19,8 +33,44 @@ def test_elasticsearch_config_info_route(tmp_app_with_users):  # NOQA
 
     expected_content = {
         "allow_access_from": "0.0.0.0/0",
+        "async_processing": False,
         "bucket_to_base_uri": {"bucket": "s3://bucket"},
-        "version": dtool_lookup_server_notification_plugin.__version__}
+        "config_file": "",
+        "config_reload_interval": 0.0,
+        "content_cache_dir": "",
+        "content_cache_disk_size": 1073741824,
+        "content_cache_size": 0,
+        "dead_letter_size": 1000,
+        "debounce_period": 0.0,
+        "dedup_cache_size": 0,
+        "dedup_cache_ttl": 600.0,
+        "deletion_batch_period": 0.0,
+        "deletion_batch_size": 1000,
+        "incremental_updates": True,
+        "journal_max_attempts": 3,
+        "journal_path": "",
+        "log_format": "text",
+        "log_max_length": 10000,
+        "object_key_classes": OBJECT_KEY_CLASSES,
+        "profile_dir": "",
+        "profile_interval": 0.001,
+        "profile_sample_rate": 0,
+        "provisional_registration": False,
+        "queue_size": 1000,
+        "reconciliation_cursor_path": "",
+        "reconciliation_interval": 0.0,
+        "reconciliation_rate": 1.0,
+        "reconciliation_slice_size": 100,
+        "registration_advisory_lock": False,
+        "retry_base_delay": 10.0,
+        "retry_max_attempts": 5,
+        "retry_max_delay": 600.0,
+        "s3_client_pooling": True,
+        "sequencer_table_size": 10000,
+        "uri_cache_size": 10000,
+        "uri_cache_ttl": 300.0,
+        "version": dtool_lookup_server_notification_plugin.__version__,
+        "worker_pool_size": 4}
 
     response = json.loads(r.data.decode("utf-8"))
     assert response == expected_content
@@ -37,8 +87,125 @@ def test_webhook_config_info_route(tmp_app_with_users):  # NOQA
 
     expected_content = {
         "allow_access_from": "0.0.0.0/0",
+        "async_processing": False,
         "bucket_to_base_uri": {"bucket": "s3://bucket"},
-        "version": dtool_lookup_server_notification_plugin.__version__}
+        "config_file": "",
+        "config_reload_interval": 0.0,
+        "content_cache_dir": "",
+        "content_cache_disk_size": 1073741824,
+        "content_cache_size": 0,
+        "dead_letter_size": 1000,
+        "debounce_period": 0.0,
+        "dedup_cache_size": 0,
+        "dedup_cache_ttl": 600.0,
+        "deletion_batch_period": 0.0,
+        "deletion_batch_size": 1000,
+        "incremental_updates": True,
+        "journal_max_attempts": 3,
+        "journal_path": "",
+        "log_format": "text",
+        "log_max_length": 10000,
+        "object_key_classes": OBJECT_KEY_CLASSES,
+        "profile_dir": "",
+        "profile_interval": 0.001,
+        "profile_sample_rate": 0,
+        "provisional_registration": False,
+        "queue_size": 1000,
+        "reconciliation_cursor_path": "",
+        "reconciliation_interval": 0.0,
+        "reconciliation_rate": 1.0,
+        "reconciliation_slice_size": 100,
+        "registration_advisory_lock": False,
+        "retry_base_delay": 10.0,
+        "retry_max_attempts": 5,
+        "retry_max_delay": 600.0,
+        "s3_client_pooling": True,
+        "sequencer_table_size": 10000,
+        "uri_cache_size": 10000,
+        "uri_cache_ttl": 300.0,
+        "version": dtool_lookup_server_notification_plugin.__version__,
+        "worker_pool_size": 4}
 
     response = json.loads(r.data.decode("utf-8"))
     assert response == expected_content
+
+
+# these two routes yield the same result
+def test_elasticsearch_stats_route(tmp_app_with_users):  # NOQA
+
+    headers = dict(Authorization="Bearer " + snowwhite_token)
+    r = tmp_app_with_users.get(
+        "/elastic-search/stats",
+        headers=headers,
+    )
+    assert r.status_code == 200
+
+    response = json.loads(r.data.decode("utf-8"))
+    assert set(response["object_key_classes"].keys()) == {
+        "finalizing", "metadata", "payload"}
+
+
+def test_webhook_stats_route(tmp_app_with_users):  # NOQA
+
+    headers = dict(Authorization="Bearer " + snowwhite_token)
+    r = tmp_app_with_users.get(
+        "/webhook/stats",
+        headers=headers,
+    )
+    assert r.status_code == 200
+
+    response = json.loads(r.data.decode("utf-8"))
+    assert set(response["object_key_classes"].keys()) == {
+        "finalizing", "metadata", "payload"}
+
+
+def test_elasticsearch_stats_route_requires_admin(tmp_app_with_users):  # NOQA
+    from dtool_lookup_server.utils import update_users
+
+    update_users([{'username': 'snow-white', 'is_admin': False}])
+    r = tmp_app_with_users.get(
+        "/elastic-search/stats",
+        headers=dict(Authorization="Bearer " + snowwhite_token),
+    )
+    assert r.status_code == 403
+
+
+def test_webhook_stats_route_requires_admin(tmp_app_with_users):  # NOQA
+    from dtool_lookup_server.utils import update_users
+
+    update_users([{'username': 'snow-white', 'is_admin': False}])
+    r = tmp_app_with_users.get(
+        "/webhook/stats",
+        headers=dict(Authorization="Bearer " + snowwhite_token),
+    )
+    assert r.status_code == 403
+
+
+def test_webhook_config_reload_route(tmp_app_with_users, config_file):  # NOQA
+    from dtool_lookup_server_notification_plugin.config import Config
+
+    headers = dict(Authorization="Bearer " + snowwhite_token)
+    r = tmp_app_with_users.post(
+        "/webhook/config/reload",
+        headers=headers,
+    )
+    assert r.status_code == 200
+
+    response = json.loads(r.data.decode("utf-8"))
+    assert response["bucket_to_base_uri"] == {"tenant": "s3://tenant"}
+    assert response["allow_access_from"] == "10.0.0.0/8"
+
+    # an invalid file keeps the current configuration
+    with open(config_file, "w") as f:
+        f.write("{")
+    r = tmp_app_with_users.post(
+        "/elastic-search/config/reload",
+        headers=headers,
+    )
+    assert r.status_code == 500
+    assert Config.bucket_index() == {"tenant": "s3://tenant"}
+
+
+def test_config_reload_route_requires_authentication(tmp_app_with_users):  # NOQA
+    r = tmp_app_with_users.post("/webhook/config/reload")
+    assert r.status_code == 401
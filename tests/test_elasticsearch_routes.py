@@ -1,7 +1,10 @@
 """Test the /elastic-search/notify/* blueprint routes."""
+import json
 import os
 import yaml
 
+import dtoolcore
+
 from dtoolcore import ProtoDataSet, generate_admin_metadata
 from dtoolcore import DataSet
 from dtoolcore.utils import generate_identifier, sanitise_uri
@@ -13,15 +16,27 @@ from dtool_lookup_server.utils import (
     register_base_uri,
     update_permissions,
 )
-from dtool_lookup_server_notification_plugin import Config
+from dtool_lookup_server_notification_plugin import Config, get_deletion_batcher
+from dtool_lookup_server_notification_plugin.elasticsearch import provisional_counters
+from dtool_lookup_server_notification_plugin.worker import (
+    INGESTION_QUEUE_EXTENSION_NAME,
+    get_ingestion_queue,
+)
 
 from . import (
     access_restriction,
+    async_processing,
+    deletion_batch_period,
+    provisional_registration,
     tmp_app_with_users,
     tmp_dir_fixture,
     TEST_SAMPLE_DATA
 ) # NOQA
 
+GONE_UUID = '1a1f9fad-8589-413e-9602-5bbd66bfe675'
+OTHER_GONE_UUID = '8ecd8e05-558a-48e2-b5c5-6ed4dd1f4b6f'
+
+
 def test_elasticsearch_notify_route(tmp_app_with_users, tmp_dir_fixture):  # NOQA
     bucket_name = 'bucket'
 
@@ -129,3 +144,267 @@ def test_elasticsearch_access_restriction(tmp_app_with_users, access_restriction
         "/elastic-search/notify/all/test_access_restriction"
     )
     assert r.status_code == 403  # Forbidden
+
+
+def test_elasticsearch_bulk_route(tmp_app_with_users, tmp_dir_fixture):  # NOQA
+    bucket_name = 'bucket'
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    admin_metadata = []
+    for i in range(2):
+        proto_dataset = dtoolcore.create_proto_dataset(
+            'dataset-{}'.format(i), base_uri, readme_content='index: {}'.format(i),
+            creator_username='snow-white')
+        proto_dataset.freeze()
+        admin_metadata.append(DataSet.from_uri(proto_dataset.uri)._admin_metadata)
+
+    def objpath(i, key):
+        return '{}_{}/{}'.format(bucket_name, admin_metadata[i]['uuid'], key)
+
+    lines = []
+    for i in range(2):
+        lines.append({'index': {'_index': 'notify', '_type': 'all', '_id': objpath(i, 'dtool')}})
+        lines.append({'bucket': bucket_name, 'metadata': admin_metadata[i]})
+    lines.append({'index': {'_index': 'notify', '_type': 'all', '_id': objpath(0, 'data/tiny.png')}})
+    lines.append({'bucket': bucket_name, 'key': 'data/tiny.png'})
+    lines.append({'delete': {'_index': 'notify', '_type': 'all',
+                             '_id': '{}_{}/dtool'.format(bucket_name, GONE_UUID)}})
+    r = tmp_app_with_users.post(
+        "/elastic-search/_bulk",
+        data=''.join(json.dumps(line) + '\n' for line in lines),
+        content_type='application/x-ndjson')
+    assert r.status_code == 200
+
+    response = json.loads(r.data.decode("utf-8"))
+    assert not response['errors']
+    assert [(action, item['status'], item['result'])
+            for result in response['items'] for action, item in result.items()] == [
+        ('index', 200, 'updated'),
+        ('index', 200, 'updated'),
+        ('index', 200, 'noop'),
+        ('delete', 404, 'not_found'),
+    ]
+    assert response['items'][0]['index']['_id'] == objpath(0, 'dtool')
+
+    datasets = list_datasets_by_user('snow-white')
+    assert len(datasets) == 2
+
+    # deletion and malformed request
+    r = tmp_app_with_users.post(
+        "/elastic-search/notify/_bulk",
+        data=json.dumps({'delete': {'_id': objpath(0, 'dtool')}}) + '\n',
+        content_type='application/x-ndjson')
+    assert r.status_code == 200
+    response = json.loads(r.data.decode("utf-8"))
+    assert response['items'] == [{'delete': {
+        '_index': 'notify', '_type': '_doc', '_id': objpath(0, 'dtool'),
+        'status': 200, 'result': 'deleted'}}]
+    assert [dataset['uuid'] for dataset in list_datasets_by_user('snow-white')] == [
+        admin_metadata[1]['uuid']]
+
+    r = tmp_app_with_users.post(
+        "/elastic-search/_bulk", data='{"index": \n',
+        content_type='application/x-ndjson')
+    assert r.status_code == 400
+
+
+def test_elasticsearch_bulk_route_item_errors(tmp_app_with_users, tmp_dir_fixture,
+                                              monkeypatch):  # NOQA
+    import dtool_lookup_server_notification_plugin.elasticsearch as elasticsearch
+
+    bucket_name = 'bucket'
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+    Config.BUCKET_TO_BASE_URI['unregistered'] = 's3://unregistered'
+
+    uuids = []
+    uris = []
+    for i in range(2):
+        proto_dataset = dtoolcore.create_proto_dataset(
+            'dataset-{}'.format(i), base_uri, readme_content='index: {}'.format(i),
+            creator_username='snow-white')
+        proto_dataset.freeze()
+        admin_metadata = DataSet.from_uri(proto_dataset.uri)._admin_metadata
+        r = tmp_app_with_users.post(
+            "/elastic-search/notify/all/{}_{}/dtool".format(bucket_name, admin_metadata['uuid']),
+            json={'bucket': bucket_name, 'metadata': admin_metadata},
+        )
+        assert r.status_code == 200
+        uuids.append(admin_metadata['uuid'])
+        uris.append(proto_dataset.uri)
+        DataSet.from_uri(proto_dataset.uri).put_readme('index: {}'.format(i + 2))
+
+    retrieve_uris = elasticsearch._retrieve_uris
+    lookups = []
+
+    def counting_retrieve_uris(datasets):
+        lookups.append(list(datasets))
+        return retrieve_uris(datasets)
+
+    monkeypatch.setattr(elasticsearch, '_retrieve_uris', counting_retrieve_uris)
+
+    def post(lines):
+        r = tmp_app_with_users.post(
+            "/elastic-search/_bulk",
+            data=''.join(json.dumps(line) + '\n' for line in lines),
+            content_type='application/x-ndjson')
+        assert r.status_code == 200
+        return json.loads(r.data.decode("utf-8"))
+
+    # all metadata updates resolve with a single lookup
+    lines = []
+    for uuid in uuids:
+        lines.append({'index': {'_id': '{}_{}/README.yml'.format(bucket_name, uuid)}})
+        lines.append({'key': 'README.yml'})
+    response = post(lines)
+    assert not response['errors']
+    assert len(lookups) == 1
+    assert [get_readme_from_uri_by_user('snow-white', uri) for uri in uris] == \
+        [{'index': 2}, {'index': 3}]
+
+    # objects of unknown buckets and unregistered base URIs fail on their own
+    lines = []
+    for bucket in ['unknown', 'unregistered']:
+        lines.append({'index': {'_id': '{}_{}/README.yml'.format(bucket, GONE_UUID)}})
+        lines.append({'key': 'README.yml'})
+        lines.append({'delete': {'_id': '{}_{}/dtool'.format(bucket, OTHER_GONE_UUID)}})
+    lines.append({'delete': {'_id': '{}_{}/dtool'.format(bucket_name, uuids[0])}})
+    response = post(lines)
+    assert response['errors']
+    assert [(action, item['status'], item.get('result'))
+            for result in response['items'] for action, item in result.items()] == [
+        ('index', 400, None),
+        ('delete', 400, None),
+        ('index', 400, None),
+        ('delete', 400, None),
+        ('delete', 200, 'deleted'),
+    ]
+    assert [dataset['uuid'] for dataset in list_datasets_by_user('snow-white')] == [uuids[1]]
+
+
+def test_elasticsearch_batched_deletion(tmp_app_with_users, tmp_dir_fixture,
+                                        deletion_batch_period):  # NOQA
+    bucket_name = 'bucket'
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    proto_dataset = dtoolcore.create_proto_dataset(
+        'dataset', base_uri, creator_username='snow-white')
+    proto_dataset.freeze()
+    admin_metadata = DataSet.from_uri(proto_dataset.uri)._admin_metadata
+    r = tmp_app_with_users.post(
+        "/elastic-search/notify/all/{}_{}/dtool".format(bucket_name, admin_metadata['uuid']),
+        json={'bucket': bucket_name, 'metadata': admin_metadata},
+    )
+    assert r.status_code == 200
+    assert len(list_datasets_by_user('snow-white')) == 1
+
+    # a dataset never indexed is not collected
+    for uuid in [GONE_UUID, admin_metadata['uuid']]:
+        r = tmp_app_with_users.delete(
+            "/elastic-search/notify/all/{}_{}/dtool".format(bucket_name, uuid))
+        assert r.status_code == 200
+
+    deletion_batcher = get_deletion_batcher()
+    assert len(deletion_batcher) == 1
+    deletion_batcher.flush()
+    assert len(list_datasets_by_user('snow-white')) == 0
+
+
+def test_elasticsearch_provisional_registration(
+        tmp_app_with_users, tmp_dir_fixture, provisional_registration):  # NOQA
+    bucket_name = 'bucket'
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    proto_dataset = dtoolcore.create_proto_dataset(
+        'provisional', base_uri, readme_content='abc: def',
+        creator_username='snow-white')
+    proto_dataset.freeze()
+    admin_metadata = DataSet.from_uri(proto_dataset.uri)._admin_metadata
+    # S3 reports the admin metadata as strings
+    admin_metadata = {k: str(v) for k, v in admin_metadata.items()}
+
+    provisional_counters.reset()
+    r = tmp_app_with_users.post(
+        "/elastic-search/notify/all/{}_{}/dtool".format(bucket_name, admin_metadata['uuid']),
+        json={'bucket': bucket_name, 'metadata': admin_metadata},
+    )
+    assert r.status_code == 200
+    datasets = list_datasets_by_user('snow-white')
+    assert [dataset['uri'] for dataset in datasets] == [proto_dataset.uri]
+
+    # completed synchronously without starting background workers
+    assert get_readme_from_uri_by_user('snow-white', proto_dataset.uri) == {'abc': 'def'}
+    assert provisional_counters.to_dict() == {'registered': 1, 'completed': 1}
+    assert INGESTION_QUEUE_EXTENSION_NAME not in tmp_app_with_users.application.extensions
+
+    # registered already, not provisionally again
+    r = tmp_app_with_users.post(
+        "/elastic-search/notify/all/{}_{}/dtool".format(bucket_name, admin_metadata['uuid']),
+        json={'bucket': bucket_name, 'metadata': admin_metadata},
+    )
+    assert r.status_code == 200
+    assert provisional_counters['registered'] == 1
+
+
+def test_elasticsearch_provisional_registration_async(
+        tmp_app_with_users, tmp_dir_fixture, provisional_registration,
+        async_processing, deletion_batch_period):  # NOQA
+    bucket_name = 'bucket'
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    proto_dataset = dtoolcore.create_proto_dataset(
+        'provisional', base_uri, readme_content='abc: def',
+        creator_username='snow-white')
+    proto_dataset.freeze()
+    admin_metadata = DataSet.from_uri(proto_dataset.uri)._admin_metadata
+    admin_metadata = {k: str(v) for k, v in admin_metadata.items()}
+
+    # a deletion collected before must not remove the provisional entry
+    deletion_batcher = get_deletion_batcher()
+    deletion_batcher.add({(base_uri, admin_metadata['uuid']): proto_dataset.uri})
+
+    provisional_counters.reset()
+    r = tmp_app_with_users.post(
+        "/elastic-search/notify/all/{}_{}/dtool".format(bucket_name, admin_metadata['uuid']),
+        json={'bucket': bucket_name, 'metadata': admin_metadata},
+    )
+    assert r.status_code == 200
+    assert len(deletion_batcher) == 0
+
+    get_ingestion_queue().join()
+    assert get_readme_from_uri_by_user('snow-white', proto_dataset.uri) == {'abc': 'def'}
+    assert provisional_counters.to_dict() == {'registered': 1, 'completed': 1}
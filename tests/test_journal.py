@@ -0,0 +1,162 @@
+"""Test the durable event journal."""
+import os
+import threading
+import time
+
+import pytest
+
+from flask import Flask
+
+from dtool_lookup_server_notification_plugin.config import Config
+from dtool_lookup_server_notification_plugin.journal import (
+    EventJournal,
+    abandoned_journal_paths,
+    replay_journal,
+)
+
+from . import tmp_dir_fixture  # NOQA
+
+EVENT_DATA = {'bucket': {'name': 'test-bucket'},
+              'object': {'key': '1a1f9fad-8589-413e-9602-5bbd66bfe675/dtool'}}
+
+
+def test_journal_append_acknowledge_and_reopen(tmp_dir_fixture):  # NOQA
+    path = os.path.join(tmp_dir_fixture, 'journal.sqlite')
+    journal = EventJournal(path)
+
+    ids = journal.append([('s3:ObjectCreated:Put', EVENT_DATA),
+                          ('s3:ObjectRemoved:Delete', EVENT_DATA)])
+    assert len(ids) == 2
+    assert len(journal) == 2
+
+    journal.acknowledge(ids[:1])
+    journal.close()
+
+    # unacknowledged events survive a restart
+    journal = EventJournal(path)
+    assert journal.unfinished() == [
+        (ids[1], 0, 's3:ObjectRemoved:Delete', EVENT_DATA)]
+    journal.close()
+
+
+def test_journal_concurrent_appends(tmp_dir_fixture):  # NOQA
+    journal = EventJournal(os.path.join(tmp_dir_fixture, 'journal.sqlite'))
+    ids = []
+    lock = threading.Lock()
+
+    def append(i):
+        new_ids = journal.append([('s3:ObjectCreated:Put', dict(EVENT_DATA, i=i))])
+        with lock:
+            ids.extend(new_ids)
+
+    threads = [threading.Thread(target=append, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(ids)) == 20
+    assert sorted(entry[3]['i'] for entry in journal.unfinished()) == list(range(20))
+    journal.close()
+
+
+def test_journal_group_commit(tmp_dir_fixture):  # NOQA
+    group_sizes = []
+
+    class SlowJournal(EventJournal):
+        def _commit(self, group):
+            group_sizes.append(len(group))
+            time.sleep(0.01)  # operations arriving meanwhile form the next group
+            super()._commit(group)
+
+    journal = SlowJournal(os.path.join(tmp_dir_fixture, 'journal.sqlite'))
+    threads = [threading.Thread(
+        target=journal.append,
+        args=([('s3:ObjectCreated:Put', dict(EVENT_DATA, i=i))],)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(group_sizes) == 16
+    assert max(group_sizes) > 1
+    assert len(group_sizes) < 16
+    assert len(journal) == 16
+    journal.close()
+
+
+def test_replay_journal(tmp_dir_fixture):  # NOQA
+    path = os.path.join(tmp_dir_fixture, 'journal.sqlite')
+    journal = EventJournal(path)
+    journal.append([('s3:ObjectCreated:Put', dict(EVENT_DATA, i=i)) for i in range(3)])
+    journal.close()
+
+    processed = []
+
+    def process(events):
+        for event_name, event_data in events:
+            if event_data['i'] == 1:
+                raise ValueError("Processing failed.")
+            processed.append(event_data['i'])
+
+    journal_path = Config.JOURNAL_PATH
+    Config.JOURNAL_PATH = path
+    try:
+        for _ in range(Config.JOURNAL_MAX_ATTEMPTS + 1):
+            # every replay is a fresh start of the server
+            with Flask(__name__).app_context():
+                replay_journal(process)
+    finally:
+        Config.JOURNAL_PATH = journal_path
+
+    # failing event retried until discarded, others processed exactly once
+    assert processed == [0, 2]
+    journal = EventJournal(path)
+    assert len(journal) == 0
+    journal.close()
+
+
+def test_journal_acknowledges_earlier_deliveries(tmp_dir_fixture):  # NOQA
+    journal = EventJournal(os.path.join(tmp_dir_fixture, 'journal.sqlite'))
+
+    # a failed delivery and its successful redelivery
+    failed_ids = journal.append([('s3:ObjectRemoved:Delete', EVENT_DATA)], keys=['event'])
+    ids = journal.append([('s3:ObjectRemoved:Delete', EVENT_DATA)], keys=['event'])
+    other_ids = journal.append([('s3:ObjectCreated:Put', EVENT_DATA)] * 2)
+    journal.acknowledge(ids + other_ids[:1])
+
+    # events without key are not related to each other
+    assert [entry[0] for entry in journal.unfinished()] == other_ids[1:]
+    assert failed_ids[0] < ids[0]
+    journal.close()
+
+
+def test_replay_journal_of_stopped_processes_only(tmp_dir_fixture):  # NOQA
+    path = os.path.join(tmp_dir_fixture, 'journal.sqlite')
+    running = EventJournal(path + '.1.running')
+    running.append([('s3:ObjectCreated:Put', dict(EVENT_DATA, i=0))])
+    stopped = EventJournal(path + '.2.stopped')
+    stopped.append([('s3:ObjectCreated:Put', dict(EVENT_DATA, i=1))])
+    stopped.close()
+
+    # a journal is owned by the process that has opened it
+    with pytest.raises(BlockingIOError):
+        EventJournal(path + '.1.running')
+
+    processed = []
+
+    def process(events):
+        processed.extend(event_data['i'] for _, event_data in events)
+
+    journal_path = Config.JOURNAL_PATH
+    Config.JOURNAL_PATH = path
+    try:
+        with Flask(__name__).app_context():
+            assert replay_journal(process) == 1
+            assert processed == [1]
+            assert abandoned_journal_paths() == [path + '.1.running']
+    finally:
+        Config.JOURNAL_PATH = journal_path
+
+    assert len(running) == 1
+    running.close()
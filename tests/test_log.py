@@ -0,0 +1,51 @@
+"""Test deferred serialization of logged payloads."""
+import json
+import logging
+
+from dtool_lookup_server_notification_plugin import Config
+from dtool_lookup_server_notification_plugin.log import JSONFormatter, LazyJSON
+
+
+class _CountingObject(object):
+    """Count how often the object has been converted to str."""
+    count = 0
+
+    def __str__(self):
+        _CountingObject.count += 1
+        return 'counted'
+
+
+def test_lazy_json_serialized_only_if_level_enabled(caplog):
+    logger = logging.getLogger('test_lazy_json')
+    payload = {'Records': [{'obj': _CountingObject()}]}
+
+    with caplog.at_level(logging.INFO, logger='test_lazy_json'):
+        logger.debug("Payload: %s", LazyJSON(payload))
+    assert _CountingObject.count == 0
+
+    with caplog.at_level(logging.DEBUG, logger='test_lazy_json'):
+        logger.debug("Payload: %s", LazyJSON(payload))
+    assert _CountingObject.count > 0
+    assert '"obj": "counted"' in caplog.text
+
+
+def test_lazy_json_truncation():
+    backup = Config.LOG_MAX_LENGTH
+    Config.LOG_MAX_LENGTH = 10
+    try:
+        s = str(LazyJSON(['a' * 100]))
+    finally:
+        Config.LOG_MAX_LENGTH = backup
+    assert s.startswith('[\n  "aaaaa')
+    assert s.endswith('... (98 characters truncated)')
+
+
+def test_json_formatter():
+    record = logging.LogRecord('test', logging.INFO, __file__, 1,
+                               "Payload: %s", (LazyJSON({'a': 1}),), None)
+    s = JSONFormatter().format(record)
+    assert '\n' not in s
+    entry = json.loads(s)
+    assert entry['level'] == 'INFO'
+    assert entry['logger'] == 'test'
+    assert entry['message'].startswith('Payload: {')
@@ -0,0 +1,69 @@
+"""Test metrics in Prometheus text exposition format."""
+import threading
+
+import pytest
+
+from dtool_lookup_server_notification_plugin.metrics import MetricsRegistry
+
+
+def test_counter_aggregated_over_threads():
+    registry = MetricsRegistry()
+    counter = registry.counter('events_total', 'Events.', ['event_name'])
+
+    def count():
+        for _ in range(1000):
+            counter.inc('put')
+
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc('delete', value=2)
+
+    text = registry.collect()
+    assert '# TYPE dtool_lookup_server_notification_events_total counter' in text
+    assert 'dtool_lookup_server_notification_events_total{event_name="put"} 4000' in text
+    assert 'dtool_lookup_server_notification_events_total{event_name="delete"} 2' in text
+
+    # metrics of finished threads are retained
+    assert registry.collect() == text
+    assert len(registry._shards) == 1
+
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_histogram():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('duration_seconds', 'Duration.', ['stage'],
+                                   buckets=(0.1, 1))
+    histogram.observe(0.05, 'parse')
+    histogram.observe(0.1, 'parse')
+    histogram.observe(5, 'parse')
+
+    lines = registry.collect().splitlines()
+    assert lines[2:] == [
+        'dtool_lookup_server_notification_duration_seconds_bucket{stage="parse",le="0.1"} 2',
+        'dtool_lookup_server_notification_duration_seconds_bucket{stage="parse",le="1.0"} 2',
+        'dtool_lookup_server_notification_duration_seconds_bucket{stage="parse",le="+Inf"} 3',
+        'dtool_lookup_server_notification_duration_seconds_sum{stage="parse"} 5.15',
+        'dtool_lookup_server_notification_duration_seconds_count{stage="parse"} 3',
+    ]
+
+
+def test_stage_counts_errors():
+    from dtool_lookup_server_notification_plugin.metrics import metrics, stage
+
+    @stage('test_stage')
+    def fail():
+        raise KeyError('missing')
+
+    with pytest.raises(KeyError):
+        fail()
+
+    text = metrics.collect()
+    assert 'dtool_lookup_server_notification_errors_total' \
+           '{stage="test_stage",error="KeyError"} 1' in text
+    assert 'dtool_lookup_server_notification_stage_duration_seconds_count' \
+           '{stage="test_stage"} 1' in text
@@ -1,6 +1,10 @@
 """Test conversion of URL to base URI and UUID"""
 
-from dtool_lookup_server_notification_plugin import Config, _parse_objpath
+from dtool_lookup_server_notification_plugin import (
+    Config,
+    ObjectKeyClassifier,
+    _parse_objpath,
+)
 
 
 def test_parse_objpath():
@@ -41,4 +45,58 @@ def test_parse_objpath():
         'frct-simdata_dtool-f8784b1e-ba60-4200-baa7-397856fe83ec')
     assert base_uri == my_base_uri
     assert uuid == 'f8784b1e-ba60-4200-baa7-397856fe83ec'
-    assert kind == '__REGISTRATION_KEY__'
\ No newline at end of file
+    assert kind == '__REGISTRATION_KEY__'
+
+
+def test_classify_obj_key():
+    classifier = ObjectKeyClassifier()
+    prefix = 'u/lp1029/6ea79d31-f100-486a-9e78-c5b609cb35de'
+
+    assert classifier.classify(f'{prefix}/dtool') == 'finalizing'
+    assert classifier.classify(f'{prefix}/manifest.json') == 'finalizing'
+    assert classifier.classify('dtool-6ea79d31-f100-486a-9e78-c5b609cb35de') == 'finalizing'
+    assert classifier.classify(f'{prefix}/README.yml') == 'metadata'
+    assert classifier.classify(f'{prefix}/tags/my-tag') == 'metadata'
+    assert classifier.classify(f'{prefix}/annotations/test_annotation.json') == 'metadata'
+    assert classifier.classify(f'{prefix}/data/18a3e253316409e313493b853f42f3f95243c404') == 'payload'
+    assert classifier.classify(f'{prefix}/overlays/is_png.json') == 'payload'
+    assert classifier.classify(f'{prefix}/fragments/18a3e253316409e313493b853f42f3f95243c404.is_png.json') == 'payload'
+    assert classifier.classify(f'{prefix}/unknown_kind') == 'finalizing'
+
+    assert classifier.to_dict() == {'finalizing': 4, 'metadata': 3, 'payload': 3}
+
+
+def test_parse_objpath_longest_prefix():
+    Config.BUCKET_TO_BASE_URI = {
+        'data': 's3://data',
+        'data-archive': 's3://data-archive',
+        'data_archive': 's3://data_archive',
+    }
+
+    base_uri, uuid, kind = _parse_objpath(
+        'data-archive_6ea79d31-f100-486a-9e78-c5b609cb35de/dtool')
+    assert base_uri == 's3://data-archive'
+    assert uuid == '6ea79d31-f100-486a-9e78-c5b609cb35de'
+    assert kind == 'dtool'
+
+    base_uri, uuid, kind = _parse_objpath(
+        'data_6ea79d31-f100-486a-9e78-c5b609cb35de/dtool')
+    assert base_uri == 's3://data'
+
+    base_uri, uuid, kind = _parse_objpath(
+        'data_archive_6ea79d31-f100-486a-9e78-c5b609cb35de/dtool')
+    assert base_uri == 's3://data_archive'
+    assert uuid == '6ea79d31-f100-486a-9e78-c5b609cb35de'
+
+    # index follows modifications of the configuration
+    Config.BUCKET_TO_BASE_URI['data-archive-2024'] = 's3://data-archive-2024'
+    base_uri, uuid, kind = _parse_objpath(
+        'data-archive-2024_6ea79d31-f100-486a-9e78-c5b609cb35de/dtool')
+    assert base_uri == 's3://data-archive-2024'
+
+    del Config.BUCKET_TO_BASE_URI['data-archive-2024']
+    base_uri, uuid, kind = _parse_objpath(
+        'data-archive-2024_6ea79d31-f100-486a-9e78-c5b609cb35de/dtool')
+    assert base_uri is None
+    assert uuid is None
+    assert kind is None
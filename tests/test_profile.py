@@ -0,0 +1,63 @@
+"""Test sampling of call stacks."""
+import os
+import time
+
+from dtool_lookup_server_notification_plugin.profile import StackSampler
+
+from . import tmp_dir_fixture  # NOQA
+
+
+def inner():
+    time.sleep(0.05)
+
+
+def outer():
+    inner()
+    return 'done'
+
+
+def test_stack_sampler(tmp_dir_fixture):  # NOQA
+    sampler = StackSampler(every=2, interval=0.001, directory=tmp_dir_fixture)
+    for _ in range(4):
+        if sampler.should_sample():
+            assert sampler.run('test', outer) == 'done'
+        else:
+            assert outer() == 'done'
+
+    stats = sampler.to_dict()
+    assert stats['sampled_calls'] == 2
+    assert stats['samples']['test'] > 0
+
+    collapsed = sampler.collapsed()
+    assert collapsed == sampler.collapsed('test')
+    assert collapsed.startswith('test;tests.test_profile:outer;tests.test_profile:inner ')
+    with open(os.path.join(tmp_dir_fixture, 'test.collapsed')) as f:
+        assert f.read() == collapsed
+
+    sampler.clear()
+    assert sampler.collapsed() == ''
+
+
+def test_stack_sampler_disabled():
+    sampler = StackSampler(every=0)
+    assert not any(sampler.should_sample() for _ in range(10))
+
+
+def test_stack_sampler_counts_calls_per_name():
+    sampler = StackSampler(every=2, interval=0.001)
+
+    def notify():
+        # nested calls neither count nor sample
+        assert not sampler.should_sample('process')
+        return 'done'
+
+    sampled = []
+    for _ in range(4):
+        if sampler.should_sample('notify'):
+            sampled.append(sampler.run('notify', notify))
+        else:
+            sampled.append(None)
+        # calls of another name do not affect the rate of notify
+        sampler.should_sample('process')
+
+    assert sampled == [None, 'done', None, 'done']
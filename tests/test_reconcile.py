@@ -0,0 +1,245 @@
+"""Test reconciliation of the index with the storage."""
+import datetime
+import os
+
+import dtoolcore
+
+from flask import Flask
+
+from dtoolcore.utils import sanitise_uri
+
+from dtool_lookup_server import mongo, sql_db, MONGO_COLLECTION
+from dtool_lookup_server.sql_models import BaseURI, Dataset
+from dtool_lookup_server.utils import (
+    list_datasets_by_user,
+    register_base_uri,
+    update_permissions,
+)
+
+from dtool_lookup_server_notification_plugin import _register_dataset_from_uri
+from dtool_lookup_server_notification_plugin.cli import notification_cli
+from dtool_lookup_server_notification_plugin import reconcile
+from dtool_lookup_server_notification_plugin.config import Config
+from dtool_lookup_server_notification_plugin.reconcile import (
+    CursorStore,
+    PeriodicReconciler,
+    reconcile_dataset,
+    reconcile_slice,
+)
+
+from . import tmp_app_with_users, tmp_dir_fixture, TEST_SAMPLE_DATA  # NOQA
+
+GONE_UUID = '1a1f9fad-8589-413e-9602-5bbd66bfe675'
+
+
+def _add_gone_entry(base_uri, name='gone', uuid=GONE_UUID):
+    sql_db.session.add(Dataset(
+        uri=base_uri + '/' + name,
+        base_uri_id=BaseURI.query.filter_by(base_uri=base_uri).first().id,
+        uuid=uuid, name=name, creator_username='snow-white',
+        frozen_at=datetime.datetime.now(), created_at=datetime.datetime.now()))
+    sql_db.session.commit()
+
+
+def test_reconcile_command(tmp_app_with_users, tmp_dir_fixture):  # NOQA
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+
+    uris = []
+    for i in range(4):
+        proto_dataset = dtoolcore.create_proto_dataset(
+            'dataset-{}'.format(i), base_uri, creator_username='snow-white')
+        if i < 3:
+            proto_dataset.freeze()
+        uris.append(proto_dataset.uri)
+
+    # up to date, outdated and missing entries
+    _register_dataset_from_uri(uris[0], base_uri)
+    _register_dataset_from_uri(uris[1], base_uri)
+    mongo.db[MONGO_COLLECTION].update_one(
+        {'uri': uris[1]}, {'$set': {'manifest_signature': 'outdated'}})
+
+    # entry of a dataset not present anymore
+    _add_gone_entry(base_uri)
+
+    runner = tmp_app_with_users.application.test_cli_runner()
+
+    result = runner.invoke(notification_cli, ['reconcile', '--dry-run', base_uri])
+    assert result.exit_code == 0
+    assert len(list_datasets_by_user('snow-white')) == 3
+
+    result = runner.invoke(notification_cli, ['reconcile', '--workers', '2', base_uri])
+    assert result.exit_code == 0
+    assert 'Registered: {}'.format(uris[2]) in result.output
+    assert 'Updated: {}'.format(uris[1]) in result.output
+    assert 'Deleted: {}/gone'.format(base_uri) in result.output
+    assert 'Incomplete: {}'.format(uris[3]) in result.output
+
+    datasets = list_datasets_by_user('snow-white')
+    assert sorted(dataset['uri'] for dataset in datasets) == sorted(uris[:3])
+
+    # nothing left to do
+    result = runner.invoke(notification_cli, ['reconcile', base_uri])
+    assert result.exit_code == 0
+    assert '3 unchanged, 0 registered, 0 updated, 0 deleted' in result.output
+
+
+def test_reconcile_unregistered_base_uri(tmp_app_with_users):  # NOQA
+    runner = tmp_app_with_users.application.test_cli_runner()
+    result = runner.invoke(notification_cli, ['reconcile', 's3://unknown'])
+    assert result.exit_code == 1
+
+
+def test_reconcile_slices(tmp_app_with_users, tmp_dir_fixture):  # NOQA
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+
+    uris = []
+    for i in range(5):
+        proto_dataset = dtoolcore.create_proto_dataset(
+            'dataset-{}'.format(i), base_uri, creator_username='snow-white')
+        proto_dataset.freeze()
+        uris.append(proto_dataset.uri)
+    _add_gone_entry(base_uri)
+
+    outcomes = {}
+    cursors = []
+    cursor = None
+    while True:
+        cursor = reconcile_slice(base_uri, start_after=cursor, slice_size=2,
+                                 callback=outcomes.__setitem__)
+        cursors.append(cursor)
+        if cursor is None:
+            break
+
+    assert cursors == [uris[1], uris[3], None]
+    assert outcomes == dict({uri: 'registered' for uri in uris},
+                            **{base_uri + '/gone': 'deleted'})
+
+    datasets = list_datasets_by_user('snow-white')
+    assert sorted(dataset['uri'] for dataset in datasets) == uris
+
+    # resumes after the cursor
+    outcomes.clear()
+    assert reconcile_slice(base_uri, start_after=uris[3], slice_size=2,
+                           callback=outcomes.__setitem__) is None
+    assert outcomes == {uris[4]: 'unchanged'}
+
+
+def test_reconcile_slice_removes_stale_entry_within_full_slice(
+        tmp_app_with_users, tmp_dir_fixture):  # NOQA
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+
+    uris = []
+    for i in range(3):
+        proto_dataset = dtoolcore.create_proto_dataset(
+            'dataset-{}'.format(i), base_uri, creator_username='snow-white')
+        proto_dataset.freeze()
+        uris.append(proto_dataset.uri)
+        _register_dataset_from_uri(proto_dataset.uri, base_uri)
+
+    # indexed after the listed datasets, sort into the first slice
+    _add_gone_entry(base_uri, name='dataset-0a')
+    _add_gone_entry(base_uri, name='dataset-0b',
+                    uuid='1a1f9fad-8589-413e-9602-5bbd66bfe676')
+
+    outcomes = {}
+    assert reconcile_slice(base_uri, slice_size=2,
+                           callback=outcomes.__setitem__) == uris[1]
+    assert outcomes == {uris[0]: 'unchanged', uris[1]: 'unchanged',
+                        base_uri + '/dataset-0a': 'deleted',
+                        base_uri + '/dataset-0b': 'deleted'}
+
+    datasets = list_datasets_by_user('snow-white')
+    assert sorted(dataset['uri'] for dataset in datasets) == uris
+
+
+def test_reconcile_dataset_without_manifest_signature(
+        tmp_app_with_users, tmp_dir_fixture):  # NOQA
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+
+    proto_dataset = dtoolcore.create_proto_dataset(
+        'dataset', base_uri, creator_username='snow-white')
+    proto_dataset.put_item(os.path.join(TEST_SAMPLE_DATA, 'tiny.png'), 'tiny.png')
+    proto_dataset.freeze()
+    uri = proto_dataset.uri
+    _register_dataset_from_uri(uri, base_uri)
+    signature = mongo.db[MONGO_COLLECTION].find_one({'uri': uri})['manifest_signature']
+
+    # entries registered before signatures were stored are compared in full
+    # once and not registered again if up to date
+    collection = mongo.db[MONGO_COLLECTION]
+    collection.update_one({'uri': uri}, {'$unset': {'manifest_signature': ''}})
+    assert reconcile_dataset(uri, base_uri) == 'unchanged'
+    assert collection.find_one({'uri': uri})['manifest_signature'] == signature
+
+    collection.update_one({'uri': uri}, {'$unset': {'manifest_signature': ''},
+                                         '$set': {'manifest.items': {}}})
+    assert reconcile_dataset(uri, base_uri) == 'updated'
+    assert collection.find_one({'uri': uri})['manifest_signature'] == signature
+    assert reconcile_dataset(uri, base_uri) == 'unchanged'
+
+
+def test_cursor_store(tmp_dir_fixture):  # NOQA
+    path = os.path.join(tmp_dir_fixture, 'cursors.json')
+    cursors = CursorStore(path)
+    cursors.set('s3://bucket', 's3://bucket/a2218059-5bd0-4690-b090-062faf08e040')
+    cursors.set('file:///data', None)
+
+    cursors = CursorStore(path)
+    assert cursors.get('s3://bucket') == 's3://bucket/a2218059-5bd0-4690-b090-062faf08e040'
+    assert cursors.get('file:///data') is None
+    assert cursors.get('s3://other') is None
+    assert os.listdir(tmp_dir_fixture) == ['cursors.json']
+
+
+def test_cursor_store_owned_by_one_process(tmp_dir_fixture):  # NOQA
+    path = os.path.join(tmp_dir_fixture, 'cursors.json')
+    owner = CursorStore(path)
+    other = CursorStore(path)
+    assert owner.acquire()
+    assert not other.acquire()
+
+    owner.set('s3://bucket', 's3://bucket/a2218059-5bd0-4690-b090-062faf08e040')
+    owner.release()
+
+    # the next owner continues where the previous one stopped
+    assert other.acquire()
+    assert other.get('s3://bucket') == 's3://bucket/a2218059-5bd0-4690-b090-062faf08e040'
+    other.release()
+
+
+def test_periodic_reconciler_visits_base_uris_in_turn(monkeypatch):
+    slices = []
+
+    def reconcile_slice(base_uri, start_after=None, **kwargs):
+        slices.append((base_uri, start_after))
+        return '{}/{}'.format(base_uri, len(slices))
+
+    monkeypatch.setattr(reconcile, 'reconcile_slice', reconcile_slice)
+    monkeypatch.setattr(Config, 'BUCKET_TO_BASE_URI', {'a': 's3://a', 'b': 's3://b'})
+
+    reconciler = PeriodicReconciler(Flask(__name__), interval=3600)
+    for _ in range(3):
+        reconciler.run_once()
+    reconciler.stop()
+
+    # every slice continues with the next base URI, not yet completed ones as well
+    assert slices == [('s3://a', None), ('s3://b', None), ('s3://a', 's3://a/1')]
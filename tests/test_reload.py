@@ -0,0 +1,79 @@
+"""Test reloading of the configuration at runtime."""
+import json
+import os
+
+import pytest
+
+from dtool_lookup_server_notification_plugin.config import (
+    BucketIndex,
+    Config,
+    IPAllowList,
+)
+from dtool_lookup_server_notification_plugin.reload import (
+    ConfigFileWatcher,
+    reload_config,
+    reload_counters,
+)
+
+from . import config_file, tmp_dir_fixture  # NOQA
+
+
+def test_config_reload(config_file):  # NOQA
+    buckets = Config.bucket_index()
+    Config.reload()
+
+    # new structures replace the old ones, which are left untouched
+    assert isinstance(Config.BUCKET_TO_BASE_URI, BucketIndex)
+    assert Config.bucket_index() == {'tenant': 's3://tenant'}
+    assert Config.bucket_index() is not buckets
+    assert 'tenant' not in buckets
+    assert isinstance(Config.ALLOW_ACCESS_FROM, IPAllowList)
+    assert '10.1.2.3' in Config.allow_list()
+    assert '192.168.1.1' not in Config.allow_list()
+
+    # settings missing from the file fall back to the environment
+    with open(config_file, 'w') as f:
+        json.dump({'allow_access_from': '10.0.0.0/8, 192.168.0.0/16'}, f)
+    Config.reload()
+    assert Config.bucket_index() == {'bucket': 's3://bucket'}
+    assert '192.168.1.1' in Config.allow_list()
+
+
+@pytest.mark.parametrize('content', [
+    '{',
+    '["tenant"]',
+    '{"bucket_to_base_uri": ["tenant"]}',
+    '{"allow_access_from": ["not-a-network"]}',
+])
+def test_config_reload_invalid(config_file, content):  # NOQA
+    Config.reload()
+    buckets = Config.bucket_index()
+    allow_list = Config.allow_list()
+
+    with open(config_file, 'w') as f:
+        f.write(content)
+    with pytest.raises(ValueError):
+        Config.reload()
+    assert Config.bucket_index() is buckets
+    assert Config.allow_list() is allow_list
+
+    failures = reload_counters['failures']
+    assert reload_config() is not None
+    assert reload_counters['failures'] == failures + 1
+
+
+def test_config_file_watcher(config_file):  # NOQA
+    watcher = ConfigFileWatcher(config_file, interval=3600)
+    try:
+        assert not watcher.check()
+
+        with open(config_file, 'w') as f:
+            json.dump({'bucket_to_base_uri': {'tenant': 's3://tenant',
+                                              'other': 's3://other'}}, f)
+        os.utime(config_file, ns=(0, 0))  # modification within the same tick
+        assert watcher.check()
+        assert Config.bucket_index() == {'tenant': 's3://tenant',
+                                         'other': 's3://other'}
+        assert not watcher.check()
+    finally:
+        watcher.stop()
@@ -0,0 +1,68 @@
+"""Test retries of registering incomplete datasets."""
+import dtoolcore
+
+from flask import Flask
+
+from dtool_lookup_server_notification_plugin.config import Config
+from dtool_lookup_server_notification_plugin.retry import (
+    DeadLetterList,
+    RETRY_TIMER_EXTENSION_NAME,
+    _retry,
+    cancel_retry,
+    dead_letters,
+    get_retry_timer,
+    retry_delay,
+    schedule_retry,
+)
+
+from . import tmp_dir_fixture  # NOQA
+
+
+def test_retry_delay_exponential_and_capped():
+    assert retry_delay(1) == Config.RETRY_BASE_DELAY
+    assert retry_delay(2) == 2*Config.RETRY_BASE_DELAY
+    assert retry_delay(3) == 4*Config.RETRY_BASE_DELAY
+    assert retry_delay(100) == Config.RETRY_MAX_DELAY
+
+
+def test_dead_letter_list_bounded():
+    dead_letter_list = DeadLetterList(max_size=2)
+    for i in range(3):
+        dead_letter_list.add('s3://bucket/{}'.format(i), 's3://bucket', 5, None)
+
+    assert [entry['uri'] for entry in dead_letter_list.to_list()] == [
+        's3://bucket/1', 's3://bucket/2']
+    assert dead_letter_list.remove('s3://bucket/1')
+    assert 's3://bucket/1' not in dead_letter_list
+
+
+def test_retry_incomplete_dataset(tmp_dir_fixture):  # NOQA
+    base_uri = dtoolcore.utils.sanitise_uri(tmp_dir_fixture)
+    proto_dataset = dtoolcore.create_proto_dataset('incomplete', base_uri)
+    dataset_uri = proto_dataset.uri
+
+    app = Flask(__name__)
+    with app.app_context():
+        schedule_retry(dataset_uri, base_uri)
+        timer = get_retry_timer()
+        assert dataset_uri in timer
+
+        # proto datasets cannot be registered, give up after last attempt
+        _retry(app, dataset_uri, base_uri, Config.RETRY_MAX_ATTEMPTS)
+        assert dataset_uri in dead_letters
+        assert dataset_uri in timer
+
+        assert cancel_retry(dataset_uri)
+        assert dataset_uri not in timer
+        assert dataset_uri not in dead_letters
+
+        timer.shutdown(flush=False)
+
+
+def test_cancel_retry_without_timer():
+    app = Flask(__name__)
+    with app.app_context():
+        dead_letters.add('file:///tmp/gone', 'file:///tmp', 1, 'error')
+        assert not cancel_retry('file:///tmp/gone')
+        assert 'file:///tmp/gone' not in dead_letters
+        assert RETRY_TIMER_EXTENSION_NAME not in app.extensions
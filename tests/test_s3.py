@@ -0,0 +1,174 @@
+"""Test caching of text objects read from S3."""
+import io
+import socket
+import threading
+
+import boto3
+import dtoolcore
+import pytest
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from dtool_s3.storagebroker import S3StorageBroker
+
+from dtool_lookup_server_notification_plugin import manifest_signature
+from dtool_lookup_server_notification_plugin.s3 import (
+    announce_etag,
+    content_cache,
+    plugin_storage_access,
+)
+
+KEY = 'a2218059-5bd0-4690-b090-062faf08e040/README.yml'
+
+
+class StorageBroker(object):
+    """Bare S3 storage broker reading from a stubbed client."""
+    get_text = S3StorageBroker.get_text
+
+    def __init__(self):
+        self.bucket = 'bucket'
+        self.s3resource = boto3.resource(
+            's3', region_name='us-east-1',
+            aws_access_key_id='key', aws_secret_access_key='secret')
+
+
+def _response(content, etag):
+    body = content.encode('utf-8')
+    return {'Body': StreamingBody(io.BytesIO(body), len(body)), 'ETag': etag}
+
+
+@pytest.fixture
+def cached_content(request):
+    backup = content_cache.max_bytes
+    content_cache.max_bytes = 1000
+
+    @request.addfinalizer
+    def teardown():
+        content_cache.max_bytes = backup
+        content_cache.clear()
+
+
+def test_get_text_cached_by_etag(cached_content):
+    storage_broker = StorageBroker()
+    with Stubber(storage_broker.s3resource.meta.client) as stubber:
+        stubber.add_response('get_object', _response('abc: def', '"1"'),
+                             {'Bucket': 'bucket', 'Key': KEY})
+        stubber.add_client_error('get_object', service_error_code='304',
+                                 http_status_code=304,
+                                 expected_params={'Bucket': 'bucket', 'Key': KEY,
+                                                  'IfNoneMatch': '"1"'})
+        stubber.add_client_error('get_object', service_error_code='NoSuchKey',
+                                 http_status_code=404)
+
+        with plugin_storage_access():
+            assert storage_broker.get_text(KEY) == 'abc: def'
+            assert storage_broker.get_text(KEY) == 'abc: def'  # not modified
+
+            # current according to notification, no request at all
+            announce_etag('s3://bucket', KEY, '1')
+            assert storage_broker.get_text(KEY) == 'abc: def'
+
+        # not cached outside of the plugin
+        with pytest.raises(ClientError):
+            storage_broker.get_text(KEY)
+
+    stats = content_cache.to_dict()
+    assert (stats['misses'], stats['revalidated'], stats['hits']) == (1, 1, 1)
+
+
+class ManifestStorageBroker(S3StorageBroker):
+    """Bare S3 storage broker with a stubbed client."""
+
+    def __init__(self):
+        self.bucket = 'bucket'
+        self.s3client = boto3.client(
+            's3', region_name='us-east-1',
+            aws_access_key_id='key', aws_secret_access_key='secret')
+
+    def get_manifest_key(self):
+        return 'a2218059-5bd0-4690-b090-062faf08e040/manifest.json'
+
+
+class Dataset(object):
+    uri = 's3://bucket/a2218059-5bd0-4690-b090-062faf08e040'
+
+    def __init__(self, storage_broker):
+        self._storage_broker = storage_broker
+
+
+def test_manifest_signature():
+    storage_broker = ManifestStorageBroker()
+    with Stubber(storage_broker.s3client) as stubber:
+        stubber.add_response(
+            'head_object', {'ETag': '"abc"', 'ContentLength': 42},
+            {'Bucket': 'bucket', 'Key': storage_broker.get_manifest_key()})
+        stubber.add_client_error('head_object', service_error_code='403',
+                                 http_status_code=403)
+
+        assert manifest_signature(Dataset(storage_broker)) == 'abc:42'
+        assert manifest_signature(Dataset(storage_broker)) is None
+
+
+@pytest.fixture
+def s3_config(monkeypatch):
+    for name, value in [('DTOOL_S3_ENDPOINT_{}', 'http://localhost:9000'),
+                        ('DTOOL_S3_ACCESS_KEY_ID_{}', 'key'),
+                        ('DTOOL_S3_SECRET_ACCESS_KEY_{}', 'secret')]:
+        monkeypatch.setenv(name.format('pooled-bucket'), value)
+
+
+def test_clients_reused_within_thread(s3_config):
+    from dtool_lookup_server_notification_plugin.s3 import client_counters
+
+    def get_clients():
+        with plugin_storage_access():
+            return S3StorageBroker._get_resource_and_client('pooled-bucket')
+
+    client_counters.reset()
+    clients = get_clients()
+    assert get_clients() is clients
+
+    other_clients = []
+    thread = threading.Thread(target=lambda: other_clients.append(get_clients()))
+    thread.start()
+    thread.join()
+    assert other_clients[0] is not clients
+
+    # not reused outside of the plugin
+    assert S3StorageBroker._get_resource_and_client('pooled-bucket') is not clients
+
+    assert client_counters.to_dict() == {'created': 2, 'reused': 1}
+
+
+def test_datasets_read_from_moto_server(s3_config, monkeypatch):
+    server_module = pytest.importorskip('moto.server')
+    from dtool_lookup_server_notification_plugin.s3 import client_counters
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = server_module.ThreadedMotoServer(ip_address='127.0.0.1', port=port,
+                                              verbose=False)
+    server.start()
+    try:
+        monkeypatch.setenv('DTOOL_S3_ENDPOINT_pooled-bucket',
+                           'http://127.0.0.1:{}'.format(port))
+        with plugin_storage_access():
+            S3StorageBroker._get_resource_and_client('pooled-bucket')[1] \
+                .create_bucket(Bucket='pooled-bucket')
+
+        proto_dataset = dtoolcore.create_proto_dataset(
+            'pooled', 's3://pooled-bucket', readme_content='abc: def')
+        proto_dataset.freeze()
+
+        client_counters.reset()
+        with plugin_storage_access():
+            for _ in range(3):
+                dataset = dtoolcore.DataSet.from_uri(proto_dataset.uri)
+                assert dataset.get_readme_content() == 'abc: def'
+        assert client_counters['created'] == 0
+        assert client_counters['reused'] >= 3
+    finally:
+        server.stop()
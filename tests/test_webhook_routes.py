@@ -3,9 +3,12 @@ import ipaddress
 import json
 import os
 import shutil
+import threading
+import types
 import urllib.parse
 
 import dtoolcore
+import pytest
 import yaml
 
 from dtoolcore import ProtoDataSet, generate_admin_metadata
@@ -13,20 +16,41 @@ from dtoolcore import DataSet
 from dtoolcore.utils import generate_identifier, sanitise_uri
 from dtoolcore.storagebroker import DiskStorageBroker
 
+from dtool_lookup_server import mongo, MONGO_COLLECTION
 from dtool_lookup_server.utils import (
     get_readme_from_uri_by_user,
     list_datasets_by_user,
     register_base_uri,
     update_permissions,
+    update_users,
+)
+from dtool_lookup_server_notification_plugin import Config, get_deletion_batcher
+
+from dtool_lookup_server_notification_plugin.journal import (
+    EventJournal,
+    get_journal,
+    journal_counters,
+)
+from dtool_lookup_server_notification_plugin.webhook import _replay_journal
+from dtool_lookup_server_notification_plugin.worker import (
+    get_debouncer,
+    get_ingestion_queue,
 )
-from dtool_lookup_server_notification_plugin import Config
 
 from . import (
     access_restriction,
+    async_processing,
+    debounce_period,
+    deduplication,
+    deletion_batch_period,
+    family_datasets,
     immuttable_dataset_uri,
+    journal_path,
+    profiling,
     tmp_app_with_users,
     tmp_dir_fixture,
     request_json,
+    snowwhite_token,
     TEST_SAMPLE_DATA
 ) # NOQA
 
@@ -122,3 +146,611 @@ def test_webhook_access_restriction(tmp_app_with_users, request_json, access_res
         "/webhook/notify", json=request_json
     )
     assert r.status_code == 403  # Forbidden
+
+
+def test_webhook_notify_route_multiple_records(tmp_app_with_users, tmp_dir_fixture,
+                                               request_json, immuttable_dataset_uri):  # NOQA
+    bucket_name = 'bucket'
+
+    # Add local directory as base URI and assign URI to the bucket
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    dataset = DataSet.from_uri(immuttable_dataset_uri)
+    uuid = dataset.uuid
+    name = dataset.name
+
+    dtoolcore.copy(immuttable_dataset_uri, tmp_dir_fixture)
+    dest_uri = sanitise_uri('/'.join((tmp_dir_fixture, name)))
+
+    def record(event_name, key):
+        r = json.loads(json.dumps(request_json['Records'][0]))
+        r['eventName'] = event_name
+        r['s3']['bucket']['name'] = bucket_name
+        r['s3']['object']['key'] = urllib.parse.quote(key)
+        return r
+
+    # several records for the same dataset within one payload, only
+    # the last relevant one is processed
+    request_json['Records'] = [
+        record('s3:ObjectCreated:Put', f'{uuid}/data/{uuid}'),
+        record('s3:ObjectRemoved:Delete', f'{uuid}/README.yml'),
+        record('s3:ObjectCreated:Put', f'{uuid}/README.yml'),
+        record('s3:ObjectRemoved:Delete', f'{uuid}/tags/some-tag'),
+        record('s3:ObjectAccessed:Get', f'{uuid}/dtool'),
+    ]
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+
+    datasets = list_datasets_by_user('snow-white')
+    assert len(datasets) == 1
+    assert datasets[0]['uri'] == dest_uri
+    assert datasets[0]['uuid'] == uuid
+
+    # removal of the 'dtool' object after an update removes the dataset
+    request_json['Records'] = [
+        record('s3:ObjectCreated:Put', f'{uuid}/README.yml'),
+        record('s3:ObjectRemoved:Delete', f'{uuid}/dtool'),
+    ]
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+
+    datasets = list_datasets_by_user('snow-white')
+    assert len(datasets) == 0
+
+    # records of unknown buckets or without object key are skipped
+    unknown_bucket_record = record('s3:ObjectCreated:Put', f'{uuid}/dtool')
+    unknown_bucket_record['s3']['bucket']['name'] = 'unknown-bucket'
+    no_key_record = record('s3:ObjectCreated:Put', f'{uuid}/dtool')
+    del no_key_record['s3']['object']['key']
+    request_json['Records'] = [
+        unknown_bucket_record,
+        no_key_record,
+        record('s3:ObjectCreated:Put', f'{uuid}/dtool'),
+    ]
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+
+    datasets = list_datasets_by_user('snow-white')
+    assert len(datasets) == 1
+
+    r = tmp_app_with_users.get("/webhook/metrics")
+    text = r.data.decode("utf-8")
+    for reason in ['unknown_bucket', 'malformed']:
+        assert 'dtool_lookup_server_notification_ignored_events_total{{reason="{}"}}'.format(
+            reason) in text
+
+
+def test_webhook_notify_route_async(tmp_app_with_users, tmp_dir_fixture,
+                                    request_json, immuttable_dataset_uri,
+                                    async_processing):  # NOQA
+    bucket_name = 'bucket'
+
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    dataset = DataSet.from_uri(immuttable_dataset_uri)
+    uuid = dataset.uuid
+    name = dataset.name
+
+    dtoolcore.copy(immuttable_dataset_uri, tmp_dir_fixture)
+    dest_uri = sanitise_uri('/'.join((tmp_dir_fixture, name)))
+
+    request_json['Records'][0]['eventName'] = 's3:ObjectCreated:Put'
+    request_json['Records'][0]['s3']['bucket']['name'] = bucket_name
+    request_json['Records'][0]['s3']['object']['key'] = urllib.parse.quote(f'{uuid}/README.yml')
+
+    # Notification is accepted before the dataset is registered
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 202
+
+    get_ingestion_queue().join()
+
+    datasets = list_datasets_by_user('snow-white')
+    assert len(datasets) == 1
+    assert datasets[0]['uri'] == dest_uri
+
+    # Unknown buckets are still ignored synchronously
+    request_json['Records'][0]['s3']['bucket']['name'] = 'unknown-bucket'
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+
+
+def test_webhook_notify_route_debounced(tmp_app_with_users, tmp_dir_fixture,
+                                        request_json, immuttable_dataset_uri,
+                                        debounce_period):  # NOQA
+    bucket_name = 'bucket'
+
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    dataset = DataSet.from_uri(immuttable_dataset_uri)
+    uuid = dataset.uuid
+    name = dataset.name
+
+    dtoolcore.copy(immuttable_dataset_uri, tmp_dir_fixture)
+    dest_uri = sanitise_uri('/'.join((tmp_dir_fixture, name)))
+
+    request_json['Records'][0]['eventName'] = 's3:ObjectCreated:Put'
+    request_json['Records'][0]['s3']['bucket']['name'] = bucket_name
+
+    # Several notifications within the quiet period collapse into one
+    # pending registration
+    for key in [f'{uuid}/data/{uuid}', f'{uuid}/README.yml', f'{uuid}/dtool']:
+        request_json['Records'][0]['s3']['object']['key'] = urllib.parse.quote(key)
+        r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+        assert r.status_code == 200
+
+    debouncer = get_debouncer()
+    assert len(debouncer) == 1
+    assert len(list_datasets_by_user('snow-white')) == 0
+
+    debouncer.flush()
+
+    datasets = list_datasets_by_user('snow-white')
+    assert len(datasets) == 1
+    assert datasets[0]['uri'] == dest_uri
+
+    # Removal of the 'dtool' object cancels a pending registration
+    request_json['Records'][0]['s3']['object']['key'] = urllib.parse.quote(f'{uuid}/README.yml')
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+    assert len(debouncer) == 1
+
+    request_json['Records'][0]['eventName'] = 's3:ObjectRemoved:Delete'
+    request_json['Records'][0]['s3']['object']['key'] = urllib.parse.quote(f'{uuid}/dtool')
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+    assert len(debouncer) == 0
+
+    assert len(list_datasets_by_user('snow-white')) == 0
+
+
+def test_webhook_notify_route_incremental_update(tmp_app_with_users, tmp_dir_fixture,
+                                                 request_json, immuttable_dataset_uri,
+                                                 monkeypatch):  # NOQA
+    bucket_name = 'bucket'
+
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    dataset = DataSet.from_uri(immuttable_dataset_uri)
+    uuid = dataset.uuid
+    name = dataset.name
+
+    dtoolcore.copy(immuttable_dataset_uri, tmp_dir_fixture)
+    dest_uri = sanitise_uri('/'.join((tmp_dir_fixture, name)))
+    dataset = DataSet.from_uri(dest_uri)
+
+    request_json['Records'][0]['eventName'] = 's3:ObjectCreated:Put'
+    request_json['Records'][0]['s3']['bucket']['name'] = bucket_name
+    request_json['Records'][0]['s3']['object']['key'] = urllib.parse.quote(f'{uuid}/dtool')
+
+    # Initial registration
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+    assert len(list_datasets_by_user('snow-white')) == 1
+
+    # Update README and tags, the manifest must not be read again
+    dataset.put_readme('ghi: jkl')
+    dataset.put_tag('incremental')
+
+    def get_manifest(self):
+        raise AssertionError("Manifest loaded for incremental update.")
+
+    monkeypatch.setattr(DiskStorageBroker, 'get_manifest', get_manifest)
+
+    readme_record = json.loads(json.dumps(request_json['Records'][0]))
+    readme_record['s3']['object']['key'] = urllib.parse.quote(f'{uuid}/README.yml')
+    tag_record = json.loads(json.dumps(request_json['Records'][0]))
+    tag_record['s3']['object']['key'] = urllib.parse.quote(f'{uuid}/tags/incremental')
+    request_json['Records'] = [readme_record, tag_record]
+
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+
+    datasets = list_datasets_by_user('snow-white')
+    assert len(datasets) == 1
+    assert datasets[0]['uri'] == dest_uri
+
+    dataset_info = mongo.db[MONGO_COLLECTION].find_one({'uri': dest_uri})
+    assert dataset_info['tags'] == ['incremental']
+
+    check_readme = get_readme_from_uri_by_user('snow-white', dest_uri)
+    assert check_readme == {'ghi': 'jkl'}
+
+
+def test_webhook_incremental_update_during_registration(tmp_app_with_users, tmp_dir_fixture,
+                                                        immuttable_dataset_uri,
+                                                        monkeypatch):  # NOQA
+    import dtool_lookup_server_notification_plugin as plugin
+
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+
+    dataset = DataSet.from_uri(immuttable_dataset_uri)
+    dtoolcore.copy(immuttable_dataset_uri, tmp_dir_fixture)
+    dest_uri = sanitise_uri('/'.join((tmp_dir_fixture, dataset.name)))
+    dataset = DataSet.from_uri(dest_uri)
+    dataset.put_readme('abc: def')
+    plugin._register_dataset_from_uri(dest_uri, base_uri)
+
+    # hold a full registration after it has read the README
+    app = tmp_app_with_users.application
+    generate_dataset_info = plugin.generate_dataset_info
+    read = threading.Event()
+    release = threading.Event()
+
+    def slow_generate_dataset_info(*args, **kwargs):
+        dataset_info = generate_dataset_info(*args, **kwargs)
+        read.set()
+        release.wait()
+        return dataset_info
+
+    monkeypatch.setattr(plugin, 'generate_dataset_info', slow_generate_dataset_info)
+
+    def register():
+        with app.app_context():
+            plugin._register_dataset_from_uri(dest_uri, base_uri)
+
+    def update():
+        with app.app_context():
+            assert plugin._update_dataset_metadata(dest_uri, ['README.yml'])
+
+    registration = threading.Thread(target=register)
+    registration.start()
+    assert read.wait(10)
+
+    dataset.put_readme('ghi: jkl')
+    incremental_update = threading.Thread(target=update)
+    incremental_update.start()
+    # the update waits for the registration in progress
+    incremental_update.join(0.2)
+    assert incremental_update.is_alive()
+
+    release.set()
+    registration.join()
+    incremental_update.join()
+
+    assert get_readme_from_uri_by_user('snow-white', dest_uri) == {'ghi': 'jkl'}
+    assert len(plugin.dataset_locks) == 0
+
+
+def test_webhook_notify_route_batched_deletion(tmp_app_with_users, tmp_dir_fixture,
+                                               request_json, immuttable_dataset_uri,
+                                               deletion_batch_period):  # NOQA
+    bucket_name = 'bucket'
+
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    dataset = DataSet.from_uri(immuttable_dataset_uri)
+    uuid = dataset.uuid
+
+    dtoolcore.copy(immuttable_dataset_uri, tmp_dir_fixture)
+
+    request_json['Records'][0]['eventName'] = 's3:ObjectCreated:Put'
+    request_json['Records'][0]['s3']['bucket']['name'] = bucket_name
+    request_json['Records'][0]['s3']['object']['key'] = urllib.parse.quote(f'{uuid}/dtool')
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+    assert len(list_datasets_by_user('snow-white')) == 1
+
+    # Removals are collected until the end of the batch period
+    request_json['Records'][0]['eventName'] = 's3:ObjectRemoved:Delete'
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+
+    deletion_batcher = get_deletion_batcher()
+    assert len(deletion_batcher) == 1
+    assert len(list_datasets_by_user('snow-white')) == 1
+
+    deletion_batcher.flush()
+
+    assert len(list_datasets_by_user('snow-white')) == 0
+    assert mongo.db[MONGO_COLLECTION].count_documents({'uuid': uuid}) == 0
+
+
+def test_delete_datasets_restores_entries_left_in_mongo(tmp_app_with_users,
+                                                        monkeypatch):  # NOQA
+    import dtool_lookup_server_notification_plugin as plugin
+    from dtool_lookup_server.utils import register_dataset
+
+    datasets = family_datasets()[:2]
+    for dataset_info in datasets:
+        register_dataset(dataset_info)
+
+    collection = mongo.db[MONGO_COLLECTION]
+
+    class PartiallyFailingCollection(object):
+        def __getattr__(self, name):
+            return getattr(collection, name)
+
+        def delete_many(self, query):
+            collection.delete_one({'uri': datasets[0]['uri']})
+            raise RuntimeError("Connection lost.")
+
+    monkeypatch.setattr(plugin, 'mongo', types.SimpleNamespace(
+        db={MONGO_COLLECTION: PartiallyFailingCollection()}))
+
+    with pytest.raises(RuntimeError):
+        plugin.delete_datasets({(dataset_info['base_uri'], dataset_info['uuid']): dataset_info['uri']
+                                for dataset_info in datasets})
+
+    # only the entry still present in the Mongo database is restored
+    assert [dataset['uri'] for dataset in list_datasets_by_user('grumpy')] == [
+        datasets[1]['uri']]
+
+
+def test_webhook_notify_route_creation_cancels_batched_deletion(
+        tmp_app_with_users, tmp_dir_fixture, request_json, immuttable_dataset_uri,
+        deletion_batch_period):  # NOQA
+    bucket_name = 'bucket'
+
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    uuid = DataSet.from_uri(immuttable_dataset_uri).uuid
+    dtoolcore.copy(immuttable_dataset_uri, tmp_dir_fixture)
+
+    request_json['Records'][0]['s3']['bucket']['name'] = bucket_name
+    request_json['Records'][0]['s3']['object']['key'] = urllib.parse.quote(f'{uuid}/dtool')
+    for event_name in ['s3:ObjectCreated:Put', 's3:ObjectRemoved:Delete',
+                       's3:ObjectCreated:Put']:
+        request_json['Records'][0]['eventName'] = event_name
+        r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+        assert r.status_code == 200
+
+    # the dataset created again within the batch period is not deleted
+    deletion_batcher = get_deletion_batcher()
+    assert len(deletion_batcher) == 0
+    deletion_batcher.flush()
+    assert len(list_datasets_by_user('snow-white')) == 1
+
+
+def test_webhook_notify_route_journal(tmp_app_with_users, tmp_dir_fixture, journal_path,
+                                     request_json, immuttable_dataset_uri):  # NOQA
+    bucket_name = 'bucket'
+
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    dataset = DataSet.from_uri(immuttable_dataset_uri)
+    dtoolcore.copy(immuttable_dataset_uri, tmp_dir_fixture)
+
+    request_json['Records'][0]['s3']['bucket']['name'] = bucket_name
+    request_json['Records'][0]['s3']['object']['key'] = f'{dataset.uuid}/dtool'
+
+    # ignored events are not journaled
+    appended = journal_counters.to_dict()['appended']
+    request_json['Records'][0]['eventName'] = 's3:ObjectRestore:Post'
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+    assert get_journal().path.startswith(journal_path + '.')
+    assert journal_counters.to_dict()['appended'] == appended
+
+    request_json['Records'][0]['eventName'] = 's3:ObjectCreated:Put'
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+    assert journal_counters.to_dict()['appended'] == appended + 1
+    assert len(get_journal()) == 0
+    assert len(list_datasets_by_user('snow-white')) == 1
+
+    # a removal left by a stopped process is superseded by the re-creation
+    stopped = EventJournal(journal_path + '.0.stopped')
+    stopped.append([('s3:ObjectRemoved:Delete', request_json['Records'][0]['s3'])])
+    stopped.close()
+    _replay_journal(tmp_app_with_users.application)
+    assert len(list_datasets_by_user('snow-white')) == 1
+    assert not os.path.exists(journal_path + '.0.stopped')
+
+    # unless the dataset is gone
+    shutil.rmtree(os.path.join(tmp_dir_fixture, dataset.name))
+    stopped = EventJournal(journal_path + '.0.stopped')
+    stopped.append([('s3:ObjectRemoved:Delete', request_json['Records'][0]['s3'])])
+    stopped.close()
+    _replay_journal(tmp_app_with_users.application)
+    assert len(list_datasets_by_user('snow-white')) == 0
+
+
+def test_webhook_notify_route_stale_event(tmp_app_with_users, tmp_dir_fixture,
+                                          request_json, immuttable_dataset_uri):  # NOQA
+    bucket_name = 'bucket'
+
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    dataset = DataSet.from_uri(immuttable_dataset_uri)
+    uuid = dataset.uuid
+
+    dtoolcore.copy(immuttable_dataset_uri, tmp_dir_fixture)
+
+    request_json['Records'][0]['s3']['bucket']['name'] = bucket_name
+    request_json['Records'][0]['s3']['object']['key'] = urllib.parse.quote(f'{uuid}/dtool')
+
+    # removal of the 'dtool' object arrives before its earlier creation
+    request_json['Records'][0]['eventName'] = 's3:ObjectRemoved:Delete'
+    request_json['Records'][0]['s3']['object']['sequencer'] = '16D67651D0E38941'
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+
+    request_json['Records'][0]['eventName'] = 's3:ObjectCreated:Put'
+    request_json['Records'][0]['s3']['object']['sequencer'] = '16D67651D0E38940'
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+
+    assert len(list_datasets_by_user('snow-white')) == 0
+
+    # later creation registers the dataset
+    request_json['Records'][0]['s3']['object']['sequencer'] = '16D67651D0E38942'
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+
+    assert len(list_datasets_by_user('snow-white')) == 1
+
+
+def test_webhook_notify_route_redelivery(tmp_app_with_users, tmp_dir_fixture,
+                                         request_json, immuttable_dataset_uri,
+                                         deduplication):  # NOQA
+    bucket_name = 'bucket'
+
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    dataset = DataSet.from_uri(immuttable_dataset_uri)
+    uuid = dataset.uuid
+    name = dataset.name
+
+    dtoolcore.copy(immuttable_dataset_uri, tmp_dir_fixture)
+    dest_uri = sanitise_uri('/'.join((tmp_dir_fixture, name)))
+
+    request_json['Records'][0]['eventName'] = 's3:ObjectCreated:Put'
+    request_json['Records'][0]['s3']['bucket']['name'] = bucket_name
+    request_json['Records'][0]['s3']['object']['key'] = urllib.parse.quote(f'{uuid}/dtool')
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+    assert len(list_datasets_by_user('snow-white')) == 1
+
+    # redelivered notification about the same object is ignored
+    DataSet.from_uri(dest_uri).put_readme('abc: def')
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+    assert get_readme_from_uri_by_user('snow-white', dest_uri) != {'abc': 'def'}
+
+    r = tmp_app_with_users.get(
+        "/webhook/stats",
+        headers=dict(Authorization="Bearer " + snowwhite_token))
+    assert r.status_code == 200
+    assert json.loads(r.data.decode("utf-8"))['dedup_cache']['hits'] == 1
+
+    # new request
+    request_json['Records'][0]['responseElements']['x-amz-request-id'] = 'C3D13FE58DE4C811'
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+    assert get_readme_from_uri_by_user('snow-white', dest_uri) == {'abc': 'def'}
+
+
+def test_webhook_metrics_route(tmp_app_with_users, request_json):  # NOQA
+    request_json['Records'][0]['eventName'] = 's3:ObjectRestore:Post'
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+
+    # bucket names not configured are not used as labels
+    request_json['Records'][0]['s3']['bucket']['name'] = 'random-8f3a2c'
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+
+    r = tmp_app_with_users.get("/webhook/metrics")
+    assert r.status_code == 200
+    assert r.content_type.startswith('text/plain')
+
+    text = r.data.decode("utf-8")
+    assert 'dtool_lookup_server_notification_events_total{route="webhook",' \
+           'event_name="s3:ObjectRestore:Post",bucket="unknown"}' in text
+    assert 'random-8f3a2c' not in text
+    assert 'dtool_lookup_server_notification_ignored_events_total{reason="unsupported_event"}' in text
+    assert 'dtool_lookup_server_notification_request_duration_seconds_count{route="webhook"}' in text
+
+
+def test_webhook_profile_route(tmp_app_with_users, tmp_dir_fixture, request_json,
+                               immuttable_dataset_uri, profiling):  # NOQA
+    bucket_name = 'bucket'
+
+    base_uri = sanitise_uri(tmp_dir_fixture)
+    register_base_uri(base_uri)
+    update_permissions({
+        'base_uri': base_uri,
+        'users_with_search_permissions': ['snow-white'],
+        'users_with_register_permissions': ['snow-white'],
+    })
+    Config.BUCKET_TO_BASE_URI[bucket_name] = base_uri
+
+    dataset = DataSet.from_uri(immuttable_dataset_uri)
+    dtoolcore.copy(immuttable_dataset_uri, tmp_dir_fixture)
+
+    request_json['Records'][0]['s3']['bucket']['name'] = bucket_name
+    request_json['Records'][0]['s3']['object']['key'] = f'{dataset.uuid}/dtool'
+    r = tmp_app_with_users.post("/webhook/notify", json=request_json)
+    assert r.status_code == 200
+    assert len(list_datasets_by_user('snow-white')) == 1
+
+    r = tmp_app_with_users.get(
+        "/webhook/stats",
+        headers=dict(Authorization="Bearer " + snowwhite_token))
+    assert r.status_code == 200
+    stats = json.loads(r.data.decode("utf-8"))['profile']
+    assert stats['sampled_calls'] == 1
+
+    r = tmp_app_with_users.get(
+        "/webhook/profile",
+        headers=dict(Authorization="Bearer " + snowwhite_token))
+    assert r.status_code == 200
+    assert r.content_type.startswith('text/plain')
+    for line in r.data.decode("utf-8").splitlines():
+        assert line.startswith('webhook;dtool_lookup_server_notification_plugin.webhook:notify')
+
+    # only admins may pull profiles
+    update_users([{'username': 'snow-white', 'is_admin': False}])
+    for route in ["/webhook/profile", "/elastic-search/profile"]:
+        r = tmp_app_with_users.get(
+            route, headers=dict(Authorization="Bearer " + snowwhite_token))
+        assert r.status_code == 403
@@ -0,0 +1,216 @@
+"""Test the background ingestion queue."""
+import queue
+import threading
+import time
+
+import pytest
+
+from flask import Flask, current_app
+
+from dtool_lookup_server_notification_plugin.worker import (
+    BatchCollector,
+    IngestionQueue,
+    KeyedLock,
+    KeyedTimer,
+    SingleFlight,
+)
+
+
+def test_ingestion_queue_processes_tasks_in_app_context():
+    app = Flask(__name__)
+    results = []
+
+    def task(value):
+        results.append((current_app.name, value))
+
+    ingestion_queue = IngestionQueue(app, num_workers=2, max_size=10)
+    for i in range(5):
+        ingestion_queue.put(task, i)
+    ingestion_queue.join()
+
+    assert sorted(results) == [(app.name, i) for i in range(5)]
+    ingestion_queue.shutdown()
+
+
+def test_ingestion_queue_bounded_and_drained_on_shutdown():
+    app = Flask(__name__)
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def task(value):
+        started.set()
+        release.wait()
+        results.append(value)
+
+    ingestion_queue = IngestionQueue(app, num_workers=1, max_size=2)
+    ingestion_queue.put(task, 0)  # blocks the only worker
+    started.wait()
+    ingestion_queue.put(task, 1)
+    ingestion_queue.put(task, 2)
+    with pytest.raises(queue.Full):
+        ingestion_queue.put(task, 3)
+
+    release.set()
+    ingestion_queue.shutdown(wait=True)
+    assert results == [0, 1, 2]
+
+    with pytest.raises(RuntimeError):
+        ingestion_queue.put(task, 4)
+
+
+def test_keyed_timer_coalesces_calls_per_key():
+    results = []
+    done = threading.Event()
+
+    def call(key, value):
+        results.append((key, value))
+        if len(results) == 2:
+            done.set()
+
+    timer = KeyedTimer()
+    for i in range(10):
+        timer.schedule('a', 0.1, call, 'a', i)
+    timer.schedule('b', 0.1, call, 'b', 0)
+    assert len(timer) == 2
+
+    assert done.wait(5)
+    assert sorted(results) == [('a', 9), ('b', 0)]
+    assert len(timer) == 0
+    timer.shutdown()
+
+
+def test_keyed_timer_cancel_and_flush():
+    results = []
+
+    timer = KeyedTimer()
+    timer.schedule('a', 60, results.append, 'a')
+    timer.schedule('b', 60, results.append, 'b')
+    timer.schedule('b', 0, results.append, 'c', reset=False)  # keeps deadline
+    assert 'a' in timer
+
+    assert timer.cancel('a')
+    assert not timer.cancel('a')
+    assert results == []
+
+    timer.shutdown(flush=True)
+    assert results == ['c']
+
+
+def test_batch_collector_collects_within_period():
+    app = Flask(__name__)
+    batches = []
+    processed = threading.Event()
+
+    def process(batch):
+        assert current_app.name == app.name
+        batches.append(dict(batch))
+        processed.set()
+
+    collector = BatchCollector(app, process, period=0.1, max_size=100)
+    collector.add({'a': 1, 'b': 2})
+    collector.add({'a': 3})
+    assert processed.wait(5)
+
+    assert batches == [{'a': 3, 'b': 2}]
+    assert len(collector) == 0
+    collector.shutdown()
+
+
+def test_batch_collector_max_size_and_flush_on_shutdown():
+    app = Flask(__name__)
+    batches = []
+    processed = threading.Event()
+
+    def process(batch):
+        batches.append(sorted(batch))
+        processed.set()
+
+    collector = BatchCollector(app, process, period=60, max_size=2)
+    collector.add({'a': 1, 'b': 2})
+    assert processed.wait(5)  # full batch processed before end of period
+
+    collector.add({'c': 3})
+    collector.shutdown()
+    assert batches == [['a', 'b'], ['c']]
+
+    with pytest.raises(RuntimeError):
+        collector.add({'d': 4})
+
+
+def test_batch_collector_remove():
+    app = Flask(__name__)
+    batches = []
+
+    collector = BatchCollector(app, batches.append, period=60, max_size=100)
+    collector.add({'a': 1, 'b': 2})
+    assert collector.remove('a')
+    assert not collector.remove('a')
+    collector.shutdown()
+    assert batches == [{'b': 2}]
+
+
+def test_keyed_lock_excludes_per_key():
+    locks = KeyedLock()
+    order = []
+
+    def hold(key, value):
+        with locks.hold(key):
+            order.append(value)
+
+    with locks.hold('a'):
+        other_key = threading.Thread(target=hold, args=('b', 'b'))
+        other_key.start()
+        other_key.join()
+        assert order == ['b']
+
+        same_key = threading.Thread(target=hold, args=('a', 'a'))
+        same_key.start()
+        same_key.join(0.05)
+        assert same_key.is_alive()
+        order.append('held')
+    same_key.join()
+
+    assert order == ['b', 'held', 'a']
+    assert len(locks) == 0
+
+
+def test_single_flight_reruns_once_for_callers_in_flight():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def register(value):
+        calls.append(value)
+        if len(calls) == 1:
+            release.wait()
+        return len(calls)
+
+    results = {}
+
+    def run(value):
+        results[value] = flights.run('dataset', register, value)
+
+    leader = threading.Thread(target=run, args=(0,))
+    leader.start()
+    while len(calls) == 0:
+        time.sleep(0.001)
+
+    followers = [threading.Thread(target=run, args=(i,)) for i in range(1, 5)]
+    for follower in followers:
+        follower.start()
+    while flights.to_dict()['attached'] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join()
+
+    # a single rerun on behalf of all callers arrived during the first call
+    assert len(calls) == 2
+    assert results[0] == 1
+    assert all(results[i] == 2 for i in range(1, 5))
+    assert flights.to_dict() == {'in_flight': 0, 'started': 2, 'attached': 3}
+
+    with pytest.raises(KeyError):
+        flights.run('dataset', lambda: {}['missing'])
+    assert len(flights) == 0